@@ -15,14 +15,65 @@ import asyncore
 import asynchat
 import threading
 import socket
-import json
 
 import time
+import collections
 
-from .nodeutils import parse_headers 
+from .nodeutils import parse_headers, json_codec
 
 DEBUG_HOST = 'localhost'
 DEBUG_PORT = 5858
+LOOP_TIMEOUT = 0.5
+
+# evaluate で受け取る文字列の長さ.
+# 通常は先頭の一部のみ受け取り、続きは必要になったときに受け取る.
+PREVIEW_STRING_LENGTH = 200
+CHUNK_STRING_LENGTH = 4000
+FULL_STRING_LENGTH = 100000
+
+# 応答時間(request の送信からレスポンスの受け取りまで)を保持する数.
+LATENCY_SAMPLES = 1000
+
+# レスポンスをできるだけ小さくするために、request に追加する arguments.
+# 参照先のオブジェクトはプロパティ内に含めてもらい、refs を省略させる.
+COMPACT_ARGUMENTS = {
+        'inlineRefs': True,
+        'compactFormat': True
+        }
+
+class Waker(asyncore.dispatcher):
+    """select で待っている asyncore のループを、他のスレッドから起こす.
+
+    handle_wake が指定されたときは、起こされたループのスレッドで呼び出す.
+    """
+    def __init__(self, handle_wake=None):
+        r, self.w = socket.socketpair()
+        asyncore.dispatcher.__init__(self, r)
+        self.w.setblocking(False)
+        self._handle_wake = handle_wake
+        return
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        self.recv(4096)
+        if self._handle_wake is not None:
+            self._handle_wake()
+        return
+
+    def wake(self):
+        try:
+            self.w.send(b'x')
+        except OSError:
+            # すでに起こしてある(バッファがいっぱい)か、閉じられている.
+            pass
+        return
+
+    def close(self):
+        asyncore.dispatcher.close(self)
+        self.w.close()
+        return
 
 class NodeClient(asynchat.async_chat):
     """Node.js の debugger を非同期に制御するクラス."""
@@ -30,18 +81,75 @@ class NodeClient(asynchat.async_chat):
         asynchat.async_chat.__init__(self)
         self.sending = threading.Lock()
         self.ibuffer = []
+        self.seq = 0
+        self.tags = {}
+
+        # 送信待ちの request. 送信は asyncore のループのスレッドでまとめて行う.
+        self.obuffer = []
+        self.closing = False
+        self.waker = Waker(self.handle_wake)
+
+        # 送受信したバイト数.
+        self.bytes_in = 0
+        self.bytes_out = 0
+        # request ごとの送信時刻と、直近の応答時間(秒).
+        self.sent_at = {}
+        self.latencies = collections.deque(maxlen=LATENCY_SAMPLES)
+        # 読み捨てたメッセージの数(ボディが JSON でないものなど).
+        self.discarded = 0
 
         self._handle_resp = handle_resp
         return
     
-    def connect_start(self):
+    def connect_start(self, host=DEBUG_HOST, port=DEBUG_PORT):
         """ debugger と接続する."""
         self.set_terminator(b'\r\n\r\n')
         self.reading_headers = True
         self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.connect((DEBUG_HOST, DEBUG_PORT))
+        # 小さな request が続くときに、Nagle アルゴリズムで待たされないように.
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.connect((host, port))
+        return
+
+    def writable(self):
+        return len(self.obuffer) > 0 or self.closing or not self.connected
+
+    def handle_write(self):
+        """ 送信待ちの request をまとめて送信する."""
+        with self.sending:
+            data = b''.join(self.obuffer)
+            self.obuffer = []
+        if len(data) > 0:
+            sent = self.send(data)
+            self.bytes_out = self.bytes_out + sent
+            if sent < len(data):
+                # 送りきれなかった分は、次のループで送信する.
+                with self.sending:
+                    self.obuffer.insert(0, data[sent:])
+        if self.closing and len(self.obuffer) == 0:
+            self.close()
         return
 
+    def close_when_done(self):
+        """ 送信待ちの request を送信し終えてから閉じる."""
+        self.closing = True
+        self.waker.wake()
+        return
+
+    def close(self):
+        asynchat.async_chat.close(self)
+        self.waker.close()
+        return
+
+    def queue_depth(self):
+        """ 送信待ちの (request の数, バイト数)."""
+        with self.sending:
+            return len(self.obuffer), sum(len(b) for b in self.obuffer)
+
+    def handle_wake(self):
+        """ Waker に起こされたときに、ループのスレッドで呼び出される."""
+        pass
+
     def handle_error(self):
         # TODO: 主に `[Errno 111] Connection refused` だが、
         # 状況にあわせたメッセージの表示等を追加.
@@ -57,14 +165,21 @@ class NodeClient(asynchat.async_chat):
 
     def collect_incoming_data(self, data):
         self.ibuffer.append(data)
+        self.bytes_in = self.bytes_in + len(data)
         return
 
     def found_terminator(self):
-        data = b''.join(self.ibuffer).decode()
+        data = b''.join(self.ibuffer)
         if self.reading_headers:
             # ヘッダの受け取り.
-            headers = parse_headers(data)
-            clen = int(headers['Content-Length'])
+            # 接続直後のヘッダのみのメッセージ(Type: connect)は
+            # Content-Length が 0 なので、なくても 0 として扱う.
+            headers = parse_headers(data.decode('latin-1'))
+            try:
+                clen = int(headers.get('Content-Length', 0))
+            except ValueError:
+                clen = 0
+                self.discarded = self.discarded + 1
             if clen > 0:
                 # 長さの指定があったので受け取る.
                 self.set_terminator(clen)
@@ -80,29 +195,91 @@ class NodeClient(asynchat.async_chat):
             self.set_terminator(b'\r\n\r\n')
             self.reading_headers = True
             self.ibuffer = []
-            self._handle_resp(json.loads(data))
+            try:
+                resp = json_codec.loads(data)
+            except ValueError:
+                # 壊れたボディのために接続を閉じないよう、読み捨てる.
+                self.discarded = self.discarded + 1
+                return
+            self._handle_resp(resp)
         return
 
     #-----------------------------------------------------------------------
     #   utils
     #-----------------------------------------------------------------------
-    def loop(self):
-        asyncore.loop()
+    def loop(self, tick=None):
+        """ asyncore のループ.
+
+        tick が指定されたときは、ループの一回ごとに呼び出し、
+        戻り値を次の select のタイムアウト(秒)とする.
+        """
+        if tick is None:
+            asyncore.loop()
+            return
+
+        timeout = LOOP_TIMEOUT
+        while asyncore.socket_map:
+            asyncore.loop(timeout, count=1)
+            timeout = tick()
+        return
+
+    def new_seq(self, tag=None):
+        """request の seq を割り当てる(self.sending を取得して呼び出す).
 
-    def send_req(self, req):
+        tag が指定されたときは、レスポンスの受け取り時に pop_tag で取得できる
+        ように seq と関連付けて保持しておく.
+        """
+        self.seq = self.seq + 1
+        self.sent_at[self.seq] = time.time()
+        if tag is not None:
+            # レスポンスの方が先に届くこともあるので、送信前に登録する.
+            self.tags[self.seq] = tag
+        return self.seq
+
+    def push_data(self, data):
+        """送信するデータを送信待ちに追加する."""
+        with self.sending:
+            self.obuffer.append(data)
+        self.waker.wake()
+        return
+
+    def send_req(self, req, tag=None):
         """debugger へ request を送信する."""
 
         try:
             self.sending.acquire()
+            seq = self.new_seq(tag)
+            req['seq'] = seq
             req['type'] = 'request'
-            msg = json.dumps(req).encode()
+            msg = json_codec.dumps(req)
             cont = b'Content-Length:' + str(len(msg)).encode() + b"\r\n\r\n" + msg
 
-            self.send(cont)
+            self.obuffer.append(cont)
         finally:
             self.sending.release()
 
-        return
+        self.waker.wake()
+        return seq
+
+    def pop_tag(self, data):
+        """レスポンスに対応する request の tag を取得する(なければ None)."""
+        seq = data.get('request_seq')
+        sent = self.sent_at.pop(seq, None)
+        if sent is not None:
+            self.latencies.append(time.time() - sent)
+        return self.tags.pop(seq, None)
+
+    def latency(self):
+        """直近の応答時間の (中央値, 99 パーセンタイル, 最大) (秒).
+
+        まだレスポンスを受け取っていないときは None.
+        """
+        samples = sorted(self.latencies)
+        if len(samples) == 0:
+            return None
+        return (samples[len(samples) // 2],
+                samples[min(len(samples) - 1, len(samples) * 99 // 100)],
+                samples[-1])
 
     #-----------------------------------------------------------------------
     #   commands for Node.js debugger
@@ -135,11 +312,16 @@ class NodeClient(asynchat.async_chat):
         return
 
     def dbg_setbp(self, name, lnum, enabled=True, columnNumber=0, \
-            condition=None, ignoreCount=0):
+            condition=None, ignoreCount=0, tag=None, type='script'):
+        """debugger へ setbreakpoint をリクエスト.
+
+        type が 'function' のときは name を関数の式とし、lnum は関数の先頭から
+        の行(1 から)とする.
+        """
         req = {
                 'command': 'setbreakpoint',
                 'arguments': {
-                    'type': 'script',
+                    'type': type,
                     'target': name,
                     'line': int(lnum) - 1,
                     'column': columnNumber,
@@ -149,7 +331,7 @@ class NodeClient(asynchat.async_chat):
                     }
                 }
 
-        self.send_req(req)
+        self.send_req(req, tag)
         return
 
     def dbg_clearbp(self, bp_id):
@@ -175,14 +357,21 @@ class NodeClient(asynchat.async_chat):
         self.send_req(req)
         return
 
-    def dbg_backtrace(self):
+    def dbg_backtrace(self, inlineRefs=True, tag=None):
         req = {
                 'command': 'backtrace'
                 }
-        self.send_req(req)
+        if inlineRefs:
+            req['arguments'] = dict(COMPACT_ARGUMENTS)
+        self.send_req(req, tag)
+        return
+
+    def dbg_suspend(self, tag=None):
+        self.send_req({ 'command': 'suspend' }, tag)
         return
 
-    def dbg_evaluate(self, expression, frame=0, context=None):
+    def dbg_evaluate(self, expression, frame=0, context=None, tag=None,
+            maxStringLength=PREVIEW_STRING_LENGTH):
 
         req = {
                 'command': 'evaluate',
@@ -192,10 +381,11 @@ class NodeClient(asynchat.async_chat):
                     'global': frame == None,
                     'disable_break': True,
                     'additional_context': context,
-                    'maxStringLength': 100000
+                    'maxStringLength': maxStringLength
                     }
                 }
-        self.send_req(req)
+        req['arguments'].update(COMPACT_ARGUMENTS)
+        self.send_req(req, tag)
         return
 
     def dbg_exceptionbp(self, type, enabled):
@@ -209,38 +399,48 @@ class NodeClient(asynchat.async_chat):
         self.send_req(req)
         return
 
-    def dbg_scripts(self):
-        self.send_req({ 'command': 'scripts' })
+    def dbg_scripts(self, ids=None, includeSource=False, tag=None):
+        req = { 'command': 'scripts' }
+        if ids is not None:
+            req['arguments'] = {
+                    'ids': ids,
+                    'includeSource': includeSource
+                    }
+        self.send_req(req, tag)
         return
 
-    def lookup(self, handles):
+    def lookup(self, handles, tag=None):
         req = {
                 'command': 'lookup',
                 'arguments': {
                     'handles': handles,
-                    'includeSource': False
+                    'includeSource': False,
+                    'maxStringLength': PREVIEW_STRING_LENGTH
                     }
                 }
-        self.send_req(req)
+        req['arguments'].update(COMPACT_ARGUMENTS)
+        self.send_req(req, tag)
         return
 
-    def dbg_frame(self):
+    def dbg_frame(self, number=None, tag=None):
         req = {
                 'command': 'frame',
-                'arguments': {
-                    }
+                'arguments': dict(COMPACT_ARGUMENTS)
                 }
-        self.send_req(req)
+        if number is not None:
+            req['arguments']['number'] = number
+        self.send_req(req, tag)
         return
 
-    def dbg_scope(self, scopeNumber, frameNumber=None):
+    def dbg_scope(self, scopeNumber, frameNumber=None, tag=None):
         req = {
                 'command': 'scope',
                 'arguments': {
                     'number': scopeNumber,
                     'frameNumber': frameNumber,
-                    'inlineRefs': True
+                    'maxStringLength': PREVIEW_STRING_LENGTH
                     }
                 }
-        self.send_req(req)
+        req['arguments'].update(COMPACT_ARGUMENTS)
+        self.send_req(req, tag)
         return
@@ -24,11 +24,15 @@
 """
 
 import os
+import re
 import sys
+import time
+import json
 import traceback
 import threading
-import functools
 import queue
+import shlex
+import collections
 
 from . import (misc, debugger)
 
@@ -37,8 +41,17 @@ try:
 except ImportError:
     from .misc import OrderedDict
 
-from .nodeclient import NodeClient
-from .nodeutils import (obj_to_print, obj_to_properties, BreakPoints, Scripts)
+from .nodeinspector import InspectorClient, INSPECTOR_PORT
+from .nodesourcemap import SourceMaps
+from .nodeprocess import NodeProcess, free_port
+from .nodeclient import (NodeClient, DEBUG_HOST, DEBUG_PORT, LOOP_TIMEOUT,
+        CHUNK_STRING_LENGTH, FULL_STRING_LENGTH)
+from .nodeutils import (obj_to_print, obj_to_properties, BreakPoints,
+        BreakPointJournal, journal_path, Scripts, json_codec,
+        EventQueue, SymbolIndex, SourceCache, StackSampler, logpoint_condition, logpoint_drain_expr,
+        logpoint_records, watch_expr, watch_values, serialize_expr,
+        serialized_to_print, string_remains, frame_location,
+        quickfix_locations, PyProfiler)
 
 # set the logging methods
 (critical, error, warning, info, debug) = misc.logmethods('nodedbg')
@@ -52,6 +65,27 @@ Unused = debug
 # グローバルにした(んだけどいいのか?)
 bps = BreakPoints()
 
+# balloon で評価する式(識別子とプロパティの参照のみ)と、
+# マウスが止まってから評価するまでの秒数.
+BALLOON_EXPR = re.compile(r'^[A-Za-z_$][\w$]*(\.[A-Za-z_$][\w$]*)*$')
+BALLOON_DELAY = 0.3
+
+# Cfindvar/N で lookup するオブジェクトの数の上限と、一度に lookup する数.
+FINDVAR_MAX_LOOKUPS = 200
+FINDVAR_BATCH = 50
+
+# 変数の履歴(Cvarhistory)として保持する停止の数.
+VARHISTORY_SIZE = 20
+
+# Cpyprofile stop で表示する関数の数.
+PYPROFILE_TOP = 20
+
+# Cbreak /regex/ や Cbreak @file で一度に設定するブレイクポイントの数の上限.
+BULK_BREAK_MAX = 500
+
+# Cbreak で debugger に探させる関数の式(foo や Foo.prototype.bar など).
+FUNCTION_NAME = re.compile(r'^[A-Za-z_$][\w$]*(\.[A-Za-z_$][\w$]*)*$')
+
 # list of key mappings, used to build the .pyclewn_keys.simple file
 #     key : (mapping, comment)
 MAPKEYS = {
@@ -76,8 +110,20 @@ NODEDBG_CMDS = {
     'continue': (),
     'disable': (),
     'enable': (),
+    'logpoint': None,   # file name completion
+    'watch': (),
+    'unwatch': (),
+    'profile': ('start', 'stop'),
+    'pyprofile': ('start', 'stop'),
     #'interrupt': (),
     'print': (),
+    'more': (),
+    'findvar': (),
+    'varhistory': (),
+    'up': (),
+    'down': (),
+    'frame': (),
+    'stats': (),
     'quit': (),
     'step': (),
 
@@ -85,44 +131,116 @@ NODEDBG_CMDS = {
     'stepout': (),
     # TODO: レスポンスの整形にまだ対応できてないのでコメントアウト
     # 'backtrace': (),
-    'attach': (),
+    'attach': ('inspector',),
     'dettach': ()
 }
 
 class NodeTarget(threading.Thread):
     """Node.js debugger target in another thread."""
 
-    def __init__(self, daemon):
-        """Constructor."""
+    def __init__(self, daemon, host=DEBUG_HOST, port=DEBUG_PORT,
+            inspector=False, launch=None):
+        """Constructor.
+
+        The inspector protocol is used instead of the legacy debugger
+        protocol when inspector is True. When launch is the list of the
+        node arguments (the script and its arguments), node is started with
+        the debugger on a free port and the target connects to it as soon
+        as it is listening.
+
+        """
         threading.Thread.__init__(self)
         self.daemon = daemon
 
         self.bp_dict = {}
-        self.bp_que = queue.Queue()
+        self.bp_que = EventQueue()
+        # 停止するたびに増やし、古い停止時のレスポンスを破棄するのに使う.
+        self.pause_gen = 0
+        # 選択している frame の番号. 停止するたびに 0 に戻す.
+        self.frame_index = 0
+
+        # 受け取ったレスポンスとイベントの数と、最初に停止するまでの時間.
+        self.messages = 0
+        self.started = time.time()
+        self.first_stop = None
 
         self.closed = False
         self.running = False
+        # break などで停止して、ユーザーの操作を待っている.
+        self.stopped = False
+        self.sampler = None
+        # Cpyprofile で計測中のときの PyProfiler.
+        self.pyprofiler = None
+
+        # 停止する前に要求されたステップ実行([stepaction, stepcount] のリスト)
+        self.pending_steps = []
+        self.step_lock = threading.Lock()
 
         # do not print on stdout when running unittests
-        self.testrun = functools.reduce(lambda x, y: x or (y == 'unittest'),
-                                        [False] + list(sys.modules.keys()))
-        self._client = NodeClient(self.handle_resp)
-        self._client.connect_start()
+        self.testrun = 'unittest' in sys.modules
+        if inspector:
+            self._client = InspectorClient(self.handle_message)
+        else:
+            self._client = NodeClient(self.handle_message)
+        self.process = None
+        if launch:
+            port = free_port()
+            try:
+                self.process = NodeProcess(launch, port, inspector,
+                        lambda: self._client.connect_start(host, port),
+                        self._client.close)
+            except OSError:
+                # 起動できなかったので、client の Waker なども閉じておく.
+                self._client.close()
+                raise
+        else:
+            self._client.connect_start(host, port)
+
+    def output(self):
+        """Return the output of the launched node not printed yet."""
+        if self.process is None:
+            return ''
+        return self.process.output.drain()
 
     def close(self):
         """Close the target."""
         self._client.dbg_disconnect()
         self._client.close_when_done()
+        if self.process is not None:
+            self.process.terminate()
         self.closed = True
 
-    def add_bp(self, bp_id, name, lnum):
+    def add_bp(self, bp_id, name, lnum, condition=None, log=None,
+            enabled=True):
         """Add breakpoint."""
         k = name + ':' + str(lnum)
         if k in self.bp_dict:
             pass
         else:
             self.bp_dict[k] = -1 # 重複しての追加がないようにダミーのキーを登録
-            self._client.dbg_setbp(name, lnum)
+            tag = {'type': 'setbreakpoint', 'lnum': int(lnum),
+                    'condition': condition, 'log': log, 'enabled': enabled,
+                    'key': k}
+            self._client.dbg_setbp(name, lnum, enabled, condition=condition,
+                    tag=tag)
+        return True
+
+    def add_func_bp(self, func, condition=None):
+        """Add a breakpoint at the start of the function func.
+
+        The position is known only from the response, as the function is
+        looked up by the debugger.
+
+        """
+        tag = {'type': 'setbreakpoint', 'lnum': None, 'condition': condition,
+                'log': None, 'enabled': True, 'func': func}
+        self._client.dbg_setbp(func, 1, True, condition=condition, tag=tag,
+                type='function')
+        return True
+
+    def register_bp(self, name, lnum, bp_id):
+        """Register the breakpoint whose script was resolved later."""
+        self.bp_dict[name + ':' + str(lnum)] = bp_id
         return True
 
     def delete_bp(self, name, lnum):
@@ -144,25 +262,54 @@ class NodeTarget(threading.Thread):
         #if self.running:
         #    return False
         self.running = True
+        self.stopped = False
         self._client.dbg_continue()
         return True
 
-    def step(self):
-        """Do a single step."""
-        #if self.running:
-        #    return False
-        self._client.dbg_continue('next', 1)
+    def _step(self, action, count):
+        """Step, or merge the step with the pending ones when running."""
+        with self.step_lock:
+            if self.running:
+                # まだ停止していないので、停止したときにまとめて送信する.
+                if len(self.pending_steps) and \
+                        self.pending_steps[-1][0] == action:
+                    self.pending_steps[-1][1] += count
+                else:
+                    self.pending_steps.append([action, count])
+                return True
+            self.running = True
+            self.stopped = False
+        self._client.dbg_continue(action, count)
         return True
 
-    def stepin(self):
-        """Do a single stepin."""
-        self._client.dbg_continue('in', 1)
+    def step(self, count=1):
+        """Do count steps."""
+        return self._step('next', count)
+
+    def stepin(self, count=1):
+        """Do count stepin."""
+        return self._step('in', count)
+
+    def stepout(self, count=1):
+        """Do count stepout."""
+        return self._step('out', count)
+
+    def pop_pending_step(self):
+        """Send the pending steps, return False when there is none."""
+        with self.step_lock:
+            if len(self.pending_steps) == 0:
+                self.running = False
+                return False
+            action, count = self.pending_steps.pop(0)
+        self._client.dbg_continue(action, count)
         return True
 
-    def stepout(self):
-        """Do a single stepin."""
-        self._client.dbg_continue('out', 1)
-        return True
+    def cancel_pending_steps(self):
+        """Drop the pending steps, as the target stopped on its own."""
+        with self.step_lock:
+            self.pending_steps = []
+            self.running = False
+        return
 
     def backtrace(self):
         """Print a value."""
@@ -171,11 +318,61 @@ class NodeTarget(threading.Thread):
         self._client.dbg_backtrace()
         return True
 
-    def print(self, args):
-        """Print a value."""
+    def print(self, args, depth=None):
+        """Print a value.
+
+        When depth is given, the value is expanded up to depth levels in the
+        target and the whole structure is returned by one response.
+        """
         #if self.running:
         #    return False
-        self._client.dbg_evaluate(args)
+        if depth is None:
+            self._client.dbg_evaluate(args, self.frame_index)
+        else:
+            self._client.dbg_evaluate(serialize_expr(args, depth),
+                    self.frame_index, tag={'type': 'serialize'},
+                    maxStringLength=FULL_STRING_LENGTH)
+        return True
+
+    def more(self, remains):
+        """Print the next chunk of a truncated string."""
+        # 式を評価しなおさないように、文字列の handle から取得する.
+        expr = '__nodedbg_s.substring(%d, %d)' % (remains['next'],
+                remains['next'] + CHUNK_STRING_LENGTH)
+        context = [{'name': '__nodedbg_s', 'handle': remains['handle']}]
+        self._client.dbg_evaluate(expr, context=context,
+                tag={'type': 'more', 'remains': remains},
+                maxStringLength=CHUNK_STRING_LENGTH)
+        return True
+
+    def source(self, script_id):
+        """get the source of a script without local file."""
+        self._client.dbg_scripts([script_id], True, tag={'type': 'source'})
+        return True
+
+    def scripts_source(self, ids):
+        """get the source of the scripts for the symbols index."""
+        self._client.dbg_scripts(ids, True, tag={'type': 'symbols'})
+        return True
+
+    def watch(self, exprs):
+        """evaluate all the watch expressions at once."""
+        self._client.dbg_evaluate(watch_expr(exprs), self.frame_index,
+                tag={'type': 'watch', 'exprs': exprs},
+                maxStringLength=FULL_STRING_LENGTH)
+        return True
+
+    def balloon(self, expr, serial):
+        """evaluate an expression for the balloon."""
+        self._client.dbg_evaluate(expr, self.frame_index,
+                tag={'type': 'balloon', 'expr': expr, 'serial': serial,
+                    'gen': self.pause_gen})
+        return True
+
+    def drain_logpoints(self):
+        """get the records buffered by logpoints."""
+        self._client.dbg_evaluate(logpoint_drain_expr(), None,
+                tag={'type': 'logpoints'}, maxStringLength=FULL_STRING_LENGTH)
         return True
 
     def scripts(self):
@@ -183,18 +380,28 @@ class NodeTarget(threading.Thread):
         self._client.dbg_scripts()
         return True
 
-    def lookup(self, handles):
-        self._client.lookup(handles)
+    def lookup(self, handles, frame=None):
+        """get properties of objects shown in the frame's variables."""
+        if frame is None:
+            frame = self.frame_index
+        self._client.lookup(handles, tag={'type': 'lookup',
+            'gen': self.pause_gen, 'frame': frame, 'handles': handles})
         return True
 
-    def frame(self):
-        """get selected frame."""
-        self._client.dbg_frame()
+    def frame(self, number=None):
+        """get selected frame, or the frame number when given."""
+        if number is None:
+            number = self.frame_index
+        self._client.dbg_frame(number, tag={'type': 'frame',
+            'gen': self.pause_gen, 'frame': number})
         return True
 
-    def scope(self, scopeNumber):
-        """get scope on selected frame."""
-        self._client.dbg_scope(scopeNumber)
+    def scope(self, scopeNumber, frame=None):
+        """get scope on selected frame, or on the frame when given."""
+        if frame is None:
+            frame = self.frame_index
+        self._client.dbg_scope(scopeNumber, frame, tag={'type': 'scope',
+            'gen': self.pause_gen, 'frame': frame})
         return True
 
     def __repr__(self):
@@ -202,9 +409,70 @@ class NodeTarget(threading.Thread):
         return "Target: {'running': %s, 'closed': %s}" % (self.running,
                                                                 self.closed)
 
+    def stats(self):
+        """Return the protocol traffic statistics as text."""
+        client = self._client
+        stops = max(self.pause_gen, 1)
+        elapsed = max(time.time() - self.started, 0.001)
+        first_stop = '-'
+        if self.first_stop is not None:
+            first_stop = '%.3fs' % self.first_stop
+        latency = '-'
+        if client.latency() is not None:
+            latency = 'p50 %.1fms, p99 %.1fms, max %.1fms' % \
+                    tuple(t * 1000 for t in client.latency())
+        return ('requests: %d, messages: %d (%.1f/s), stops: %d\n'
+                'bytes in: %d (%d per stop), bytes out: %d (%d per stop)\n'
+                'latency: %s, discarded messages: %d\n'
+                'json codec: %s, first stop after: %s\n') % \
+                        (client.seq, self.messages, self.messages / elapsed,
+                        self.pause_gen,
+                        client.bytes_in, client.bytes_in // stops,
+                        client.bytes_out, client.bytes_out // stops,
+                        latency, client.discarded,
+                        json_codec.name, first_stop)
+
+    def profile_start(self, hz):
+        """Start sampling the stack hz times per second.
+
+        Return False when the sampling is deferred until the program is
+        continued, as it has not stopped nor run yet (--debug-brk).
+
+        """
+        self.sampler = StackSampler(hz)
+        return self.may_sample()
+
+    def may_sample(self):
+        """最初の停止を処理したか、ユーザーが continue したか.
+
+        --debug-brk の最初の停止前に suspend/continue すると、ユーザーが
+        操作する前にプログラムが動き出してしまう.
+        """
+        return self.first_stop is not None or self.running
+
+    def profile_stop(self):
+        """Stop sampling and return the sampler."""
+        sampler = self.sampler
+        self.sampler = None
+        return sampler
+
+    def tick(self):
+        """Called by the client loop, in this thread."""
+        sampler = self.sampler
+        if sampler is None:
+            return LOOP_TIMEOUT
+        now = time.time()
+        if not self.stopped and self.may_sample() and sampler.due(now):
+            # suspend して backtrace を取得し、そのレスポンスで continue する.
+            token = sampler.begin(now)
+            self._client.dbg_suspend(tag={'type': 'sample'})
+            self._client.dbg_backtrace(True, tag={'type': 'sample',
+                'sampler': sampler, 'token': token})
+        return min(LOOP_TIMEOUT, sampler.timeout(now))
+
     def run(self):
         """Run the target."""
-        self._client.loop()
+        self._client.loop(self.tick)
 
         item = {}
         item['type'] = 'close'
@@ -212,25 +480,83 @@ class NodeTarget(threading.Thread):
 
         self.running = False
 
+    def new_pause(self):
+        """新しく停止したので、以前の停止時の item を破棄させる."""
+        self.stopped = True
+        if self.first_stop is None:
+            self.first_stop = time.time() - self.started
+        self.pause_gen = self.pause_gen + 1
+        self.frame_index = 0
+        self.bp_que.set_gen(self.pause_gen)
+        return
+
+    def is_sample_pause(self, body):
+        """サンプリングのための suspend による停止か.
+
+        そうであれば、サンプリング中なら backtrace のレスポンスで、
+        取り消されていればここで continue する. ブレイクポイントなどによる
+        停止のときは、応答を待っているサンプリングを取り消し、
+        その backtrace のレスポンスで continue しないようにする.
+        (suspend での停止を break イベントで通知するのは inspector のみ).
+        """
+        sample = body.get('suspend', False) and \
+                not body.get('breakpoints') and \
+                body.get('reason', 'other') == 'other'
+        sampler = self.sampler
+        if sample:
+            if sampler is None or not sampler.busy:
+                # 取り消されたサンプリングの停止(suspend はサンプリングでのみ
+                # 送信する).
+                self._client.dbg_continue()
+            return True
+        if sampler is not None:
+            sampler.abort()
+        return False
+
+    def handle_message(self, data):
+        """client から受け取ったメッセージを、計測中は計測しながら処理する."""
+        profiler = self.pyprofiler
+        if profiler is None:
+            self.handle_resp(data)
+        else:
+            profiler.runcall(self.handle_resp, data)
+        return
+
     def handle_resp(self, data):
         """client(node.js の debugger) からのレスポンスを処理する.
 
         """
+        self.messages = self.messages + 1
         try:
             if data['type'] == 'event':
                 if data['event'] == 'break':
+                    if self.is_sample_pause(data['body']):
+                        return
+                    if data['body'].get('breakpoints'):
+                        # ブレイクポイントで停止したときは、残りのステップ
+                        # 実行は取り消してその位置で止まる.
+                        self.cancel_pending_steps()
+                    elif self.pop_pending_step():
+                        # 途中の停止なので、変数一覧などは更新しない.
+                        return
                     item = {}
                     item['type'] = 'break'
-                    item['name'] = data['body']['script']['name'] 
+                    item['name'] = data['body']['script'].get('name')
+                    item['script_id'] = data['body']['script']['id']
                     item['lnum'] =data['body']['sourceLine'] + 1 
-                    self.running = False
+                    self.new_pause()
                     self.bp_que.put(item)
                 if data['event'] == 'exception':
+                    if self.sampler is not None:
+                        self.sampler.abort()
                     item = {}
                     item['type'] = 'break'
-                    item['name'] = data['body']['script']['name'] 
+                    item['name'] = data['body']['script'].get('name')
+                    item['script_id'] = data['body']['script']['id']
                     item['lnum'] =data['body']['sourceLine'] + 1 
-                    self.running = False
+                    # 例外で停止したときは、残りのステップ実行は取り消す.
+                    self.cancel_pending_steps()
+                    self.new_pause()
                     self.bp_que.put(item)
                     item = {}
                     item['type'] = 'print'
@@ -238,22 +564,60 @@ class NodeTarget(threading.Thread):
                     self.bp_que.put(item)
 
             elif data['type'] == 'response':
+                tag = self._client.pop_tag(data)
+                if tag is None:
+                    tag = {'type': None}
                 if data['command'] == 'disconnect':
                     item = {}
                     item['type'] = 'close'
                     self.bp_que.put(item)
+                elif data['command'] == 'setbreakpoint' and \
+                        not data['success']:
+                    # 関数が見つからないときなど.
+                    self.bp_dict.pop(tag.get('key'), None)
+                    item = {}
+                    item['type'] = 'print'
+                    item['text'] = 'Cannot set breakpoint: %s' % \
+                            data.get('message')
+                    self.bp_que.put(item)
                 elif data['command'] == 'setbreakpoint':
                     item = {}
                     item['type'] = 'setbreakpoint'
-                    name = data['body']['script_name']
-                    lnum = data['body']['actual_locations'][0]['line'] + 1 
+                    # function のブレイクポイントでは script_name がなく、
+                    # スクリプトは script_id で受け取る.
+                    name = data['body'].get('script_name')
+                    locations = data['body']['actual_locations']
+                    if len(locations) > 0:
+                        lnum = locations[0]['line'] + 1 
+                        if name is None:
+                            item['script_id'] = locations[0].get('script_id')
+                    else:
+                        # まだロードされていないスクリプトなど.
+                        lnum = tag.get('lnum')
                     bp_id = data['body']['breakpoint']
                     item['name'] = name
                     item['lnum'] = lnum
                     item['bp_id'] = bp_id
+                    if tag['type'] == 'setbreakpoint':
+                        item['condition'] = tag['condition']
+                        item['log'] = tag['log']
+                        item['enabled'] = tag['enabled']
+                        if tag['lnum'] is not None:
+                            item['req_lnum'] = tag['lnum']
+                        if 'func' in tag:
+                            item['func'] = tag['func']
                     self.bp_que.put(item)
-                    # target 側でもid を保持しておく.
-                    self.bp_dict[name + ':' + str(lnum)] = bp_id
+                    if name is not None:
+                        # target 側でもid を保持しておく.
+                        self.bp_dict[name + ':' + str(lnum)] = bp_id
+                elif data['command'] == 'backtrace' and \
+                        tag['type'] == 'sample':
+                    if data['success']:
+                        frames = data['body'].get('frames', [])
+                    else:
+                        frames = []
+                    if tag['sampler'].add(frames, time.time(), tag['token']):
+                        self._client.dbg_continue()
                 elif data['command'] == 'backtrace':
                     print(data['body']['frames'][0])
                     item = {}
@@ -262,20 +626,82 @@ class NodeTarget(threading.Thread):
                     for i in data['body']['frames']:
                         item['text'] = item['text'] + i['text'] + '\n'
                     self.bp_que.put(item)
+                elif data['command'] == 'evaluate' and tag['type'] == 'logpoints':
+                    item = {}
+                    item['type'] = 'logpoints'
+                    item['records'], item['dropped'] = logpoint_records(data)
+                    if len(item['records']) > 0 or item['dropped'] > 0:
+                        self.bp_que.put(item)
+                elif data['command'] == 'evaluate' and tag['type'] == 'watch':
+                    item = {}
+                    item['type'] = 'watch'
+                    item['exprs'] = tag['exprs']
+                    item['values'] = watch_values(data)
+                    self.bp_que.put(item)
+                elif data['command'] == 'evaluate' and tag['type'] == 'more':
+                    item = {}
+                    item['type'] = 'print'
+                    if data['success']:
+                        remains = dict(tag['remains'])
+                        item['text'] = data['body']['value']
+                        remains['next'] = remains['next'] + len(item['text'])
+                        if remains['next'] < remains['total']:
+                            item['remains'] = remains
+                    else:
+                        item['text'] = data['message']
+                    self.bp_que.put(item)
+                elif data['command'] == 'evaluate' and \
+                        tag['type'] == 'serialize':
+                    item = {}
+                    item['type'] = 'print'
+                    if data['success']:
+                        item['text'] = serialized_to_print(data)
+                    else:
+                        item['text'] = data['message']
+                    self.bp_que.put(item)
+                elif data['command'] == 'evaluate' and \
+                        tag['type'] == 'balloon':
+                    item = {}
+                    item['type'] = 'balloon'
+                    item['expr'] = tag['expr']
+                    item['serial'] = tag['serial']
+                    item['gen'] = tag['gen']
+                    if data['success']:
+                        item['text'] = obj_to_print(data)
+                    else:
+                        item['text'] = data['message']
+                    self.bp_que.put(item)
                 elif data['command'] == 'evaluate':
                     item = {}
                     item['type'] = 'print'
                     if data['success']:
                         item['text'] = obj_to_print(data)
+                        remains = string_remains(data['body'])
+                        if remains is not None:
+                            item['remains'] = remains
                     else:
                         item['text'] = data['message']
                     self.bp_que.put(item)
+                elif data['command'] == 'scripts' and tag['type'] == 'source':
+                    if data['success'] and len(data['body']) > 0:
+                        item = {}
+                        item['type'] = 'source'
+                        item['script_id'] = data['body'][0]['id']
+                        item['name'] = data['body'][0].get('name')
+                        item['source'] = data['body'][0]['source']
+                        self.bp_que.put(item)
+                elif data['command'] == 'scripts' and tag['type'] == 'symbols':
+                    item = {}
+                    item['type'] = 'symbols'
+                    item['body'] = data['body']
+                    self.bp_que.put(item)
                 elif data['command'] == 'scripts':
                     item = {}
                     item['type'] = 'scripts'
                     item['body'] = data['body']
                     self.bp_que.put(item)
                 elif data['command'] == 'lookup':
+                    found = set()
                     if data['success']:
                         for body in data['body']:
                             item = {}
@@ -283,20 +709,43 @@ class NodeTarget(threading.Thread):
                             item['handle'] =data['body'][body]['handle']
                             item['properties'] = obj_to_properties(data,
                                     data['body'][body], item['handle'])
+                            if 'gen' in tag:
+                                item['gen'] = tag['gen']
+                            item['frame'] = tag.get('frame', 0)
                             self.bp_que.put(item)
+                            found.add(item['handle'])
+                    # 失敗したときやボディにないものは、取得できなかった
+                    # ことを伝える(Cfindvar が待ち続けないように).
+                    missing = [h for h in tag.get('handles', ())
+                            if h not in found]
+                    if len(missing):
+                        item = {}
+                        item['type'] = 'lookup_failed'
+                        item['handles'] = missing
+                        if 'gen' in tag:
+                            item['gen'] = tag['gen']
+                        item['frame'] = tag.get('frame', 0)
+                        self.bp_que.put(item)
                 elif data['command'] == 'frame':
                     item = {}
                     item['type'] = 'frame'
+                    if 'gen' in tag:
+                        item['gen'] = tag['gen']
+                    item['frame'] = tag.get('frame', 0)
                     if data['success']:
                         item['scopes'] = data['body']['scopes']
+                        item['name'], item['lnum'] = frame_location(data)
                         self.bp_que.put(item)
                         for scope in data['body']['scopes']:
-                            self.scope(scope['index'])
+                            self.scope(scope['index'], item['frame'])
                     else:
                         self.bp_que.put(item)
                 elif data['command'] == 'scope':
                     item = {}
                     item['type'] = 'scope'
+                    if 'gen' in tag:
+                        item['gen'] = tag['gen']
+                    item['frame'] = tag.get('frame', 0)
                     if data['success']:
                         item['body'] = data['body']
                     self.bp_que.put(item)
@@ -321,6 +770,138 @@ class NodeVar:
 
         self.prev_scopes = []
 
+        self.watches = []
+
+        # 変数名のインデックス(変数一覧が変更されたときは None にする).
+        self.name_index = None
+
+        # 停止ごとの変数のスナップショット(古い順).
+        self.history = collections.deque(maxlen=VARHISTORY_SIZE)
+
+    def add_watch(self, expr):
+        self.watches.append({'expr': expr, 'value': None, 'prev': None})
+        self.dirty = True
+        return
+
+    def del_watch(self, num):
+        """ 番号(1 から)で指定された watch を削除."""
+        ret = False
+        if 0 < num <= len(self.watches):
+            del self.watches[num - 1]
+            self.dirty = True
+            ret = True
+        return ret
+
+    def get_watch_exprs(self):
+        return [w['expr'] for w in self.watches]
+
+    def set_watch_values(self, exprs, values):
+        """ まとめて評価した watch の値をセットする.
+
+        評価中に watch が追加、削除されていることもあるので、式で対応させる.
+        """
+        if values is None:
+            values = ['<error>'] * len(exprs)
+        value_dict = dict(zip(exprs, values))
+        for w in self.watches:
+            if w['expr'] in value_dict:
+                w['prev'] = w['value']
+                w['value'] = value_dict[w['expr']]
+        self.dirty = True
+        return
+
+    def watch_str(self):
+        varstr = ''
+
+        if len(self.watches):
+            varstr = '%s %s\n' % (self.get_tgl_lbl({}), 'Watch')
+            num = 1
+            for w in self.watches:
+                hilite = '='
+                if w['value'] != w['prev']:
+                    hilite = '*'
+                value = w['value']
+                if value is None:
+                    value = ''
+                varstr += ' ' + '%s %d: %s ={%s} %s\n' % \
+                        (self.get_tgl_lbl({}), num, w['expr'], hilite, value)
+                num = num + 1
+
+        return varstr
+
+    def snapshot_properties(self, properties, prev):
+        """ properties のスナップショット.
+
+        変数ごとに (値の表示, 子のスナップショットまたは None) とし、
+        前回のスナップショット prev と変わらない部分は prev のものを共有する.
+        """
+        ret = OrderedDict()
+        same = prev is not None and len(prev) == len(properties)
+        for name in properties:
+            var = properties[name]
+            prev_node = None
+            if prev is not None:
+                prev_node = prev.get(name)
+            children = None
+            if len(var.get('properties', ())):
+                children = self.snapshot_properties(var['properties'],
+                        prev_node[1] if prev_node is not None else None)
+            node = (self.get_value_lbl(var), children)
+            if prev_node is not None and prev_node[0] == node[0] and \
+                    prev_node[1] is children:
+                node = prev_node
+            else:
+                same = False
+            ret[name] = node
+        if same:
+            return prev
+        return ret
+
+    def snapshot(self):
+        """ 現在の変数一覧のスナップショット((scope 名, properties) の
+        タプル)."""
+        prev = None
+        if len(self.history):
+            prev = dict(self.history[-1][1])
+        scopes = []
+        for scope in self.scopes:
+            if isinstance(scope, dict) and not scope['standby']:
+                scopes.append((scope['lbl'], self.snapshot_properties(
+                    scope['properties'],
+                    prev.get(scope['lbl']) if prev is not None else None)))
+        return tuple(scopes)
+
+    def push_history(self, label):
+        """ 停止位置 label での変数一覧を履歴へ追加する."""
+        if len(self.scopes):
+            self.history.append((label, self.snapshot()))
+        return
+
+    def set_history_size(self, size):
+        self.history = collections.deque(self.history, maxlen=size)
+        return
+
+    def var_history(self, names):
+        """ 変数(names はプロパティの名前のリスト)の履歴を
+        (停止位置, 値の表示) のリストで返す. 見つからないときの値は None.
+        最後は現在の値."""
+        ret = []
+        for label, scopes in list(self.history) + [(None, self.snapshot())]:
+            value = None
+            for lbl, props in scopes:
+                node = None
+                for name in names:
+                    if props is None or name not in props:
+                        node = None
+                        break
+                    node = props[name]
+                    props = node[1]
+                if node is not None:
+                    value = node[0]
+                    break
+            ret.append((label, value))
+        return ret
+
     def scopes_equal(self, scopes):
         """ 指定された scopes が、保持している scopes と同じか?
         ただし、ここでは厳密には区別できない(する方法が不明)ので、
@@ -364,6 +945,11 @@ class NodeVar:
                 expanded = True
             elif scope['type'] == 4:
                 lbl = 'Catch'
+            elif scope['type'] == 5:
+                lbl = 'Block'
+                expanded = True
+            elif scope['type'] == 6:
+                lbl = 'Script'
             item = {
                     'type': scope['type'],
                     'lbl': lbl,
@@ -380,6 +966,7 @@ class NodeVar:
                 scope['expanded'] = self.prev_scopes[index]['expanded']
                 index = index + 1
 
+        self.name_index = None
         self.dirty = True
 
         return
@@ -400,6 +987,13 @@ class NodeVar:
             if not ('value' in prop['value']):
                 item['expanded'] = False
                 item['properties'] = []
+                if 'preview' in prop['value']:
+                    # generatePreview でわかっている一階層目の子の値.
+                    # lookup するまでの仮のもの.
+                    item['properties'] = OrderedDict()
+                    item['preview'] = True
+                    self.move_properties_array_to_ordered_dict(
+                            prop['value']['preview'], item['properties'])
             item['value'] = prop['value']
 
             dict_p[item['name']] = item
@@ -451,6 +1045,7 @@ class NodeVar:
 
         self.scopes[index]['standby'] = False;
 
+        self.name_index = None
         self.dirty = True
 
         return
@@ -489,6 +1084,7 @@ class NodeVar:
                 self.scope_lookup[handle]['name']
                 )
         tgt['properties'] = OrderedDict()
+        tgt.pop('preview', None)
 
         self.move_properties_array_to_ordered_dict(properties, \
                 tgt['properties']
@@ -509,6 +1105,7 @@ class NodeVar:
                         tgt['properties'][prop]['expanded'] = \
                             prev_tgt['properties'][prop]['expanded']
 
+        self.name_index = None
         self.dirty = True
 
         return
@@ -600,6 +1197,9 @@ class NodeVar:
                                     )
             index = index + 1
 
+        # watch は foldvar の行番号に影響しないように末尾に表示する.
+        varstr = varstr + self.watch_str()
+
         self.dirty = False
 
         return varstr
@@ -643,9 +1243,8 @@ class NodeVar:
 
         return lines
 
-    def foldvar(self, lnum):
-        ret = -1
-
+    def get_lines(self):
+        """ 変数一覧の行ごとの情報(scope の行は root を持つ)."""
         lines = []
         index = 0
 
@@ -660,6 +1259,105 @@ class NodeVar:
                 lines.extend(self.get_properties_lines(index, scope['properties'], []))
             index = index + 1
 
+        return lines
+
+    def walk(self):
+        """ 取得済の変数を浅い順に (index, names, item) で列挙する."""
+        que = collections.deque()
+        for index, scope in enumerate(self.scopes):
+            if isinstance(scope, dict):
+                que.append((index, [], scope))
+        while que:
+            index, names, parent = que.popleft()
+            for name, var in parent.get('properties', {}).items():
+                yield index, names + [name], var
+                if len(var.get('properties', ())):
+                    que.append((index, names + [name], var))
+        return
+
+    def get_name_index(self):
+        """ 変数名から (index, names) の一覧を引くインデックス.
+
+        変数一覧が変更されるまではキャッシュしておく.
+        """
+        if self.name_index is None:
+            self.name_index = {}
+            for index, names, var in self.walk():
+                self.name_index.setdefault(names[-1], []).append(
+                        (index, names))
+        return self.name_index
+
+    def find(self, pattern):
+        """ 名前が pattern(正規表現)にマッチする変数の (index, names)."""
+        ret = []
+        for name, paths in self.get_name_index().items():
+            if pattern.search(str(name)):
+                ret.extend(paths)
+        ret.sort(key=lambda p: (len(p[1]), p))
+        return ret
+
+    def get_unfetched(self, limit, exclude=(), everything=False):
+        """ まだ lookup していないオブジェクトを浅い順に limit 個まで取得し、
+        lookup の結果をセットできるように登録する.
+
+        exclude は lookup 済(プロパティがなかったもの)の handle.
+        everything でないときは、閉じている scope(Global など)の変数と
+        関数(prototype などの内部のプロパティしかない)は lookup しない.
+        """
+        ret = []
+        exclude = set(exclude)
+        for index, names, var in self.walk():
+            if len(ret) >= limit:
+                break
+            if not everything and (not self.scopes[index]['expanded'] or \
+                    var['value'].get('type') == 'function'):
+                continue
+            if 'expanded' in var and \
+                    (len(var['properties']) == 0 or 'preview' in var) and \
+                    'ref' in var['value'] and \
+                    var['value']['ref'] not in exclude:
+                ref = var['value']['ref']
+                self.scope_lookup[ref] = {'index': index, 'name': names}
+                ret.append(ref)
+        return ret
+
+    def forget_lookup(self, handles):
+        """ 展開されていないものは、停止するたびに lookup しなおさないように
+        登録を削除する."""
+        for handle in handles:
+            if handle in self.scope_lookup:
+                tgt = self.get_tgt_item_from_names(
+                        self.scope_lookup[handle]['index'],
+                        self.scope_lookup[handle]['name'])
+                if not tgt.get('expanded'):
+                    del self.scope_lookup[handle]
+        return
+
+    def expand_path(self, index, names):
+        """ 変数が表示されるように scope と親を展開し、その行番号を返す."""
+        self.scopes[index]['expanded'] = True
+        for i in range(1, len(names)):
+            tgt = self.get_tgt_item_from_names(index, names[:i])
+            if 'expanded' in tgt:
+                tgt['expanded'] = True
+        self.dirty = True
+
+        lnum = 1
+        for line in self.get_lines():
+            if line['index'] == index and line.get('name') == names:
+                return lnum
+            lnum = lnum + 1
+        return None
+
+    def foldvar(self, lnum):
+        ret = -1
+
+        lines = self.get_lines()
+
+        if lnum > len(lines):
+            # watch の行など.
+            return ret
+
         line = lines[lnum-1]
         if 'root' in line:
             self.scopes[line['index']]['expanded'] = \
@@ -693,18 +1391,70 @@ class NodeDbg(debugger.Debugger):
         self._bp_resp = {}
         self._bpgo_que =queue.Queue() 
         self._scripts = Scripts()
+        self._symbols = None
+        self._sources = SourceCache()
+        self._sourcemaps = SourceMaps()
+        # 切り詰めて表示した文字列の続き.
+        self._remains = None
+        # balloon の評価. serial は最新の要求のみ表示するのに使い、
+        # 評価結果は停止している間(pause_gen が同じ間)キャッシュする.
+        self._balloon_serial = 0
+        self._balloon_pending = None
+        self._balloon_inflight = None
+        self._balloon_cache = (None, {})
+        # Cpyprofile で計測中のときの PyProfiler.
+        self._pyprofiler = None
+        # 実行中の Cfindvar/N と、変数一覧で移動する行.
+        self._findvar = None
+        self._findvar_lnum = None
         self.inferior = None
 
         self.varobj = NodeVar()
+        # 選択している frame と、frame ごとの変数一覧.
+        # 変数一覧は停止している間キャッシュし(_frame_fresh が取得済の frame)、
+        # 次の停止でも展開の状態を引き継ぐために残しておく.
+        self._frame = 0
+        self._frame_prev = 0
+        self._frame_vars = {0: self.varobj}
+        self._frame_fresh = set()
+        self._frame_pos = {}
 
     def start(self):
         """Start the debugger."""
         self.console_print('\n')
         self.print_prompt()
 
+        if bps.journal is None:
+            # 前回のセッションのブレイクポイントを standby で復元し、
+            # 次の scripts のレスポンスでまとめて target へ設定する.
+            journal = BreakPointJournal(journal_path(os.getcwd()))
+            for bp in bps.open_journal(journal):
+                self.bp_id += 1
+                bps.add_standby(self.bp_id, bp['name'], bp['lnum'],
+                        bp['condition'], bp['log'])
+                if not bp['enabled']:
+                    bps.set_enabled(self.bp_id, False)
+            bps.set_journal(journal)
+
         # start the node.js debuggee
         if self.inferior is None:
-            self.inferior = NodeTarget(self.options.daemon)
+            # 引数があるときは、そのスクリプトを node で起動する
+            # (先頭が --inspect のときは inspector を使う. --inspect のみの
+            # ときは起動せずに inspector のポートへ接続する).
+            launch = shlex.split(self.options.args or '')
+            inspector = len(launch) > 0 and launch[0] == '--inspect'
+            if inspector:
+                launch = launch[1:]
+            port = INSPECTOR_PORT if inspector else DEBUG_PORT
+            try:
+                self.inferior = NodeTarget(self.options.daemon, port=port,
+                        inspector=inspector, launch=launch)
+            except OSError as e:
+                # node がない、スクリプトを実行できないなど.
+                self.console_print('Cannot start node: %s\n' % e)
+                self.print_prompt()
+                return
+            self.inferior.pyprofiler = self._pyprofiler
             self.inferior.start()
             self.inferior.scripts()
             self.timer(self.myjob, debugger.LOOP_TIMEOUT)
@@ -717,6 +1467,7 @@ class NodeDbg(debugger.Debugger):
         if self.inferior is not None:
             self.inferior.close()
             self.inferior = None
+        self._sources.close()
 
     def remove_all(self):
         debugger.Debugger.remove_all(self)
@@ -733,77 +1484,249 @@ class NodeDbg(debugger.Debugger):
         """
         self.inferior.frame();
         if show:
-            script_name = self._bp_resp['name']
-            if script_name is not None:
-                if os.path.isabs(script_name):
-                    self.show_frame(self._bp_resp['name'], \
-                            self._bp_resp['lnum'])
-                else:
-                    self.console_print('Break in '+ script_name +'.\n')
+            self.show_position(self._bp_resp['name'], self._bp_resp['lnum'],
+                    self._bp_resp['script_id'])
         else:
             # hide frame
             self.show_frame()
 
+    def show_position(self, script_name, lnum, script_id=None):
+        """Show the frame sign at lnum of the script."""
+        if script_name is not None and os.path.isabs(script_name):
+            # source map があれば元のソースの位置を表示.
+            self.show_frame(*self._sourcemaps.to_original(script_name, lnum))
+        elif script_id is not None:
+            # ローカルにファイルがないので、取得したソースを表示する.
+            path = self._sources.get(script_id)
+            if path is not None:
+                self.show_frame(path, lnum)
+            else:
+                self.inferior.source(script_id)
+
+    def frame_var(self, frame):
+        """Return the variables of the frame (created when missing)."""
+        var = self._frame_vars.get(frame)
+        if var is None:
+            var = NodeVar()
+            # watch はどの frame でも同じものを表示する.
+            var.watches = self._frame_vars[0].watches
+            self._frame_vars[frame] = var
+        return var
+
+    def select_frame(self, number):
+        """Select the frame number for the variables buffer and Cprint."""
+        if self.inferior is None or not self.inferior.stopped:
+            self.console_print('The program is not stopped.\n')
+            self.print_prompt()
+            return
+        if number < 0:
+            self.console_print('Bottom (innermost) frame selected; '
+                    'you cannot go down.\n')
+            self.print_prompt()
+            return
+        self._frame_prev = self._frame
+        self._frame = number
+        self.inferior.frame_index = number
+        self.varobj = self.frame_var(number)
+        if self._findvar is not None:
+            self._findvar = None
+            self.console_print('Cfindvar cancelled.\n')
+        if len(self.varobj.watches):
+            self.inferior.watch(self.varobj.get_watch_exprs())
+        if number in self._frame_fresh:
+            # この停止中に取得済なので、キャッシュから表示する.
+            self.show_selected_frame()
+            self.update_dbgvarbuf(self.varobj.__str__, True)
+        else:
+            self._frame_fresh.add(number)
+            self.inferior.frame(number)
+
+    def show_selected_frame(self):
+        """Print and show the position of the selected frame."""
+        if self._frame == 0:
+            name, lnum = self._bp_resp['name'], self._bp_resp['lnum']
+            self.show_position(name, lnum, self._bp_resp['script_id'])
+        else:
+            name, lnum = self._frame_pos[self._frame]
+            self.show_position(name, lnum)
+        self.console_print('#%d %s:%s\n' % (self._frame, name, lnum))
+        self.print_prompt()
+
     def myjob(self):
+        """Process the queued items, profiled when Cpyprofile is running."""
+        if self._pyprofiler is None:
+            self.update_job()
+        else:
+            self._pyprofiler.runcall(self.update_job)
+
+    def update_job(self):
+        # 変数一覧の更新は、まとめて取り出した item を処理し終えてから一度だけ.
+        render = False
         if self.inferior is not None:
+            output = self.inferior.output()
+            if output:
+                self.console_print(output)
             bp_que = self.inferior.bp_que
-            while not bp_que.empty():
-                item = bp_que.get()
+            for item in bp_que.drain():
                 if item['type'] == 'close':
                     self.console_print('Node.js debugger connection closed.\n')
                     self.print_prompt()
                     self.move_frame(False)
                     self.inferior = None
+                    self._frame = 0
+                    self.varobj = self._frame_vars[0]
                     bps.standby_all()
+                    if self._symbols is not None:
+                        self._symbols.reset()
+                    self._sources.reset()
                     self.remove_all()
                     self.closed = True
+                    break
                 elif item['type'] == 'setbreakpoint':
-                    self.add_bp(item['bp_id'], item['name'], item['lnum'])
-                    bps.add(item['bp_id'], item['name'], str(item['lnum']))
-                    self.console_print('Breakpoint %d at file %s, line %d.\n' % \
-                            (item['bp_id'], item['name'], item['lnum']))
+                    if item['name'] is None:
+                        # function のブレイクポイントは script id から.
+                        item['name'] = self._scripts.name_of(
+                                item.get('script_id'))
+                        if item['name'] is None:
+                            # スクリプトが不明なので、アノテーションは省略.
+                            self.console_print(
+                                    'Breakpoint %d at function %s.\n' % \
+                                    (item['bp_id'], item.get('func')))
+                            continue
+                        self.inferior.register_bp(item['name'], item['lnum'],
+                                item['bp_id'])
+                    # bps は生成されたスクリプトの位置、
+                    # アノテーションは元のソースの位置で管理する.
+                    name, lnum = self._sourcemaps.to_original(item['name'],
+                            item['lnum'])
+                    self.add_bp(item['bp_id'], name, lnum)
+                    bps.add(item['bp_id'], item['name'], str(item['lnum']),
+                            item.get('condition'), item.get('log'))
+                    if 'req_lnum' in item:
+                        bps.relocate(item['name'], item['req_lnum'],
+                                item['lnum'])
+                    if 'func' in item:
+                        bps.save(item['name'], str(item['lnum']))
+                    if not item.get('enabled', True):
+                        self.update_bp(item['bp_id'], True)
+                    kind = 'Breakpoint'
+                    if item.get('log') is not None:
+                        kind = 'Logpoint'
+                    self.console_print('%s %d at file %s, line %d.\n' % \
+                            (kind, item['bp_id'], name, lnum))
+                elif item['type'] == 'logpoints':
+                    # まとめて取り出した記録は、まとめて表示する.
+                    text = '\n'.join(item['records'])
+                    if item['dropped'] > 0:
+                        text = text + '\n(%d logpoint records dropped)' % \
+                                item['dropped']
+                    self.console_print(text.lstrip('\n') + '\n')
                 elif item['type'] == 'break':
+                    # 停止位置が変わったので、frame の選択とキャッシュを戻す.
+                    self._frame = 0
+                    self._frame_fresh = set([0])
+                    self._frame_pos = {}
+                    self.varobj = self._frame_vars[0]
+                    if self._bp_resp.get('name') is not None:
+                        # 前回の停止位置での変数一覧を履歴に残す.
+                        self.varobj.push_history('%s:%s' % (
+                            os.path.basename(self._bp_resp['name']),
+                            self._bp_resp['lnum']))
                     self._bp_resp = item
                     self.move_frame(True)
+                    if self._findvar is not None:
+                        # 停止位置が変わったので中止.
+                        self._findvar = None
+                        self.console_print('Cfindvar cancelled.\n')
+                    if len(self.varobj.watches):
+                        self.inferior.watch(self.varobj.get_watch_exprs())
+                elif item['type'] == 'watch':
+                    self.varobj.set_watch_values(item['exprs'], item['values'])
+                    render = True
+                elif item['type'] == 'balloon':
+                    self._balloon_inflight = None
+                    self.balloon_cache()[item['expr']] = item['text']
+                    if item['serial'] == self._balloon_serial:
+                        self.show_balloon('%s = %s' % (item['expr'],
+                            item['text']))
+                    elif self._balloon_pending is not None:
+                        # 評価中に要求されていた最新のものを評価.
+                        self.balloon_fire(*self._balloon_pending)
                 elif item['type'] == 'print':
                     self.console_print(item['text'] + '\n')
+                    self._remains = item.get('remains')
+                    if self._remains is not None:
+                        self.console_print('... (%d of %d characters, '
+                                'Cmore to continue)\n' % \
+                                (self._remains['next'], self._remains['total']))
                     self.print_prompt()
                 elif item['type'] == 'properties':
-                    self.varobj.set_properties_from_handle(item['handle'], item['properties'])
-                    if self.varobj.is_standby() == False:
-                        self.update_dbgvarbuf(self.varobj.__str__,
-                                self.varobj.dirty)
+                    frame = item.get('frame', 0)
+                    self.frame_var(frame).set_properties_from_handle(
+                            item['handle'], item['properties'])
+                    if frame == self._frame:
+                        render = True
+                        if self._findvar is not None:
+                            self.findvar_next([item['handle']])
+                elif item['type'] == 'lookup_failed':
+                    if self._findvar is not None and \
+                            item.get('frame', 0) == self._frame:
+                        self._findvar['failed'] += len(item['handles'])
+                        self.findvar_next(item['handles'])
                 elif item['type'] == 'frame':
+                    frame = item.get('frame', 0)
                     if 'scopes' in item:
-                        self.varobj.set_scopes(item['scopes'])
+                        self.frame_var(frame).set_scopes(item['scopes'])
+                        self._frame_pos[frame] = (item['name'], item['lnum'])
+                        if frame == self._frame and frame > 0:
+                            self.show_selected_frame()
+                    elif frame > 0:
+                        # 選択された frame が存在しないので、選択を戻す.
+                        self._frame_fresh.discard(frame)
+                        if frame == self._frame:
+                            self.console_print('No frame %d.\n' % frame)
+                            self.select_frame(self._frame_prev)
                     else:
                         # FIXME: frame が存在しない'No framse)というエラーの対応.
                         # エラーが発生しないようにできないか?
-                        self.inferior.frame();
+                        self.inferior.frame(0);
                 elif item['type'] == 'scope':
+                    frame = item.get('frame', 0)
+                    var = self.frame_var(frame)
                     if 'body' in item:
-                        self.varobj.set_scope_props(item['body']['index'], \
+                        var.set_scope_props(item['body']['index'], \
                             item['body']['object']['properties']);
-                        if self.varobj.is_standby() == False:
-                            handles = self.varobj.get_lookup_list()
-                            self.inferior.lookup(handles)
-                            self.update_dbgvarbuf(self.varobj.__str__,
-                                    self.varobj.dirty)
+                        if var.is_standby() == False:
+                            handles = var.get_lookup_list()
+                            self.inferior.lookup(handles, frame)
+                            if frame == self._frame:
+                                render = True
                     else:
                         # FIXME: scope が存在しないというエラー対応.
                         # frame コマンドから取得した scope なので存在しないとい
                         # うことはないと思うのだが、タイミング依存でなにかあるの
                         # か?
-                        self.varobj.restore_prev_scopes()
-                        self.inferior.frame();
+                        var.restore_prev_scopes()
+                        self.inferior.frame(frame);
 
                 elif item['type'] == 'scripts':
-                    self._scripts.set_scripts(item['body'])
+                    added = self._scripts.set_scripts(item['body'])
+                    if self._sourcemaps.add_scripts(added):
+                        # 元のソースへ設定していたものを、新しく source map
+                        # のわかったスクリプトの位置へ移す.
+                        bps.map_standby(self._sourcemaps.to_generated)
+                    if self._symbols is not None:
+                        # 新しくロードされたスクリプトのみインデックスへ追加.
+                        ids = self._symbols.new_ids(self._scripts.ids())
+                        if len(ids) > 0:
+                            self.inferior.scripts_source(ids)
                     bplist = bps.get_standby_bps(self._scripts)
                     if len(bplist) > 0:
                         for bp in bplist:
                             bps.clear_standby(bp['name'], bp['lnum'])
-                            self.inferior.add_bp(bp['bp_id'], bp['name'], bp['lnum'])
+                            self.inferior.add_bp(bp['bp_id'], bp['name'],
+                                    bp['lnum'], bp['condition'], bp['log'],
+                                    bp['enabled'])
                     else:
                         while not self._bpgo_que.empty():
                             fn = self._bpgo_que.get()
@@ -811,12 +1734,72 @@ class NodeDbg(debugger.Debugger):
                             self._bpgo_que.task_done()
 
 
-                bp_que.task_done()
+                elif item['type'] == 'source':
+                    path = self._sources.add(item['script_id'], item['name'],
+                            item['source'])
+                    # ソースの取得中に移動していなければ表示.
+                    if self._bp_resp.get('script_id') == item['script_id']:
+                        self.show_frame(path, self._bp_resp['lnum'])
+                elif item['type'] == 'symbols':
+                    count = 0
+                    for script in item['body']:
+                        if 'name' in script and 'source' in script:
+                            count = count + self._symbols.add_script(
+                                    script['name'], script['source'])
+                    debug('%d symbols indexed.', count)
+
+        if self._findvar_lnum is not None:
+            self.update_dbgvarbuf(self.varobj.__str__, True,
+                    self._findvar_lnum)
+            self._findvar_lnum = None
+        elif render and self.varobj.is_standby() == False:
+            self.update_dbgvarbuf(self.varobj.__str__, self.varobj.dirty)
 
         if self.closed == False:
             self.inferior.scripts()
+            if bps.has_logpoints():
+                self.inferior.drain_logpoints()
             self.timer(self.myjob, debugger.LOOP_TIMEOUT + 0.1)
 
+    def balloon_cache(self):
+        """Return the balloon cache of the current stop and frame."""
+        gen = (self.inferior.pause_gen, self._frame)
+        if self._balloon_cache[0] != gen:
+            self._balloon_cache = (gen, {})
+        return self._balloon_cache[1]
+
+    def balloon_text(self, text):
+        """Evaluate the expression under the mouse for the balloon.
+
+        The evaluation is delayed until the mouse has rested for
+        BALLOON_DELAY seconds, and only the latest request is evaluated.
+
+        """
+        expr = text.strip()
+        if self.inferior is None or not self.inferior.stopped or \
+                BALLOON_EXPR.match(expr) is None:
+            return
+        self._balloon_serial += 1
+        cache = self.balloon_cache()
+        if expr in cache:
+            self.show_balloon('%s = %s' % (expr, cache[expr]))
+            return
+        serial = self._balloon_serial
+        self.timer(lambda: self.balloon_fire(serial, expr), BALLOON_DELAY)
+
+    def balloon_fire(self, serial, expr):
+        """Send the balloon evaluation unless superseded."""
+        self._balloon_pending = None
+        if serial != self._balloon_serial or self.inferior is None or \
+                not self.inferior.stopped:
+            return False
+        if self._balloon_inflight == self.inferior.pause_gen:
+            # 評価中のものがあるので、レスポンスを受け取ってから評価する.
+            self._balloon_pending = (serial, expr)
+            return False
+        self._balloon_inflight = self.inferior.pause_gen
+        self.inferior.balloon(expr, serial)
+        return False
 
     #-----------------------------------------------------------------------
     #   commands
@@ -849,11 +1832,34 @@ class NodeDbg(debugger.Debugger):
         self.print_prompt()
 
     def cmd_attach(self, cmd, args):
-        """ Attach to Node.js debugger."""
+        """ Attach to Node.js debugger.
+
+        The optional arguments are 'inspector' (use the inspector protocol
+        of node --inspect) and '[host:]port'.
+
+        """
         unused = cmd
 
         if self.inferior is None:
-            self.inferior = NodeTarget(self.options.daemon)
+            inspector = False
+            host = DEBUG_HOST
+            port = None
+            for arg in args.split():
+                if arg == 'inspector':
+                    inspector = True
+                    continue
+                m = re.match(r'^(?:(.+):)?(\d+)$', arg)
+                if m is None:
+                    self.console_print('Invalid argument: %s\n' % arg)
+                    self.print_prompt()
+                    return
+                host = m.group(1) or host
+                port = int(m.group(2))
+            if port is None:
+                port = INSPECTOR_PORT if inspector else DEBUG_PORT
+            self.inferior = NodeTarget(self.options.daemon, host, port,
+                    inspector)
+            self.inferior.pyprofiler = self._pyprofiler
             self.inferior.start()
         else:
             self.console_print('The inferior progam was attached.\n')
@@ -872,13 +1878,63 @@ class NodeDbg(debugger.Debugger):
     def cmd_break(self, cmd, args):
         """Set a breakpoint at a specified line.
 
-        The required argument of the vim user command is 'fname:lnum'.
+        The required argument of the vim user command is 'fname:lnum' or a
+        function name. 'Cbreak /regex/ [fname]' sets a breakpoint at every
+        indexed function matching regex (in fname), and 'Cbreak @file' at
+        every location of a quickfix file. The breakpoints of one command
+        are sent together and registered as each one is acknowledged.
 
         """
         unused = cmd
 
+        m = re.match(r'^\s*/(.+)/(?:\s+(\S+))?\s*$', args)
+        if m:
+            self.console_print(self.break_regex(m.group(1), m.group(2)))
+            self.print_prompt()
+            return
+        if args.strip().startswith('@'):
+            self.console_print(self.break_quickfix(args.strip()[1:].strip()))
+            self.print_prompt()
+            return
+
         name, lnum = debugger.name_lnum(args)
+        if not name and self._symbols is not None:
+            # 関数名の指定.
+            found = self._symbols.find(args.strip())
+            if len(found) == 1:
+                name, lnum = found[0]
+            elif len(found) > 1:
+                self.console_print('"%s" is ambiguous:\n' % args.strip())
+                for n, l in found:
+                    self.console_print('    %s:%d\n' % (n, l))
+                self.print_prompt()
+                return
         if name:
+            self.break_locations([(name, lnum)])
+        elif FUNCTION_NAME.match(args.strip()) and self.inferior is not None:
+            # インデックスにない関数は、debugger に関数の先頭へ設定させる.
+            self.inferior.add_func_bp(args.strip())
+        else:
+            self.console_print('Invalid arguments.\n')
+
+        self.print_prompt()
+
+    def break_locations(self, locations, skip_existing=False):
+        """Set breakpoints at the (fname, lnum) locations at once.
+
+        Return the number of the breakpoints set, the locations that already
+        have one are skipped when skip_existing is True.
+
+        """
+        count = 0
+        for name, lnum in locations:
+            name, lnum = self._sourcemaps.to_generated(name, lnum)
+            name = self.resolve_script(name)
+            if name is None:
+                continue
+            if skip_existing and bps.get_bp_id(name, lnum) is not None:
+                continue
+            count += 1
             self.bp_id += 1
             # 実際の位置はセットしてみないとわからないので、
             # ここでは追加の設定のみ行い、
@@ -887,6 +1943,84 @@ class NodeDbg(debugger.Debugger):
             # 実際にロードされるまでレスポンスがないので、
             # アノテーションは表示されないので、なにか対応を.
             bps.add_standby(self.bp_id, name, lnum)
+        # 次の scripts のレスポンスで、ロード済のスクリプトのものを
+        # まとめて送信する(レスポンスを待たずに続けて送信する).
+        self.inferior.scripts()
+        return count
+
+    def resolve_script(self, name):
+        """Return the loaded script matching the name, or the name itself.
+
+        The name may be the last components of the path ('lib/foo.js'). When
+        it matches several loaded scripts, the candidates are printed and
+        None is returned.
+
+        """
+        resolved, candidates = self._scripts.resolve(name)
+        if resolved is not None:
+            return resolved
+        if len(candidates) > 1:
+            self.console_print('"%s" is ambiguous:\n' % name)
+            for c in candidates:
+                self.console_print('    %s\n' % c)
+            return None
+        # まだロードされていないときは、ロードされたときに決める.
+        return name
+
+    def break_regex(self, pattern, script):
+        """Set breakpoints at the indexed functions matching pattern."""
+        if self._symbols is None:
+            return 'No function index, run Csymcompletion first.\n'
+        try:
+            regex = re.compile(pattern)
+        except re.error as e:
+            return 'Invalid regular expression: %s.\n' % e
+        if script is not None:
+            script = os.path.abspath(script)
+        found = self._symbols.match(regex, script)
+        if len(found) == 0:
+            return 'No function matches "%s".\n' % pattern
+        if len(found) > BULK_BREAK_MAX:
+            return '%d functions match "%s", the limit is %d.\n' % \
+                    (len(found), pattern, BULK_BREAK_MAX)
+        return 'Setting %d breakpoints.\n' % self.break_locations(found, True)
+
+    def break_quickfix(self, path):
+        """Set breakpoints at the locations of the quickfix file."""
+        try:
+            with open(path, encoding='utf-8', errors='replace') as f:
+                found = quickfix_locations(f)
+        except (IOError, OSError) as e:
+            return 'Cannot read %s: %s.\n' % (path, e.strerror)
+        if len(found) == 0:
+            return 'No location in %s.\n' % path
+        if len(found) > BULK_BREAK_MAX:
+            return '%d locations in %s, the limit is %d.\n' % \
+                    (len(found), path, BULK_BREAK_MAX)
+        return 'Setting %d breakpoints.\n' % self.break_locations(found, True)
+
+    def cmd_logpoint(self, cmd, args):
+        """Set a logpoint at a specified line.
+
+        The required arguments of the vim user command are 'fname:lnum' and
+        the message template, the expressions enclosed in braces in the
+        template are evaluated each time the logpoint is hit. The target is
+        never stopped by a logpoint.
+
+        """
+        unused = cmd
+
+        args = args.split(None, 1)
+        name = None
+        if len(args) == 2:
+            name, lnum = debugger.name_lnum(args[0])
+        if name:
+            self.bp_id += 1
+            label = os.path.basename(name) + ':' + str(lnum)
+            name, lnum = self._sourcemaps.to_generated(name, lnum)
+            condition = logpoint_condition(label, args[1])
+            # 設定の流れは cmd_break と同じ.
+            bps.add_standby(self.bp_id, name, lnum, condition, args[1])
             self.inferior.scripts()
         else:
             self.console_print('Invalid arguments.\n')
@@ -903,6 +2037,12 @@ class NodeDbg(debugger.Debugger):
         result = 'Invalid arguments.\n'
 
         name, lnum = debugger.name_lnum(args)
+        if name:
+            name, lnum = self._sourcemaps.to_generated(name, lnum)
+            name = self.resolve_script(name)
+            if name is None:
+                # 候補は表示済.
+                result = ''
         if name:
             bp_id = bps.get_bp_id(name, lnum)
             if bp_id is not None:
@@ -928,6 +2068,7 @@ class NodeDbg(debugger.Debugger):
             if name is not None:
                 self.update_bp(args[0], not enable)
                 self.inferior.update_bp(args[0], not enable)
+                bps.set_enabled(args[0], enable)
                 result = ''
 
         self.console_print(result)
@@ -949,26 +2090,58 @@ class NodeDbg(debugger.Debugger):
         """
         self.set_bpstate(cmd, args, True)
 
-    def cmd_step(self, *args):
-        """Step program until it reaches a different source line."""
-        unused = args
+    def get_count(self, args):
+        """Return the count argument of the step commands, None if invalid."""
+        count = 1
+        if args.strip():
+            try:
+                count = int(args)
+            except ValueError:
+                count = 0
+        if count < 1:
+            self.console_print('Invalid arguments.\n')
+            self.print_prompt()
+            return None
+        return count
+
+    def cmd_step(self, cmd, args):
+        """Step program until it reaches a different source line.
+
+        With a count argument, step count times.
+
+        """
+        unused = cmd
         assert self.inferior is not None
-        self.inferior.step()
-        self.print_prompt()
+        count = self.get_count(args)
+        if count is not None:
+            self.inferior.step(count)
+            self.print_prompt()
 
-    def cmd_stepin(self, *args):
-        """Step into function."""
-        unused = args
+    def cmd_stepin(self, cmd, args):
+        """Step into function.
+
+        With a count argument, step count times.
+
+        """
+        unused = cmd
         assert self.inferior is not None
-        self.inferior.stepin()
-        self.print_prompt()
+        count = self.get_count(args)
+        if count is not None:
+            self.inferior.stepin(count)
+            self.print_prompt()
 
-    def cmd_stepout(self, *args):
-        """Step out current function."""
-        unused = args
+    def cmd_stepout(self, cmd, args):
+        """Step out current function.
+
+        With a count argument, step count times.
+
+        """
+        unused = cmd
         assert self.inferior is not None
-        self.inferior.stepout()
-        self.print_prompt()
+        count = self.get_count(args)
+        if count is not None:
+            self.inferior.stepout(count)
+            self.print_prompt()
 
     def cmd_continue(self, *args):
         """Continue the program being debugged, also used to start the program."""
@@ -988,15 +2161,323 @@ class NodeDbg(debugger.Debugger):
         self.inferior.backtrace()
         self.print_prompt()
 
+    def cmd_findvar(self, cmd, args):
+        """Find the variables whose name matches a pattern.
+
+        The matching variables are expanded in the variables buffer and the
+        cursor is moved to the first one. With 'Cfindvar/N pattern', the
+        objects not yet fetched are looked up first, breadth first, up to N
+        levels (and FINDVAR_MAX_LOOKUPS objects). Only the expanded scopes
+        are searched this way and functions are not looked up, unless
+        'Cfindvar/N! pattern' is used.
+
+        """
+        unused = cmd
+        m = re.match(r'^(?:/(\d+)(!)?\s+)?(.+)$', args.strip())
+        pattern = None
+        if m:
+            try:
+                pattern = re.compile(m.group(3))
+            except re.error:
+                pass
+        if pattern is None:
+            self.console_print('Invalid arguments.\n')
+            self.print_prompt()
+            return
+
+        depth = int(m.group(1) or 0)
+        if depth > 0 and self.inferior is not None:
+            self._findvar = {'pattern': pattern, 'depth': depth,
+                    'pending': set(), 'fetched': [], 'budget':
+                    FINDVAR_MAX_LOOKUPS, 'everything': bool(m.group(2)),
+                    'failed': 0}
+            self.findvar_next([])
+        else:
+            self.findvar_show(pattern)
+
+    def findvar_next(self, done):
+        """Look up the next level of Cfindvar/N, or show the result.
+
+        done are the handles looked up, or that could not be, since the
+        last call.
+
+        """
+        findvar = self._findvar
+        findvar['pending'].difference_update(done)
+        if len(findvar['pending']):
+            return
+        handles = []
+        if findvar['depth'] > 0 and findvar['budget'] > 0:
+            handles = self.varobj.get_unfetched(findvar['budget'],
+                    findvar['fetched'], findvar['everything'])
+        if len(handles) == 0:
+            self._findvar = None
+            if findvar['failed'] > 0:
+                self.console_print('%d objects not found.\n' % \
+                        findvar['failed'])
+            self.findvar_show(findvar['pattern'])
+            # 表示のために展開したもの以外は、停止するたびに lookup しない.
+            self.varobj.forget_lookup(findvar['fetched'])
+            return
+        findvar['depth'] -= 1
+        findvar['budget'] -= len(handles)
+        findvar['pending'].update(handles)
+        findvar['fetched'].extend(handles)
+        for i in range(0, len(handles), FINDVAR_BATCH):
+            self.inferior.lookup(handles[i:i + FINDVAR_BATCH])
+
+    def findvar_show(self, pattern):
+        """Print the matching variables and expand them."""
+        found = self.varobj.find(pattern)
+        if len(found) == 0:
+            self.console_print('No variable matches "%s".\n' % \
+                    pattern.pattern)
+        else:
+            for index, names in found:
+                self.console_print('%s: %s\n' % \
+                        (self.varobj.scopes[index]['lbl'],
+                            '.'.join(str(n) for n in names)))
+                self.varobj.expand_path(index, names)
+            # 展開したことで行番号が変わるので、先頭のものを取得しなおす.
+            self._findvar_lnum = self.varobj.expand_path(*found[0])
+        self.print_prompt()
+
+    def cmd_varhistory(self, cmd, args):
+        """Print how a variable changed over the last stops.
+
+        The variable is given by its name in the variables buffer, with
+        '.' between the names of nested properties. With 'Cvarhistory/N',
+        the number of stops kept is changed to N (default VARHISTORY_SIZE).
+
+        """
+        unused = cmd
+        m = re.match(r'^(?:/(\d+))?\s*(.*)$', args.strip())
+        if m.group(1):
+            self.varobj.set_history_size(max(1, int(m.group(1))))
+            self.console_print('Keep the variables of the last %d stops.\n'
+                    % self.varobj.history.maxlen)
+        if m.group(2):
+            names = m.group(2).split('.')
+            prev = None
+            for label, value in self.varobj.var_history(names):
+                hilite = '='
+                if value != prev:
+                    hilite = '*'
+                prev = value
+                if value is None:
+                    value = '<not found>'
+                self.console_print('%-20s {%s} %s\n' % \
+                        (label or '(current)', hilite, value))
+        elif not m.group(1):
+            self.console_print('Invalid arguments.\n')
+        self.print_prompt()
+
+    def cmd_up(self, cmd, args):
+        """Select the frame N (default 1) levels up, to the caller."""
+        unused = cmd
+        self.move_selected_frame(args, 1)
+
+    def cmd_down(self, cmd, args):
+        """Select the frame N (default 1) levels down, to the callee."""
+        unused = cmd
+        self.move_selected_frame(args, -1)
+
+    def move_selected_frame(self, args, direction):
+        args = args.strip() or '1'
+        if not args.isdigit():
+            self.console_print('Invalid arguments.\n')
+            self.print_prompt()
+            return
+        self.select_frame(self._frame + int(args) * direction)
+
+    def cmd_frame(self, cmd, args):
+        """Select the frame N, or print the selected frame without N.
+
+        The variables buffer and Cprint use the selected frame until the
+        program stops again. The variables of each frame are kept while
+        the program is stopped, so switching back is immediate.
+
+        """
+        unused = cmd
+        args = args.strip()
+        if not args:
+            if self.inferior is None or not self.inferior.stopped:
+                self.console_print('The program is not stopped.\n')
+                self.print_prompt()
+            elif self._frame in self._frame_fresh and \
+                    (self._frame == 0 or self._frame in self._frame_pos):
+                self.show_selected_frame()
+            else:
+                self.console_print('#%d\n' % self._frame)
+                self.print_prompt()
+        elif args.isdigit():
+            self.select_frame(int(args))
+        else:
+            self.console_print('Invalid arguments.\n')
+            self.print_prompt()
+
     def cmd_print(self, cmd, args):
-        """Print a value."""
+        """Print a value.
+
+        With 'Cprint/N expr', objects are expanded up to N levels.
+
+        """
         unused = cmd
-        if args:
+        m = re.match(r'^/(\d+)\s+(.+)$', args)
+        if m:
+            self.inferior.print(m.group(2), int(m.group(1)))
+        elif args:
             self.inferior.print(args)
         else:
             self.console_print('Invalid arguments.\n')
             self.print_prompt()
 
+    def cmd_profile(self, cmd, args):
+        """Sample the stack of the running program.
+
+        'Cprofile start [hz]' starts sampling hz times per second (default
+        100), 'Cprofile stop [file]' writes the sampled stacks to file in the
+        folded format of flamegraph.pl and prints the hottest functions.
+
+        """
+        unused = cmd
+        args = args.split()
+        if self.inferior is None:
+            self.console_print('The inferior progam was not attached.\n')
+        elif len(args) in (1, 2) and args[0] == 'start':
+            try:
+                hz = 100
+                if len(args) == 2:
+                    hz = int(args[1])
+                if hz < 1:
+                    raise ValueError
+                if self.inferior.profile_start(hz):
+                    self.console_print('Sampling at %d Hz.\n' % hz)
+                else:
+                    self.console_print('Sampling at %d Hz once the program'
+                            ' is continued.\n' % hz)
+            except ValueError:
+                self.console_print('Invalid arguments.\n')
+        elif len(args) in (1, 2) and args[0] == 'stop':
+            sampler = self.inferior.profile_stop()
+            if sampler is None:
+                self.console_print('Not sampling.\n')
+            else:
+                path = 'nodedbg-profile.folded'
+                if len(args) == 2:
+                    path = args[1]
+                sampler.write_folded(path)
+                self.console_print('%d samples written to %s.\n' % \
+                        (sampler.samples, path))
+                if sampler.samples > 0:
+                    self.console_print('average pause: %.2f ms\n' % \
+                            (sampler.pause_total * 1000 / sampler.samples))
+                self.console_print('%6s %6s  %s\n' % ('self', 'total',
+                    'function'))
+                for label, self_count, total_count in sampler.top(20):
+                    self.console_print('%5.1f%% %5.1f%%  %s\n' % \
+                            (self_count * 100.0 / sampler.samples,
+                                total_count * 100.0 / sampler.samples, label))
+        else:
+            self.console_print('Invalid arguments.\n')
+        self.print_prompt()
+
+    def cmd_pyprofile(self, cmd, args):
+        """Profile nodedbg itself, to find where the Python side spends time.
+
+        'Cpyprofile start' profiles the responses handled in the I/O thread
+        and the periodic job updating Vim, 'Cpyprofile stop [file]' writes
+        the pstats file (default nodedbg.pstats) and prints the functions
+        with the highest cumulative time.
+
+        """
+        unused = cmd
+        args = args.split()
+        if args == ['start']:
+            if self.inferior is None:
+                self.console_print('The inferior progam was not attached.\n')
+                self.print_prompt()
+                return
+            if self._pyprofiler is None:
+                self._pyprofiler = PyProfiler()
+                self.inferior.pyprofiler = self._pyprofiler
+            self.console_print('Profiling nodedbg.\n')
+        elif len(args) in (1, 2) and args[0] == 'stop':
+            profiler = self._pyprofiler
+            if profiler is None:
+                self.console_print('Not profiling.\n')
+            else:
+                # 計測は NodeDbg が持つので、切断した後でも書き出せる.
+                self._pyprofiler = None
+                if self.inferior is not None:
+                    self.inferior.pyprofiler = None
+                path = 'nodedbg.pstats'
+                if len(args) == 2:
+                    path = args[1]
+                text = profiler.stop(path, PYPROFILE_TOP)
+                if text:
+                    self.console_print('%d calls profiled in %.1fs, written to'
+                            ' %s.\n' % (profiler.calls,
+                                time.time() - profiler.started, path))
+                    self.console_print(text)
+                else:
+                    self.console_print('No calls profiled.\n')
+        else:
+            self.console_print('Invalid arguments.\n')
+        self.print_prompt()
+
+    def cmd_watch(self, cmd, args):
+        """Add an expression to the watch list of the variables window.
+
+        Without argument, list the watch expressions.
+
+        """
+        unused = cmd
+        if args:
+            self.varobj.add_watch(args.strip())
+            if self.inferior is not None and not self.inferior.running:
+                self.inferior.watch(self.varobj.get_watch_exprs())
+        else:
+            num = 1
+            for expr in self.varobj.get_watch_exprs():
+                self.console_print('%d: %s\n' % (num, expr))
+                num = num + 1
+        self.print_prompt()
+
+    def cmd_unwatch(self, cmd, args):
+        """Remove an expression from the watch list.
+
+        The required argument of the vim user command is the watch number.
+
+        """
+        unused = cmd
+        try:
+            if self.varobj.del_watch(int(args)):
+                self.update_dbgvarbuf(self.varobj.__str__, True)
+            else:
+                self.console_print('"%s" not found.\n' % args)
+        except ValueError:
+            self.console_print('Invalid arguments.\n')
+        self.print_prompt()
+
+    def cmd_more(self, *args):
+        """Print the next part of the string truncated by the last print."""
+        unused = args
+        if self._remains is None:
+            self.console_print('Nothing more to print.\n')
+            self.print_prompt()
+        else:
+            self.inferior.more(self._remains)
+
+    def cmd_stats(self, *args):
+        """Print the statistics of the traffic with the debugger."""
+        unused = args
+        if self.inferior is None:
+            self.console_print('The inferior progam was not attached.\n')
+        else:
+            self.console_print(self.inferior.stats())
+        self.print_prompt()
+
     def cmd_foldvar(self, cmd, args):
         """Collapse/expand a variable from the debugger variable buffer."""
         unused = cmd
@@ -1033,8 +2514,187 @@ class NodeDbg(debugger.Debugger):
         self.print_prompt()
 
     def cmd_symcompletion(self, *args):
-        """Populate the break and clear commands with symbols completion (not implemented)."""
-        unused = self
+        """Build the function names index used by the break command.
+
+        The index is updated as new scripts are loaded, once built the
+        break command accepts a function name in place of 'fname:lnum'.
+
+        """
         unused = args
-        self.console_print('Not implemented.\n')
+        if self._symbols is None:
+            self._symbols = SymbolIndex()
+        ids = self._symbols.new_ids(self._scripts.ids())
+        if len(ids) > 0 and self.inferior is not None:
+            self.inferior.scripts_source(ids)
+        self.console_print('Indexing the functions of %d scripts.\n' % len(ids))
         self.print_prompt()
+
+class NodeBatch:
+    """Run a file of nodedbg commands against a Node.js debugger without Vim.
+
+    Each command and each event or result received from the debugger is
+    written to out as one JSON object per line.
+
+    """
+
+    # 出力しない(変数一覧用などの) item
+    IGNORED_ITEMS = ('scripts', 'frame', 'scope', 'properties', 'logpoints')
+
+    def __init__(self, out, host=DEBUG_HOST, port=DEBUG_PORT, timeout=30,
+            inspector=False):
+        """Constructor."""
+        self.out = out
+        self.host = host
+        self.port = port
+        self.inspector = inspector
+        self.timeout = timeout
+        self.inferior = None
+        self.watches = []
+        self.failed = False
+
+    def write(self, item):
+        self.out.write(json.dumps(item) + '\n')
+        self.out.flush()
+
+    def wait(self, types):
+        """Write the items from the target until one of types is received."""
+        limit = time.time() + self.timeout
+        found = False
+        watching = False
+        while time.time() < limit:
+            for item in self.inferior.bp_que.drain():
+                if item['type'] in types:
+                    found = True
+                if item['type'] == 'break' and len(self.watches):
+                    # watch の結果も待つ.
+                    self.inferior.watch(self.watches)
+                    watching = True
+                elif item['type'] == 'watch':
+                    watching = False
+                if item['type'] == 'close':
+                    self.failed = True
+                    return False
+                if item['type'] not in self.IGNORED_ITEMS:
+                    self.write(item)
+            if found and not watching:
+                return True
+            time.sleep(0.01)
+        self.write({'type': 'timeout', 'wait': list(types)})
+        self.failed = True
+        return False
+
+    def error(self, lnum, text):
+        """Report the error of the command at lnum and stop the run."""
+        self.write({'type': 'error', 'lnum': lnum,
+            'text': 'bad command at line %s: %s' % (lnum, text)})
+        self.failed = True
+        return
+
+    def run_cmd(self, line, lnum=None):
+        """Run one command line, lnum is its line number in the file."""
+        cmd, _, args = line.partition(' ')
+        args = args.strip()
+        self.write({'type': 'cmd', 'cmd': line})
+        if cmd == 'break':
+            name, bp_lnum = debugger.name_lnum(args)
+            if not name:
+                self.error(lnum, 'expected fname:lnum, got "%s"' % args)
+                return
+            self.inferior.add_bp(0, name, bp_lnum)
+            self.wait(('setbreakpoint', 'print'))
+        elif cmd == 'continue':
+            self.inferior.run_continue()
+            self.wait(('break',))
+        elif cmd in ('step', 'stepin', 'stepout'):
+            if not re.match(r'^\d*$', args) or args == '0':
+                self.error(lnum, 'expected a positive count, got "%s"' % args)
+                return
+            getattr(self.inferior, cmd)(int(args or 1))
+            self.wait(('break',))
+        elif cmd.startswith('print'):
+            m = re.match(r'^print(?:/(\d+))?$', cmd)
+            if m is None or not args:
+                self.error(lnum, 'expected print[/N] expr')
+                return
+            if m.group(1):
+                self.inferior.print(args, int(m.group(1)))
+            else:
+                self.inferior.print(args)
+            self.wait(('print',))
+        elif cmd == 'watch':
+            if not args:
+                self.error(lnum, 'expected watch expr')
+                return
+            self.watches.append(args)
+            self.inferior.watch(self.watches)
+            self.wait(('watch',))
+        elif cmd == 'stats':
+            self.write({'type': 'stats', 'text': self.inferior.stats()})
+        elif cmd == 'sleep':
+            try:
+                seconds = float(args)
+            except ValueError:
+                seconds = -1
+            if not seconds >= 0:
+                self.error(lnum, 'expected seconds, got "%s"' % args)
+                return
+            time.sleep(seconds)
+        else:
+            self.error(lnum, 'invalid command "%s"' % cmd)
+        return
+
+    def run(self, lines):
+        """Connect to the debugger and run the commands."""
+        self.inferior = NodeTarget(True, self.host, self.port,
+                self.inspector)
+        self.inferior.start()
+        for lnum, line in enumerate(lines, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            if line == 'quit':
+                break
+            self.run_cmd(line, lnum)
+            if self.failed:
+                break
+        if self.inferior.is_alive():
+            self.inferior.close()
+            self.inferior.join(self.timeout)
+        return not self.failed
+
+def main():
+    """Run nodedbg in batch mode."""
+    # batch mode でのみ使うので、ここで import する.
+    import optparse
+    parser = optparse.OptionParser(
+            usage='python -m clewn.nodedbg --batch FILE [options]')
+    parser.add_option('--batch', metavar='FILE',
+            help='run the nodedbg commands of FILE (- for stdin)')
+    parser.add_option('--host', default=DEBUG_HOST,
+            help='host of the Node.js debugger (default \'%default\')')
+    parser.add_option('--port', type='int',
+            help='port of the Node.js debugger (default %d, or %d with '
+            '--inspector)' % (DEBUG_PORT, INSPECTOR_PORT))
+    parser.add_option('--inspector', action='store_true', default=False,
+            help='use the inspector protocol of node --inspect')
+    parser.add_option('--timeout', type='float', default=30,
+            help='seconds to wait for each command (default \'%default\')')
+    (options, args) = parser.parse_args()
+    if options.batch is None:
+        parser.error('the --batch option is required')
+
+    if options.batch == '-':
+        lines = sys.stdin.readlines()
+    else:
+        with open(options.batch) as f:
+            lines = f.readlines()
+    port = options.port
+    if port is None:
+        port = INSPECTOR_PORT if options.inspector else DEBUG_PORT
+    batch = NodeBatch(sys.stdout, options.host, port, options.timeout,
+            options.inspector)
+    if not batch.run(lines):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,847 @@
+# vi:set ts=8 sts=4 sw=4 et tw=80:
+#
+# @author hankei6km
+# @copyright (c) 2013 hankei6km
+# @license MIT License (http://opensource.org/licenses/mit-license.php)
+#
+# Node.js の inspector (Chrome DevTools Protocol) 用のクライアント.
+# NodeClient と同じ dbg_* メソッドを持ち、
+# レスポンスとイベントは v8 debugger protocol の形式に変換して渡すので、
+# NodeTarget からは NodeClient と同じように扱える.
+
+import os
+import re
+import json
+import base64
+import collections
+import urllib.parse
+
+from .nodeclient import (NodeClient, DEBUG_HOST, PREVIEW_STRING_LENGTH)
+from .nodeutils import json_codec
+
+INSPECTOR_PORT = 9229
+
+# Debugger.paused の scopeChain の type から v8 debugger protocol の scope の
+# type への変換.
+SCOPE_TYPES = {
+        'global': 0,
+        'local': 1,
+        'with': 2,
+        'closure': 3,
+        'catch': 4,
+        'block': 5,
+        'script': 6,
+        'eval': 7,
+        'module': 8
+        }
+
+STEP_METHODS = {
+        None: 'Debugger.resume',
+        'next': 'Debugger.stepOver',
+        'in': 'Debugger.stepInto',
+        'out': 'Debugger.stepOut'
+        }
+
+def url_to_name(url):
+    """ scriptParsed の url をスクリプト名(ファイルのパスなど)へ変換."""
+    if url.startswith('file://'):
+        return urllib.parse.unquote(url[len('file://'):])
+    return url
+
+def preview_to_value(preview):
+    """ generatePreview の PropertyPreview を properties の value 形式へ変換.
+
+    子のオブジェクトは objectId がないので、展開できない値として
+    description を表示する(親を lookup すると置き換わる).
+    """
+    value = {'type': preview['type']}
+    if preview['type'] == 'undefined':
+        pass
+    elif preview.get('subtype') == 'null':
+        value['type'] = 'null'
+        value['value'] = None
+    elif preview['type'] in ('number', 'boolean'):
+        # RemoteObject の value とそろえる(NaN などは文字列のまま).
+        try:
+            value['value'] = json.loads(preview.get('value', ''))
+        except ValueError:
+            value['value'] = preview.get('value', '')
+    else:
+        value['value'] = preview.get('value', '')
+    return value
+
+def name_to_url_regex(name):
+    """ スクリプト名から setBreakpointByUrl の urlRegex を作成."""
+    return '^(file://)?' + re.escape(name) + '$'
+
+def ws_frame(payload, opcode=0x1):
+    """ クライアントから送信する(マスクした) WebSocket のフレーム."""
+
+    header = bytes([0x80 | opcode])
+    length = len(payload)
+    if length < 126:
+        header = header + bytes([0x80 | length])
+    elif length < 65536:
+        header = header + bytes([0x80 | 126]) + length.to_bytes(2, 'big')
+    else:
+        header = header + bytes([0x80 | 127]) + length.to_bytes(8, 'big')
+    key = os.urandom(4)
+    mask = (key * (length // 4 + 1))[:length]
+    masked = (int.from_bytes(payload, 'big') ^ int.from_bytes(mask, 'big')) \
+            .to_bytes(length, 'big')
+    return header + key + masked
+
+class InspectorClient(NodeClient):
+    """Node.js の inspector を非同期に制御するクラス."""
+    def __init__(self, handle_resp):
+        NodeClient.__init__(self, handle_resp)
+        self.cdp_id = 0
+        self.callbacks = {}
+        self.calls = collections.deque()
+
+        self.ws_state = 'handshake'
+        self.ws_pending = []
+        self.ws_opcode = 0
+        self.ws_payload = []
+
+        # 以下はループのスレッドでのみ参照する.
+        self.context_id = None
+        self.scripts = {}
+        self.call_frames = None
+        self.when_paused = []
+        self.steps = None
+        # Debugger.pause を送信し、まだ停止していない.
+        self.pause_requested = False
+        # resume などを送信し、まだ Debugger.resumed を受け取っていない.
+        # その間の Debugger.pause は無視されるので、受け取ってから送信する.
+        self.resuming = False
+        self.when_resumed = []
+        self.bp_id = 0
+        self.bps = {}
+        self.handle = 0
+        self.objects = {}
+        self.strings = {}
+        return
+
+    def connect_start(self, host=DEBUG_HOST, port=INSPECTOR_PORT):
+        """ inspector と接続する.
+
+        接続先の WebSocket の url は /json/list から取得する.
+        取得は待たされることもあるので、呼び出し元(Vim など)のスレッドでは
+        行わず、ループのスレッドで行う.
+        """
+        self.calls.append((self._connect, (host, port)))
+        self.waker.wake()
+        return
+
+    def _connect(self, host, port):
+        # http.client などを読み込むので、使うときにのみ import する.
+        import urllib.request
+        self.host = host
+        try:
+            with urllib.request.urlopen('http://%s:%d/json/list' % \
+                    (host, port), timeout=5) as f:
+                targets = json.loads(f.read().decode())
+            url = urllib.parse.urlparse(targets[0]['webSocketDebuggerUrl'])
+            self.ws_path = url.path
+        except (OSError, ValueError, IndexError, KeyError):
+            self.close()
+            return
+        NodeClient.connect_start(self, host, url.port or port)
+        return
+
+    def handle_connect(self):
+        key = base64.b64encode(os.urandom(16)).decode()
+        req = ('GET %s HTTP/1.1\r\n'
+                'Host: %s\r\n'
+                'Upgrade: websocket\r\n'
+                'Connection: Upgrade\r\n'
+                'Sec-WebSocket-Key: %s\r\n'
+                'Sec-WebSocket-Version: 13\r\n\r\n') % \
+                        (self.ws_path, self.host, key)
+        self.push_data(req.encode())
+        return
+
+    def found_terminator(self):
+        data = b''.join(self.ibuffer)
+        self.ibuffer = []
+        if self.ws_state == 'handshake':
+            if not data.startswith(b'HTTP/1.1 101'):
+                self.close()
+                return
+            self.set_terminator(2)
+            with self.sending:
+                self.ws_state = 'head'
+                for method in ('Runtime.enable', 'Debugger.enable',
+                        'Runtime.runIfWaitingForDebugger'):
+                    self.obuffer.append(self.cdp_frame(method))
+                # ハンドシェイクの前に要求されたものはここで送信する.
+                self.obuffer.extend(self.ws_pending)
+                self.ws_pending = []
+            self.waker.wake()
+        elif self.ws_state == 'head':
+            self.ws_opcode = data[0] & 0x0f or self.ws_opcode
+            self.ws_fin = (data[0] & 0x80) != 0
+            length = data[1] & 0x7f
+            if length == 126:
+                self.ws_state = 'length'
+                self.set_terminator(2)
+            elif length == 127:
+                self.ws_state = 'length'
+                self.set_terminator(8)
+            else:
+                self.ws_length(length)
+        elif self.ws_state == 'length':
+            self.ws_length(int.from_bytes(data, 'big'))
+        else:
+            self.ws_payload.append(data)
+            self.ws_message()
+        return
+
+    def ws_length(self, length):
+        """ フレームの長さを受け取ったので、ペイロードを待つ."""
+        if length > 0:
+            self.ws_state = 'payload'
+            self.set_terminator(length)
+        else:
+            self.ws_message()
+        return
+
+    def ws_message(self):
+        """ フレームを受け取り終えたので処理する."""
+        self.ws_state = 'head'
+        self.set_terminator(2)
+        if not self.ws_fin:
+            # 続きのフレームを待つ.
+            return
+
+        payload = b''.join(self.ws_payload)
+        self.ws_payload = []
+        if self.ws_opcode == 0x1:
+            self.handle_cdp(json_codec.loads(payload))
+        elif self.ws_opcode == 0x8:
+            self.close()
+        elif self.ws_opcode == 0x9:
+            self.push_data(ws_frame(payload, 0xa))
+        self.ws_opcode = 0
+        return
+
+    #-----------------------------------------------------------------------
+    #   utils
+    #-----------------------------------------------------------------------
+    def send_cdp(self, method, params=None, callback=None):
+        """ inspector へ request を送信する.
+
+        callback はレスポンスの result (エラーのときは None) と、
+        エラーを引数としてループのスレッドで呼び出される.
+        """
+        with self.sending:
+            frame = self.cdp_frame(method, params, callback)
+            if self.ws_state == 'handshake':
+                self.ws_pending.append(frame)
+            else:
+                self.obuffer.append(frame)
+        self.waker.wake()
+        return
+
+    def cdp_frame(self, method, params=None, callback=None):
+        """ request のフレームを作成する(self.sending を取得して呼び出す)."""
+        self.cdp_id = self.cdp_id + 1
+        msg = {'id': self.cdp_id, 'method': method, 'params': params or {}}
+        if callback is not None:
+            self.callbacks[self.cdp_id] = callback
+        return ws_frame(json_codec.dumps(msg))
+
+    def call_soon(self, tag, fn, *args):
+        """ seq を割り当て、fn(seq, *args) をループのスレッドで呼び出す."""
+        with self.sending:
+            seq = self.new_seq(tag)
+        self.calls.append((fn, (seq,) + args))
+        self.waker.wake()
+        return seq
+
+    def handle_wake(self):
+        while self.calls:
+            fn, args = self.calls.popleft()
+            fn(*args)
+        return
+
+    def reply(self, seq, command, body=None, success=True, message=None,
+            refs=None):
+        """ v8 debugger protocol 形式のレスポンスを渡す."""
+        resp = {
+                'type': 'response',
+                'request_seq': seq,
+                'command': command,
+                'success': success,
+                'body': body,
+                'refs': refs or []
+                }
+        if message is not None:
+            resp['message'] = message
+        self._handle_resp(resp)
+        return
+
+    def event(self, event, body):
+        self._handle_resp({'type': 'event', 'event': event, 'body': body})
+        return
+
+    def paused(self, fn):
+        """ 停止していれば fn を呼び出し、そうでなければ停止するまで待つ."""
+        if self.call_frames is not None:
+            fn()
+        else:
+            self.when_paused.append(fn)
+        return
+
+    def new_handle(self, remote):
+        """ RemoteObject に v8 debugger protocol 形式の handle を割り当てる."""
+        self.handle = self.handle + 1
+        if 'objectId' in remote:
+            self.objects[self.handle] = remote['objectId']
+        return self.handle
+
+    def remote_to_value(self, remote, max_length=PREVIEW_STRING_LENGTH):
+        """ RemoteObject を scope の properties の value 形式へ変換."""
+        value = {'type': remote['type']}
+        if remote['type'] in ('object', 'function'):
+            if remote.get('subtype') == 'null':
+                value['type'] = 'null'
+                value['value'] = None
+            else:
+                value['className'] = remote.get('className', 'Object')
+                value['ref'] = self.new_handle(remote)
+        elif remote['type'] == 'undefined':
+            pass
+        elif 'value' in remote:
+            value['value'] = remote['value']
+            if remote['type'] == 'string' and len(remote['value']) > max_length:
+                # 続きは手元から返せるように保持しておく.
+                value['ref'] = self.new_handle(remote)
+                value['length'] = len(remote['value'])
+                self.strings[value['ref']] = remote['value']
+                value['value'] = remote['value'][:max_length]
+        else:
+            # NaN や Infinity など.
+            value['value'] = remote.get('unserializableValue',
+                    remote.get('description'))
+        return value
+
+    def remote_to_body(self, remote, max_length):
+        """ RemoteObject を evaluate の body 形式へ変換."""
+        body = self.remote_to_value(remote, max_length)
+        if 'ref' in body:
+            body['handle'] = body['ref']
+        body['text'] = remote.get('description', str(body.get('value')))
+        if body['type'] == 'string':
+            body['text'] = body['value']
+        refs = []
+        preview = remote.get('preview')
+        if body['type'] == 'object' and preview is not None:
+            # generatePreview の内容から、lookup しなくても表示できるようにする.
+            body['properties'] = []
+            for p in preview.get('properties', []):
+                self.handle = self.handle + 1
+                className = 'Object'
+                if p.get('subtype') == 'array':
+                    className = 'Array'
+                body['properties'].append({'name': p['name'],
+                    'ref': self.handle})
+                refs.append({'handle': self.handle, 'type': p['type'],
+                    'className': className, 'text': p.get('value', '')})
+        return body, refs
+
+    def props_to_properties(self, props):
+        """ Runtime.getProperties の result を properties 形式へ変換.
+
+        generatePreview の内容がすべてそろっているオブジェクトは、
+        一階層目の子の値を value の 'preview' に入れておく.
+        """
+        ret = []
+        for p in props:
+            if 'value' in p and p['name'] != '__proto__':
+                value = self.remote_to_value(p['value'])
+                preview = p['value'].get('preview')
+                if 'ref' in value and preview is not None and \
+                        not preview.get('overflow') and \
+                        'entries' not in preview:
+                    value['preview'] = [{'name': c['name'],
+                        'value': preview_to_value(c)}
+                        for c in preview.get('properties', [])]
+                ret.append({'name': p['name'], 'value': value})
+        return ret
+
+    #-----------------------------------------------------------------------
+    #   events from inspector
+    #-----------------------------------------------------------------------
+    def handle_cdp(self, msg):
+        if 'id' in msg:
+            callback = self.callbacks.pop(msg['id'], None)
+            if callback is not None:
+                callback(msg.get('result'), msg.get('error'))
+            return
+
+        method = msg.get('method')
+        params = msg.get('params', {})
+        if method == 'Runtime.executionContextCreated':
+            if self.context_id is None:
+                self.context_id = params['context']['id']
+        elif method == 'Debugger.scriptParsed':
+            self.scripts[params['scriptId']] = url_to_name(params['url'])
+        elif method == 'Debugger.paused':
+            self.on_paused(params)
+        elif method == 'Debugger.resumed':
+            self.call_frames = None
+            self.objects = {}
+            self.strings = {}
+            self.resuming = False
+            when_resumed = self.when_resumed
+            self.when_resumed = []
+            for fn in when_resumed:
+                fn()
+        return
+
+    def on_paused(self, params):
+        if self.steps is not None and self.steps[1] > 1 and \
+                not params.get('hitBreakpoints'):
+            # stepcount 分のステップ実行の途中(ブレイクポイントで停止した
+            # ときは、残りは取り消してその位置で止まる).
+            self.steps[1] = self.steps[1] - 1
+            self.send_cdp(STEP_METHODS[self.steps[0]])
+            return
+        self.steps = None
+
+        self.call_frames = params['callFrames']
+        location = self.call_frames[0]['location']
+        script = {'id': int(location['scriptId'])}
+        name = self.scripts.get(location['scriptId'])
+        if name:
+            script['name'] = name
+        body = {'script': script, 'sourceLine': location['lineNumber'],
+                'reason': params.get('reason', 'other')}
+        if params.get('hitBreakpoints'):
+            body['breakpoints'] = params['hitBreakpoints']
+        if self.pause_requested:
+            # dbg_suspend による停止(ブレイクポイントなどと重なることもある).
+            body['suspend'] = True
+            self.pause_requested = False
+        if params.get('reason') in ('exception', 'promiseRejection'):
+            data = params.get('data', {})
+            body['exception'] = {'text': data.get('description',
+                str(data.get('value')))}
+            self.event('exception', body)
+        else:
+            self.event('break', body)
+
+        when_paused = self.when_paused
+        self.when_paused = []
+        for fn in when_paused:
+            fn()
+        return
+
+    #-----------------------------------------------------------------------
+    #   commands for Node.js debugger
+    #-----------------------------------------------------------------------
+
+    def dbg_disconnect(self):
+        self.call_soon(None, self._disconnect)
+        return
+
+    def _disconnect(self, seq):
+        self.reply(seq, 'disconnect')
+        self.push_data(ws_frame(b'', 0x8))
+        return
+
+    def dbg_continue(self, step=None, count=1):
+        self.call_soon(None, self._continue, step, count)
+        return
+
+    def _continue(self, seq, step, count):
+        if step is not None:
+            self.steps = [step, count]
+        # Debugger.resumed を待たずに、前回の停止時の frame は使わなくする
+        # (backtrace などは次に停止したときに応答する).
+        self.call_frames = None
+        self.resuming = True
+        self.send_cdp(STEP_METHODS[step],
+                callback=lambda result, error: self.reply(seq, 'continue'))
+        return
+
+    def dbg_setbp(self, name, lnum, enabled=True, columnNumber=0, \
+            condition=None, ignoreCount=0, tag=None, type='script'):
+        if type == 'function':
+            self.call_soon(tag, self._setfuncbp, name, condition)
+            return
+        self.call_soon(tag, self._setbp, name, int(lnum) - 1, columnNumber,
+                condition, None, enabled)
+        return
+
+    def _setfuncbp(self, seq, expression, condition):
+        """ 関数の先頭にブレイクポイントを設定する.
+
+        停止中は先頭の frame で、それ以外は global で関数の式を評価し、
+        [[FunctionLocation]] の位置へ設定する.
+        """
+        def fail(message):
+            self.reply(seq, 'setbreakpoint', success=False, message=message)
+
+        def set_location(result, error):
+            if error is not None:
+                fail(error.get('message'))
+                return
+            location = None
+            for p in result.get('internalProperties', []):
+                if p['name'] == '[[FunctionLocation]]':
+                    location = p['value']['value']
+            if location is None:
+                fail('%s is not a function' % expression)
+                return
+            params = {'location': location}
+            if condition:
+                params['condition'] = condition
+
+            def callback(result, error):
+                if error is not None:
+                    fail(error.get('message'))
+                    return
+                actual = result['actualLocation']
+                name = self.scripts.get(actual['scriptId'], '')
+                self.bp_id = self.bp_id + 1
+                self.bps[self.bp_id] = {'id': result['breakpointId'],
+                        'name': name, 'line': actual['lineNumber'],
+                        'column': actual.get('columnNumber', 0),
+                        'condition': condition}
+                self.reply(seq, 'setbreakpoint', {
+                    'type': 'function',
+                    'script_name': name,
+                    'breakpoint': self.bp_id,
+                    'actual_locations': [{'line': actual['lineNumber']}]
+                    })
+            self.send_cdp('Debugger.setBreakpoint', params, callback)
+
+        def get_location(result, error):
+            if error is not None:
+                fail(error.get('message'))
+            elif 'exceptionDetails' in result:
+                details = result['exceptionDetails']
+                fail(details.get('exception', {}).get('description',
+                    details.get('text')))
+            elif result['result'].get('type') != 'function':
+                fail('%s is not a function' % expression)
+            else:
+                self.send_cdp('Runtime.getProperties', {
+                    'objectId': result['result']['objectId'],
+                    'ownProperties': True
+                    }, set_location)
+
+        if self.call_frames:
+            self.send_cdp('Debugger.evaluateOnCallFrame', {
+                'callFrameId': self.call_frames[0]['callFrameId'],
+                'expression': expression
+                }, get_location)
+        else:
+            self.send_cdp('Runtime.evaluate', {'expression': expression},
+                    get_location)
+        return
+
+    def _setbp(self, seq, name, line, column, condition, bp_id=None,
+            enabled=True):
+        params = {
+                'urlRegex': name_to_url_regex(name),
+                'lineNumber': line,
+                'columnNumber': column
+                }
+        if condition:
+            params['condition'] = condition
+
+        def callback(result, error):
+            if error is not None:
+                self.reply(seq, 'setbreakpoint', success=False,
+                        message=error.get('message'))
+                return
+            if bp_id is None:
+                # pyclewn の breakpoint の番号は数値なので、番号を割り当てる.
+                self.bp_id = self.bp_id + 1
+                num = self.bp_id
+            else:
+                num = bp_id
+            self.bps[num] = {'id': result['breakpointId'], 'name': name,
+                    'line': line, 'column': column, 'condition': condition}
+            locations = [{'line': l['lineNumber']}
+                    for l in result.get('locations', [])]
+            self.reply(seq, 'setbreakpoint', {
+                'script_name': name,
+                'breakpoint': num,
+                'actual_locations': locations
+                })
+
+        if enabled:
+            self.send_cdp('Debugger.setBreakpointByUrl', params, callback)
+        else:
+            # 無効なものは、有効にされたときに設定する.
+            callback({'breakpointId': None}, None)
+        return
+
+    def dbg_clearbp(self, bp_id):
+        self.call_soon(None, self._clearbp, bp_id)
+        return
+
+    def _clearbp(self, seq, bp_id):
+        bp = self.bps.pop(int(bp_id), None)
+        if bp is not None and bp['id'] is not None:
+            self.send_cdp('Debugger.removeBreakpoint',
+                    {'breakpointId': bp['id']})
+        self.reply(seq, 'clearbreakpoint')
+        return
+
+    def dbg_changebp(self, bp_id, enabled, condition=None, ignoreCount=0):
+        self.call_soon(None, self._changebp, bp_id, enabled)
+        return
+
+    def _changebp(self, seq, bp_id, enabled):
+        """ inspector には breakpoint ごとの無効化がないので、
+        無効化は削除、有効化は再設定で代用する."""
+        bp = self.bps.get(int(bp_id))
+        if bp is not None:
+            if not enabled and bp['id'] is not None:
+                self.send_cdp('Debugger.removeBreakpoint',
+                        {'breakpointId': bp['id']})
+                bp['id'] = None
+            elif enabled and bp['id'] is None:
+                self._setbp(None, bp['name'], bp['line'], bp['column'],
+                        bp['condition'], int(bp_id))
+        self.reply(seq, 'changebreakpoint')
+        return
+
+    def dbg_backtrace(self, inlineRefs=True, tag=None):
+        self.call_soon(tag,
+                lambda seq: self.paused(lambda: self._backtrace(seq)))
+        return
+
+    def _backtrace(self, seq):
+        frames = []
+        index = 0
+        for f in self.call_frames:
+            name = self.scripts.get(f['location']['scriptId'], '')
+            func = f['functionName'] or '(anonymous)'
+            line = f['location']['lineNumber']
+            column = f['location'].get('columnNumber', 0)
+            frames.append({
+                'index': index,
+                'line': line,
+                'column': column,
+                'func': {'name': f['functionName']},
+                'script': {'name': name},
+                'text': '#%02d %s %s line %d column %d' % \
+                        (index, func, name, line + 1, column + 1)
+                })
+            index = index + 1
+        self.reply(seq, 'backtrace', {'frames': frames})
+        return
+
+    def dbg_suspend(self, tag=None):
+        self.call_soon(tag, self._suspend)
+        return
+
+    def _suspend(self, seq):
+        if self.resuming:
+            self.when_resumed.append(lambda: self._suspend(seq))
+            return
+        # 停止するまでに受けた backtrace などは、停止したときの frame で応答する.
+        self.call_frames = None
+        self.pause_requested = True
+        self.send_cdp('Debugger.pause',
+                callback=lambda result, error: self.reply(seq, 'suspend'))
+        return
+
+    def dbg_evaluate(self, expression, frame=0, context=None, tag=None,
+            maxStringLength=PREVIEW_STRING_LENGTH):
+        self.call_soon(tag, self._evaluate, expression, frame, context,
+                maxStringLength)
+        return
+
+    def _evaluate(self, seq, expression, frame, context, max_length):
+        def callback(result, error):
+            if error is not None:
+                self.reply(seq, 'evaluate', success=False,
+                        message=error.get('message'))
+            elif 'exceptionDetails' in result:
+                details = result['exceptionDetails']
+                message = details.get('exception', {}).get('description',
+                        details.get('text'))
+                self.reply(seq, 'evaluate', success=False, message=message)
+            else:
+                body, refs = self.remote_to_body(result['result'], max_length)
+                self.reply(seq, 'evaluate', body, refs=refs)
+
+        if context:
+            # additional_context の名前を引数とする関数として評価する.
+            names = [c['name'] for c in context]
+            args = []
+            for c in context:
+                if c['handle'] in self.strings:
+                    args.append({'value': self.strings[c['handle']]})
+                else:
+                    args.append({'objectId': self.objects.get(c['handle'])})
+            func = 'function (%s) { return eval(%s); }' % \
+                    (', '.join(names), json.dumps(expression))
+            params = {
+                    'functionDeclaration': func,
+                    'arguments': args,
+                    'executionContextId': self.context_id,
+                    'generatePreview': True
+                    }
+            self.send_cdp('Runtime.callFunctionOn', params, callback)
+        elif frame is not None and self.call_frames is not None and \
+                frame < len(self.call_frames):
+            params = {
+                    'callFrameId': self.call_frames[frame]['callFrameId'],
+                    'expression': expression,
+                    'generatePreview': True
+                    }
+            self.send_cdp('Debugger.evaluateOnCallFrame', params, callback)
+        else:
+            params = {
+                    'expression': expression,
+                    'generatePreview': True
+                    }
+            self.send_cdp('Runtime.evaluate', params, callback)
+        return
+
+    def dbg_exceptionbp(self, type, enabled):
+        state = 'none'
+        if enabled:
+            state = type
+        self.send_cdp('Debugger.setPauseOnExceptions', {'state': state})
+        return
+
+    def dbg_scripts(self, ids=None, includeSource=False, tag=None):
+        # 一覧は scriptParsed から手元で作成しているので問い合わせない.
+        self.call_soon(tag, self._scripts, ids, includeSource)
+        return
+
+    def _scripts(self, seq, ids, include_source):
+        scripts = []
+        for script_id, name in self.scripts.items():
+            if ids is not None and int(script_id) not in ids:
+                continue
+            if ids is None and name.startswith('node:'):
+                # Node.js 内部のスクリプトは一覧に含めない.
+                continue
+            script = {'id': int(script_id), 'type': 4}
+            if name:
+                script['name'] = name
+            scripts.append(script)
+
+        if not include_source or len(scripts) == 0:
+            self.reply(seq, 'scripts', scripts)
+            return
+
+        # すべてのソースを受け取ってからまとめて返す.
+        remains = [len(scripts)]
+        def get_source(script):
+            def callback(result, error):
+                if result is not None:
+                    script['source'] = result['scriptSource']
+                remains[0] = remains[0] - 1
+                if remains[0] == 0:
+                    self.reply(seq, 'scripts', scripts)
+            self.send_cdp('Debugger.getScriptSource',
+                    {'scriptId': str(script['id'])}, callback)
+        for script in scripts:
+            get_source(script)
+        return
+
+    def lookup(self, handles, tag=None):
+        self.call_soon(tag, self._lookup, handles)
+        return
+
+    def _lookup(self, seq, handles):
+        body = {}
+        refs = []
+        remains = [len(handles)]
+        if remains[0] == 0:
+            self.reply(seq, 'lookup', body)
+            return
+
+        def get_properties(handle):
+            def callback(result, error):
+                properties = []
+                if result is not None:
+                    for p in self.props_to_properties(result['result']):
+                        # obj_to_properties が参照する refs 形式にする.
+                        ref = dict(p['value'])
+                        self.handle = self.handle + 1
+                        ref['handle'] = ref.pop('ref', self.handle)
+                        properties.append({'name': p['name'],
+                            'ref': ref['handle']})
+                        refs.append(ref)
+                body[str(handle)] = {'handle': handle,
+                        'properties': properties}
+                remains[0] = remains[0] - 1
+                if remains[0] == 0:
+                    self.reply(seq, 'lookup', body, refs=refs)
+            self.send_cdp('Runtime.getProperties', {
+                'objectId': self.objects.get(handle),
+                'ownProperties': True,
+                'generatePreview': True
+                }, callback)
+        for handle in handles:
+            get_properties(handle)
+        return
+
+    def dbg_frame(self, number=None, tag=None):
+        self.call_soon(tag,
+                lambda seq: self.paused(lambda: self._frame(seq, number or 0)))
+        return
+
+    def _frame(self, seq, number):
+        if number >= len(self.call_frames):
+            self.reply(seq, 'frame', success=False, message='No frames')
+            return
+        frame = self.call_frames[number]
+        scopes = []
+        index = 0
+        for scope in frame['scopeChain']:
+            scopes.append({'index': index,
+                'type': SCOPE_TYPES.get(scope['type'], 1)})
+            index = index + 1
+        self.reply(seq, 'frame', {
+            'index': number,
+            'line': frame['location']['lineNumber'],
+            'script': {'name': self.scripts.get(
+                frame['location']['scriptId'], '')},
+            'scopes': scopes
+            })
+        return
+
+    def dbg_scope(self, scopeNumber, frameNumber=None, tag=None):
+        self.call_soon(tag, self._scope, scopeNumber, frameNumber or 0)
+        return
+
+    def _scope(self, seq, number, frame):
+        if self.call_frames is None or frame >= len(self.call_frames) or \
+                number >= len(self.call_frames[frame]['scopeChain']):
+            self.reply(seq, 'scope', success=False, message='No scope')
+            return
+
+        def callback(result, error):
+            if result is None:
+                self.reply(seq, 'scope', success=False,
+                        message=error.get('message'))
+                return
+            self.reply(seq, 'scope', {
+                'index': number,
+                'frameIndex': frame,
+                'object': {
+                    'properties': self.props_to_properties(result['result'])
+                    }
+                })
+
+        scope = self.call_frames[frame]['scopeChain'][number]
+        self.send_cdp('Runtime.getProperties', {
+            'objectId': scope['object']['objectId'],
+            'ownProperties': True,
+            'generatePreview': True
+            }, callback)
+        return
@@ -0,0 +1,162 @@
+# vi:set ts=8 sts=4 sw=4 et tw=80:
+#
+# @author hankei6km
+# @copyright (c) 2013 hankei6km
+# @license MIT License (http://opensource.org/licenses/mit-license.php)
+#
+# nodedbg から起動する Node.js のプロセス.
+# 標準出力と標準エラー出力は asyncore のループでノンブロッキングに読み込む.
+
+import re
+import socket
+import asyncore
+import threading
+import subprocess
+
+NODE_COMMAND = 'node'
+
+# debugger が接続を待ち始めたときに、標準エラー出力へ出力される行.
+# (--debug-brk では 'debugger listening on port 5858'、
+# --inspect-brk では 'Debugger listening on ws://...').
+LISTENING_PATTERN = re.compile(br'debugger listening on', re.IGNORECASE)
+
+# 表示されるまで溜めておく出力の上限(バイト数).
+OUTPUT_MAX = 64 * 1024
+
+# terminate してから終了を待つ秒数(過ぎたら kill する).
+TERMINATE_TIMEOUT = 2
+
+def free_port():
+    """ 空いている TCP のポート番号を取得."""
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+    finally:
+        s.close()
+
+class OutputBuffer():
+    """ プロセスの出力を、表示されるまで溜めておく.
+
+    上限を超えたときは古いものから破棄し、破棄したバイト数を数えておく.
+    """
+    def __init__(self, maxsize=OUTPUT_MAX):
+        self.lock = threading.Lock()
+        self.chunks = []
+        self.size = 0
+        self.maxsize = maxsize
+        self.dropped = 0
+
+    def put(self, data):
+        with self.lock:
+            self.chunks.append(data)
+            self.size = self.size + len(data)
+            while self.size > self.maxsize and len(self.chunks) > 1:
+                old = self.chunks.pop(0)
+                self.size = self.size - len(old)
+                self.dropped = self.dropped + len(old)
+            if self.size > self.maxsize:
+                # 一度に上限を超えて出力されたときは末尾のみ残す.
+                over = self.size - self.maxsize
+                self.chunks[0] = self.chunks[0][over:]
+                self.size = self.maxsize
+                self.dropped = self.dropped + over
+        return
+
+    def drain(self):
+        """ 溜まっている出力を文字列で取り出す(なければ '')."""
+        with self.lock:
+            data = b''.join(self.chunks)
+            dropped = self.dropped
+            self.chunks = []
+            self.size = 0
+            self.dropped = 0
+        text = data.decode('utf-8', 'replace')
+        if dropped > 0:
+            text = '(%d bytes of output dropped)\n' % dropped + text
+        return text
+
+class OutputReader(asyncore.file_dispatcher):
+    """ プロセスの出力のパイプを読み込み、OutputBuffer へ追加する."""
+    def __init__(self, pipe, output, handle_line=None, handle_eof=None):
+        asyncore.file_dispatcher.__init__(self, pipe.fileno())
+        # file_dispatcher は fd を複製するので、元のパイプは閉じておく.
+        pipe.close()
+        self.output = output
+        self.line = b''
+        self._handle_line = handle_line
+        self._handle_eof = handle_eof
+        return
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        data = self.recv(4096)
+        if not data:
+            return
+        self.output.put(data)
+        if self._handle_line is not None:
+            lines = (self.line + data).split(b'\n')
+            # 改行までそろっていない行は、長くなりすぎないように切り詰める.
+            self.line = lines.pop()[-1024:]
+            for line in lines:
+                self._handle_line(line)
+        return
+
+    def handle_close(self):
+        self.close()
+        if self._handle_eof is not None:
+            self._handle_eof()
+        return
+
+class NodeProcess():
+    """ debugger を有効にして起動した Node.js のプロセス.
+
+    handle_ready は debugger が接続を待ち始めたときに、
+    handle_exit は接続を待ち始める前に終了したときに、
+    どちらも asyncore のループのスレッドで呼び出される.
+    """
+    def __init__(self, args, port, inspector, handle_ready, handle_exit):
+        if inspector:
+            option = '--inspect-brk=%d' % port
+        else:
+            option = '--debug-brk=%d' % port
+        self.ready = False
+        self.output = OutputBuffer()
+        self._handle_ready = handle_ready
+        self._handle_exit = handle_exit
+        self.proc = subprocess.Popen([NODE_COMMAND, option] + list(args),
+                stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE)
+        self.readers = [
+                OutputReader(self.proc.stdout, self.output),
+                OutputReader(self.proc.stderr, self.output,
+                    self.handle_stderr_line, self.handle_eof)
+                ]
+        return
+
+    def handle_stderr_line(self, line):
+        if not self.ready and LISTENING_PATTERN.search(line):
+            self.ready = True
+            self._handle_ready()
+        return
+
+    def handle_eof(self):
+        if not self.ready:
+            self._handle_exit()
+        return
+
+    def terminate(self, timeout=TERMINATE_TIMEOUT):
+        """ プロセスを終了させ、終了を待つ(ゾンビにならないように).
+
+        timeout 秒待っても終了しないときは kill する.
+        """
+        if self.proc.poll() is None:
+            self.proc.terminate()
+            try:
+                self.proc.wait(timeout)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+                self.proc.wait()
+        return
@@ -0,0 +1,262 @@
+# vi:set ts=8 sts=4 sw=4 et tw=80:
+#
+# @author hankei6km
+# @copyright (c) 2013 hankei6km
+# @license MIT License (http://opensource.org/licenses/mit-license.php)
+#
+# source map (revision 3) による、生成されたスクリプトと元のソースとの
+# 位置の変換.
+
+import os
+import re
+import json
+import base64
+import bisect
+import urllib.parse
+
+VLQ_CHARS = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/'
+VLQ_VALUES = dict((c, i) for i, c in enumerate(VLQ_CHARS))
+
+SOURCE_MAPPING_URL = re.compile(r'//[#@]\s*sourceMappingURL=(\S+)\s*$')
+
+# sourceMappingURL のコメントを探す、スクリプトの末尾のバイト数.
+TAIL_SIZE = 4096
+
+def decode_vlq(segment):
+    """ Base64 VLQ でエンコードされたセグメントを数値のリストへ変換."""
+    values = []
+    value = 0
+    shift = 0
+    for c in segment:
+        digit = VLQ_VALUES[c]
+        value = value + ((digit & 0x1f) << shift)
+        if digit & 0x20:
+            shift = shift + 5
+        else:
+            if value & 1:
+                values.append(-(value >> 1))
+            else:
+                values.append(value >> 1)
+            value = 0
+            shift = 0
+    return values
+
+class SourceMap():
+    """ 一つの source map.
+
+    mappings は最初に位置を変換するときにデコードし、
+    生成されたスクリプトの行ごとの列のリストと、
+    元のソースごとの (行, 列) のリストとして保持し、二分探索で変換する.
+    行と列は 0 から.
+    """
+    def __init__(self, data, base_dir):
+        root = data.get('sourceRoot') or ''
+        self.sources = []
+        for s in data.get('sources', []):
+            s = root + s if not root or root.endswith('/') else root + '/' + s
+            if s.startswith('file://'):
+                s = urllib.parse.unquote(s[len('file://'):])
+            if not re.match(r'^\w+:', s):
+                s = os.path.normpath(os.path.join(base_dir, s))
+            self.sources.append(s)
+        self.source_index = dict((s, i) for i, s in enumerate(self.sources))
+        self.mappings = data.get('mappings', '')
+        self.decoded = False
+
+    def decode(self):
+        """ mappings をデコードする."""
+        # 生成側: 行ごとに、列と (元のソース, 行, 列) のリスト.
+        self.gen_cols = []
+        self.gen_origs = []
+        # 元のソース側: ソースごとに、(行, 列) と生成側の (行, 列) のリスト.
+        origs = [[] for s in self.sources]
+
+        src = 0
+        oline = 0
+        ocol = 0
+        gline = 0
+        for line in self.mappings.split(';'):
+            cols = []
+            targets = []
+            gcol = 0
+            for segment in line.split(','):
+                if not segment:
+                    continue
+                values = decode_vlq(segment)
+                gcol = gcol + values[0]
+                if len(values) < 4:
+                    continue
+                src = src + values[1]
+                oline = oline + values[2]
+                ocol = ocol + values[3]
+                cols.append(gcol)
+                targets.append((src, oline, ocol))
+                if 0 <= src < len(origs):
+                    origs[src].append((oline, ocol, gline, gcol))
+            self.gen_cols.append(cols)
+            self.gen_origs.append(targets)
+            gline = gline + 1
+
+        # 通常は生成側の順に並んでいるので、元のソース側のみ並べ替える.
+        self.orig_pos = []
+        self.orig_gens = []
+        for o in origs:
+            o.sort()
+            self.orig_pos.append([(l, c) for l, c, gl, gc in o])
+            self.orig_gens.append([(gl, gc) for l, c, gl, gc in o])
+        self.mappings = None
+        self.decoded = True
+        return
+
+    def original(self, line, column=0):
+        """ 生成側の位置から元の (ソース, 行, 列) を取得(なければ None)."""
+        if not self.decoded:
+            self.decode()
+        if line >= len(self.gen_cols):
+            return None
+        cols = self.gen_cols[line]
+        i = bisect.bisect_right(cols, column) - 1
+        if i < 0:
+            # 行の先頭より前の列のときは、行の最初の mapping を使う.
+            if len(cols) == 0:
+                return None
+            i = 0
+        src, oline, ocol = self.gen_origs[line][i]
+        return self.sources[src], oline, ocol
+
+    def generated(self, source, line):
+        """ 元のソースの行から、生成側の (行, 列) を取得(なければ None).
+
+        その行に mapping がないときは、それ以降で最初の mapping を使う.
+        """
+        if source not in self.source_index:
+            return None
+        if not self.decoded:
+            self.decode()
+        src = self.source_index[source]
+        pos = self.orig_pos[src]
+        i = bisect.bisect_left(pos, (line, 0))
+        if i >= len(pos):
+            return None
+        return self.orig_gens[src][i]
+
+class SourceMaps():
+    """ スクリプトごとの source map のキャッシュ.
+
+    スクリプトのファイルの mtime が変わったときは読み込みなおす
+    (ファイルがなかったスクリプトは、stat しなおさない).
+    また、元のソースから生成されたスクリプトを引けるようにしておく.
+    """
+    def __init__(self):
+        self.maps = {}
+        self.generated_dict = {}
+
+    def load(self, path):
+        """ スクリプトの source map を取得(なければ None)."""
+        if path in self.maps and self.maps[path][0] is None:
+            return None
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            self.maps[path] = (None, None)
+            return None
+        if path in self.maps and self.maps[path][0] == mtime:
+            return self.maps[path][1]
+
+        smap = None
+        try:
+            data = self.read_map(path)
+            if data is not None:
+                smap = SourceMap(data, os.path.dirname(path))
+        except (OSError, ValueError, KeyError, TypeError):
+            smap = None
+        self.maps[path] = (mtime, smap)
+        if smap is not None:
+            for s in smap.sources:
+                self.generated_dict.setdefault(s, set()).add(path)
+        return smap
+
+    def get(self, path):
+        """ デコード済の source map を取得(なければ、壊れていれば None).
+
+        mappings が壊れているときは、その source map を使わない
+        (スクリプトが更新されたら読み込みなおす).
+        """
+        smap = self.load(path)
+        if smap is not None and not smap.decoded:
+            try:
+                smap.decode()
+            except (KeyError, IndexError):
+                self.maps[path] = (self.maps[path][0], None)
+                smap = None
+        return smap
+
+    def read_map(self, path):
+        """ sourceMappingURL のコメントから source map を読み込む."""
+        with open(path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            f.seek(max(0, f.tell() - TAIL_SIZE))
+            tail = f.read().decode('utf-8', 'replace')
+        url = None
+        for line in reversed(tail.rstrip().splitlines()[-3:]):
+            m = SOURCE_MAPPING_URL.search(line)
+            if m:
+                url = m.group(1)
+                break
+        if url is None:
+            if not os.path.exists(path + '.map'):
+                return None
+            url = os.path.basename(path) + '.map'
+
+        if url.startswith('data:'):
+            meta, _, payload = url.partition(',')
+            if meta.endswith(';base64'):
+                payload = base64.b64decode(payload).decode('utf-8')
+            else:
+                payload = urllib.parse.unquote(payload)
+            return json.loads(payload)
+        map_path = os.path.join(os.path.dirname(path),
+                urllib.parse.unquote(url))
+        with open(map_path, encoding='utf-8') as f:
+            return json.load(f)
+
+    def add_scripts(self, names):
+        """ 新しくロードされたスクリプトの source map を読み込んでおく.
+
+        読み込み済(ファイルがなかったものも含む)のスクリプトは飛ばす.
+        source map を持つスクリプトがあったときは True を返す.
+        """
+        loaded = False
+        for name in names:
+            if os.path.isabs(name) and name not in self.maps:
+                if self.load(name) is not None:
+                    loaded = True
+        return loaded
+
+    def to_original(self, name, lnum):
+        """ 生成されたスクリプトの位置を元のソースの位置へ変換する.
+
+        lnum は 1 から. 変換できないときはそのまま返す.
+        """
+        if name is None or not os.path.isabs(name):
+            return name, lnum
+        smap = self.get(name)
+        if smap is not None:
+            pos = smap.original(int(lnum) - 1)
+            if pos is not None and os.path.isabs(pos[0]):
+                return pos[0], pos[1] + 1
+        return name, lnum
+
+    def to_generated(self, name, lnum):
+        """ 元のソースの位置を生成されたスクリプトの位置へ変換する.
+
+        lnum は 1 から. 変換できないときはそのまま返す.
+        """
+        for path in sorted(self.generated_dict.get(name, ())):
+            smap = self.get(path)
+            if smap is None:
+                continue
+            pos = smap.generated(name, int(lnum) - 1)
+            if pos is not None:
+                return path, pos[0] + 1
+        return name, lnum
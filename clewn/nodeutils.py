@@ -5,37 +5,130 @@
 # @license MIT License (http://opensource.org/licenses/mit-license.php)
 #
 
+import os
+import re
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import importlib
+import threading
+from collections import OrderedDict
+
+# シンボルのインデックスなどのキャッシュを置くディレクトリ.
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.pyclewn_nodedbg')
+
+# logpoint の記録を溜めておく target 側の変数と、その上限など.
+LOGPOINT_VAR = 'global.__nodedbg_logpoints'
+LOGPOINT_MAX = 10000
+LOGPOINT_MSG_MAX = 160
+LOGPOINT_DRAIN_MAX = 500
+
+# Scripts.resolve で、一つに決まらないときに返す候補の数.
+SCRIPTS_AMBIGUOUS_MAX = 10
+
+def is_absolute(name):
+    """ スクリプト名が絶対パスか(Windows の 'C:\\foo.js' なども含む)."""
+    return os.path.isabs(name) or \
+            re.match(r'^[A-Za-z]:[\\/]', name) is not None
+
+class JsonCodec():
+    """ debugger とやりとりする JSON のエンコードとデコード.
+
+    高速な orjson か ujson がインストールされていればそれを使い、
+    なければ標準の json を使う. dumps は bytes を返す.
+    """
+    CODECS = ('orjson', 'ujson', 'json')
+
+    def __init__(self, name=None):
+        if not name or not self.use(name):
+            self.use()
+
+    def use(self, name=None):
+        """ name (省略時は使えるもののうち最初のもの)を使う."""
+        for n in ([name] if name else self.CODECS):
+            if n not in self.CODECS:
+                continue
+            try:
+                module = importlib.import_module(n)
+            except ImportError:
+                continue
+            self.name = n
+            self.loads = module.loads
+            if n == 'orjson':
+                self.dumps = module.dumps
+            else:
+                self.dumps = lambda obj, dumps=module.dumps: \
+                        dumps(obj).encode()
+            return True
+        return False
+
+# 環境変数 PYCLEWN_NODEDBG_JSON で codec を指定できる(json, ujson, orjson).
+json_codec = JsonCodec(os.environ.get('PYCLEWN_NODEDBG_JSON'))
+
 def parse_headers(resp):
     """ Node.js のレスポンスのヘッダをパース.
 
-    TODO: とりあえずで作ったので、まともな方法を考えること.
+    値に ':' を含むヘッダ(Embedding-Host など)もあるので、最初の ':' で分ける.
+    ':' のない行(空行など)は無視する.
     """
 
     ret = {}
     header_lines = resp.split('\r\n')
     for line in header_lines:
-        k, v = line.split(':')
-        ret[k] = v
+        k, sep, v = line.partition(':')
+        if sep:
+            ret[k.strip()] = v.strip()
 
     return ret
 
+def _mirror_text(mirror):
+    """ inlineRefs で text が省略された値の表示用文字列."""
+
+    if mirror['type'] in ('undefined', 'null'):
+        return mirror['type']
+    elif mirror['type'] == 'boolean':
+        return 'true' if mirror.get('value') else 'false'
+    elif mirror['type'] == 'number':
+        value = mirror.get('value')
+        if isinstance(value, float) and value.is_integer():
+            value = int(value)
+        return str(value)
+    return str(mirror.get('value', ''))
+
+def _prop_mirror(p, refs_dict):
+    """ プロパティの値(inlineRefs のときはプロパティ内、
+    そうでなければ refs 内にある)を取得."""
+
+    if isinstance(p.get('value'), dict):
+        mirror = dict(p['value'])
+        mirror.setdefault('handle', mirror.get('ref'))
+        if 'text' not in mirror:
+            mirror['text'] = _mirror_text(mirror)
+        return mirror
+    return refs_dict.get(p.get('ref'))
+
+def _refs_dict(refs):
+    return dict((r['handle'], r) for r in refs)
+
 def _obj_to_print(className, properties, refs):
     """ プロパティを持っている場合の変換 ."""
 
     ret = ''
+    refs_dict = _refs_dict(refs)
     for p in properties:
-        for r in refs:
-            if p['ref'] == r['handle']:
-                text = r['text']
-                if r['type'] == 'object':
-                    if r['className'] == 'Array':
-                        text = '#<Array>'
-                    else:
-                        text = '#<Object>'
-                elif r['type'] == 'function':
-                    text = '#<Function>'
-                ret = ret + ' ' + str(p['name']) + ': ' + text + '\n'
-                break
+        r = _prop_mirror(p, refs_dict)
+        if r is not None:
+            text = r['text']
+            if r['type'] == 'object':
+                if r.get('className') == 'Array':
+                    text = '#<Array>'
+                else:
+                    text = '#<Object>'
+            elif r['type'] == 'function':
+                text = '#<Function>'
+            ret = ret + ' ' + str(p['name']) + ': ' + text + '\n'
     if className == 'Array':
         ret = '[\n' + ret + ']'
     else:
@@ -49,14 +142,101 @@ def obj_to_print(data):
     if data['body']['type'] == 'object':
         ret = _obj_to_print(
                 data['body']['className'],
-                data['body']['properties'],
-                data['refs'])
+                data['body'].get('properties', []),
+                data.get('refs') or [])
     elif data['body']['type'] == 'function':
         ret  = '#<Function>'
+    elif data['body']['type'] == 'string' and 'value' in data['body']:
+        # text は短く切り詰められているので value を使う.
+        ret = data['body']['value']
     else:
         ret = data['body']['text']
     return ret
 
+# target 側でオブジェクトを展開する関数.
+# 循環参照、深さ、要素数、文字列の長さを制限し、JSON 文字列で返す.
+SERIALIZE_SIZE = 500
+SERIALIZE_STRING_MAX = 100
+SERIALIZE_FUNC = (
+    'function (root, depth, size, smax) { '
+    'var count = 0, stack = []; '
+    'function ser(v, d) { '
+        'count++; '
+        'if (typeof v === "function") { return {v: "#<Function>"}; } '
+        'if (v === null || typeof v !== "object") { '
+            'if (typeof v === "string") { '
+                'return {v: JSON.stringify(v.length > smax ? '
+                    'v.slice(0, smax) + "..." : v)}; } '
+            'return {v: String(v)}; } '
+        'if (stack.indexOf(v) >= 0) { return {v: "#<Circular>"}; } '
+        'var a = Array.isArray(v); '
+        'var c = a ? "Array" : (v.constructor && v.constructor.name) || "Object"; '
+        'if (d <= 0 || count >= size) { return {v: "#<" + c + ">"}; } '
+        'var keys = Object.keys(v), p = [], i, x; '
+        'stack.push(v); '
+        'for (i = 0; i < keys.length && count < size; i++) { '
+            'try { x = ser(v[keys[i]], d - 1); } '
+            'catch (e) { x = {v: "<error: " + e + ">"}; } '
+            'p.push([keys[i], x]); } '
+        'stack.pop(); '
+        'return {c: c, a: a, p: p, more: keys.length - p.length}; } '
+    'return JSON.stringify(ser(root, depth)); }')
+
+def serialize_expr(expression, depth):
+    """ expression の値を depth の深さまで展開して返す式."""
+    return '(%s)((%s), %d, %d, %d)' % (SERIALIZE_FUNC,
+            expression.rstrip().rstrip(';'), depth, SERIALIZE_SIZE,
+            SERIALIZE_STRING_MAX)
+
+def _serialized_to_print(node, depth):
+    if 'v' in node:
+        return node['v']
+
+    ret = ''
+    indent = ' ' * (depth + 1)
+    for name, child in node['p']:
+        ret = ret + indent + str(name) + ': ' + \
+                _serialized_to_print(child, depth + 1) + '\n'
+    if node['more'] > 0:
+        ret = ret + indent + '... (%d more)\n' % node['more']
+    if node['a']:
+        ret = '[\n' + ret + ' ' * depth + ']'
+    else:
+        ret = '{\n' + ret + ' ' * depth + '}'
+    if node['c'] not in ('Object', 'Array'):
+        ret = node['c'] + ' ' + ret
+    return ret
+
+def serialized_to_print(data):
+    """ serialize_expr の evaluate のレスポンスを表示用文字列に変換.
+
+    結果が切り詰められている(JSON として読めない)ときは、その旨の 1 行.
+    """
+    body = data['body']
+    remains = string_remains(body)
+    if remains is not None:
+        return 'Serialization truncated (%d of %d characters), ' \
+                'try a smaller depth.' % (remains['next'], remains['total'])
+    try:
+        return _serialized_to_print(json.loads(body['value']), 0)
+    except (KeyError, TypeError, ValueError):
+        return 'Cannot decode the serialized value.'
+
+def string_remains(body):
+    """ evaluate の結果が切り詰められた文字列のとき、
+    続きを取得するための情報を返す(そうでなければ None)."""
+
+    ret = None
+    if body['type'] == 'string' and 'value' in body and 'handle' in body:
+        total = body.get('length', len(body['value']))
+        if total > len(body['value']):
+            ret = {
+                    'handle': body['handle'],
+                    'next': len(body['value']),
+                    'total': total
+                    }
+    return ret
+
 def obj_to_properties(in_data, in_body, handle):
     """ Node.js のオブジェクトをref含みのproperties形式へ変換."""
 
@@ -65,45 +245,361 @@ def obj_to_properties(in_data, in_body, handle):
     body = in_body
     if 'properties' in body:
         properties = body['properties']
-        refs = data['refs']
+        refs_dict = _refs_dict(data.get('refs') or [])
         for p in properties:
             value = {}
-            for r in refs:
-                if p['ref'] == r['handle']:
-                    if 'value' in r:
-                        value['value'] = r['value']
-                    if 'className' in r:
-                        value['className'] = r['className']
-                    value['type'] = r['type']
-                    value['ref'] = r['handle']
-                    ret.append({
-                        'name': p['name'],
-                        'value': value
-                        })
-                    break
+            r = _prop_mirror(p, refs_dict)
+            if r is not None:
+                if 'value' in r:
+                    value['value'] = r['value']
+                if 'className' in r:
+                    value['className'] = r['className']
+                value['type'] = r['type']
+                value['ref'] = r['handle']
+                ret.append({
+                    'name': p['name'],
+                    'value': value
+                    })
 
     return ret
 
+# quickfix の行('fname:lnum:col: text' または quickfix ウィンドウの
+# 'fname|lnum col 3| text').
+QUICKFIX_PATTERN = re.compile(r'^(.+?)[:|](\d+)(?:[:|\s]|$)')
+
+def quickfix_locations(lines):
+    """ quickfix 形式の行から (ファイル名, 行番号) の一覧を取得.
+
+    位置のない行は無視し、重複は除く.
+    """
+    ret = []
+    seen = set()
+    for line in lines:
+        m = QUICKFIX_PATTERN.match(line.strip())
+        if m:
+            loc = (os.path.abspath(m.group(1)), int(m.group(2)))
+            if loc not in seen:
+                seen.add(loc)
+                ret.append(loc)
+    return ret
+
+def frame_location(data):
+    """ frame のレスポンスから (スクリプト名, 行番号(1 から)) を取得."""
+
+    body = data['body']
+    script = body.get('script') or {}
+    name = script.get('name')
+    if name is None and 'ref' in script:
+        name = _refs_dict(data.get('refs') or []).get(script['ref'],
+                {}).get('name')
+    return name, body.get('line', -1) + 1
+
+def logpoint_condition(label, template):
+    """ logpoint 用の breakpoint の condition を作成.
+
+    template 内の {expr} を評価した結果で組み立てたメッセージを
+    target 側のバッファへ追加し、condition としては常に false を返す.
+    バッファが上限に達しているときは、破棄した件数のみ数えておく.
+    """
+
+    parts = [json.dumps(label + ': ')]
+    for i, s in enumerate(re.split(r'\{([^{}]*)\}', template)):
+        if i % 2:
+            parts.append('(' + s + ')')
+        elif s:
+            parts.append(json.dumps(s))
+    msg = '(%s).slice(0, %d)' % (' + '.join(parts), LOGPOINT_MSG_MAX)
+
+    buf = LOGPOINT_VAR
+    return ('((%s = %s || []).length < %d ? %s.push(%s) : '
+            '(%s.dropped = (%s.dropped || 0) + 1)) && false') % \
+            (buf, buf, LOGPOINT_MAX, buf, msg, buf, buf)
+
+def logpoint_drain_expr():
+    """ target 側に溜まっている logpoint の記録を取り出す式.
+
+    一度に取り出す件数は LOGPOINT_DRAIN_MAX までとし、
+    結果は JSON 文字列で返す.
+    """
+
+    buf = LOGPOINT_VAR
+    return ('(function () { var b = %s; if (!b) { return ""; } '
+            'var r = {records: b.splice(0, %d), dropped: b.dropped || 0}; '
+            'b.dropped = 0; return JSON.stringify(r); })()') % \
+            (buf, LOGPOINT_DRAIN_MAX)
+
+def logpoint_records(data):
+    """ logpoint_drain_expr の evaluate のレスポンスから記録を取り出す."""
+
+    records = []
+    dropped = 0
+    if data['success'] and data['body'].get('value'):
+        r = json.loads(data['body']['value'])
+        records = r['records']
+        dropped = r['dropped']
+    return records, dropped
+
+# watch の値を表示用文字列へ変換する target 側の関数.
+WATCH_VALUE_MAX = 200
+WATCH_REPR = ('function (g) { try { var v = g(); } '
+        'catch (e) { return "<error: " + e + ">"; } '
+        'if (typeof v === "function") { return "#<Function>"; } '
+        'if (v !== null && typeof v === "object") { '
+        'return Array.isArray(v) ? "#<Array>" : "#<Object>"; } '
+        'return String(v).slice(0, %d); }') % WATCH_VALUE_MAX
+
+def watch_expr(exprs):
+    """ 複数の watch 式をまとめて評価する式.
+
+    結果は各 watch 式の値の表示用文字列の配列を JSON 文字列にしたもの.
+    """
+
+    funcs = []
+    for expr in exprs:
+        funcs.append('f(function () { return (%s); })' % expr.rstrip().rstrip(';'))
+    return '(function (f) { return JSON.stringify([%s]); })(%s)' % \
+            (', '.join(funcs), WATCH_REPR)
+
+def watch_values(data):
+    """ watch_expr の evaluate のレスポンスから値の一覧を取り出す."""
+
+    if data['success']:
+        return json.loads(data['body']['value'])
+    else:
+        return None
+
+class EventQueue():
+    """ NodeTarget から NodeDbg へ item を渡すキュー.
+
+    同じ対象への更新(properties, scope など)は最新のもののみ残し、
+    古い停止時(gen)の item は破棄する. 上限を超えたときは、
+    古い停止時の item をまとめて破棄する. 現在の停止時の item は、
+    表示に必要なものなので上限を超えても破棄しない
+    (対象ごとにまとめられるので、際限なく増えることはない).
+    """
+    def __init__(self, maxsize=1000):
+        self.lock = threading.Lock()
+        self.items = OrderedDict()
+        self.maxsize = maxsize
+        self.serial = 0
+        self.gen = 0
+        self.dropped = 0
+
+    def _get_key(self, item):
+        """ まとめてもよい item には、まとめる単位のキーを返す."""
+        t = item['type']
+        if t == 'properties':
+            return (t, item.get('frame', 0), item['handle'])
+        elif t == 'scope' and 'body' in item:
+            return (t, item.get('frame', 0), item['body']['index'])
+        elif t == 'frame':
+            return (t, item.get('frame', 0))
+        elif t in ('scripts', 'watch'):
+            return (t,)
+        # まとめられない item(break や print など).
+        self.serial = self.serial + 1
+        return (None, self.serial)
+
+    def _is_stale(self, item):
+        return 'gen' in item and item['gen'] < self.gen
+
+    def put(self, item):
+        with self.lock:
+            if self._is_stale(item):
+                self.dropped = self.dropped + 1
+                return
+            key = self._get_key(item)
+            if key in self.items:
+                # 古い方を削除して、新しい方を末尾へ.
+                del self.items[key]
+                self.dropped = self.dropped + 1
+            elif len(self.items) >= self.maxsize:
+                stale = [k for k, v in self.items.items()
+                        if self._is_stale(v)]
+                for k in stale:
+                    del self.items[k]
+                self.dropped = self.dropped + len(stale)
+            self.items[key] = item
+        return
+
+    def set_gen(self, gen):
+        """ 停止するたびに呼び出し、以前の停止時の item を無効にする."""
+        with self.lock:
+            self.gen = gen
+        return
+
+    def drain(self):
+        """ 溜まっている item をすべて取り出す."""
+        with self.lock:
+            ret = [i for i in self.items.values() if not self._is_stale(i)]
+            self.dropped = self.dropped + len(self.items) - len(ret)
+            self.items = OrderedDict()
+        return ret
+
+    def empty(self):
+        return len(self.items) == 0
+
+def journal_path(project_dir, cache_dir=os.path.join(CACHE_DIR,
+    'breakpoints')):
+    """ プロジェクト(ディレクトリ)ごとのブレイクポイントの保存先."""
+    key = hashlib.sha1(os.path.abspath(project_dir).encode()).hexdigest()
+    return os.path.join(cache_dir, key[:12] + '.jsonl')
+
+class BreakPointJournal():
+    """ ブレイクポイントの保存.
+
+    変更のたびに、その位置の状態を 1 行の JSON として追記していき、
+    読み込むときに最後の状態のみを取り出す.
+    追記した行が増えすぎたときは、読み込み時に書きなおして小さくする.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.saved = OrderedDict()
+        self.lines = 0
+
+    def load(self):
+        """ 保存されていた [key, condition, log, enabled] の一覧."""
+        self.saved = OrderedDict()
+        self.lines = 0
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        rec = json.loads(line)
+                    except ValueError:
+                        # 書き込み途中で終了した行など.
+                        continue
+                    self.lines = self.lines + 1
+                    self.saved.pop(rec[0], None)
+                    if len(rec) > 1:
+                        self.saved[rec[0]] = rec[1:]
+        except (IOError, OSError):
+            pass
+        if self.lines > len(self.saved) * 2 + 32:
+            self.compact()
+        return [[k] + v for k, v in self.saved.items()]
+
+    def compact(self):
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path + '.tmp', 'w') as f:
+                for k, v in self.saved.items():
+                    f.write(json.dumps([k] + v) + '\n')
+            os.replace(self.path + '.tmp', self.path)
+            self.lines = len(self.saved)
+        except (IOError, OSError):
+            pass
+        return
+
+    def write(self, key, state):
+        """ key の位置の状態を追記する(state が None のときは削除)."""
+        if self.saved.get(key) == state:
+            return
+        if state is None:
+            del self.saved[key]
+            rec = [key]
+        else:
+            self.saved[key] = state
+            rec = [key] + state
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(rec) + '\n')
+            self.lines = self.lines + 1
+        except (IOError, OSError):
+            pass
+        return
+
 class BreakPoints():
     def __init__(self):
         self.bp_dict = {}
+        self.journal = None
 
     def _get_key(self, name, lnum):
         return str(lnum) + ':' + name
 
     def _get_name_lnum_from_key(self, key):
-        lnum, name = key.split(':', 2)
+        # ファイル名に ':' が含まれることもある('C:\\foo.js' など).
+        lnum, name = key.split(':', 1)
         return name,  lnum
 
-    def add(self, bp_id, name, lnum):
-        self.bp_dict[self._get_key(name, lnum)] = {'bp_id': bp_id}
+    def add(self, bp_id, name, lnum, condition=None, log=None):
+        """ ブレイクポイントを追加.
+
+        すでに同じ位置にあるときは、condition などの情報は引き継ぐ.
+        """
+        bp = self.bp_dict.setdefault(self._get_key(name, lnum), {})
+        bp['bp_id'] = bp_id
+        if condition is not None:
+            bp['condition'] = condition
+        if log is not None:
+            bp['log'] = log
         return
 
-    def add_standby(self, bp_id, name, lnum):
-        self.add(bp_id, name, lnum)
+    def add_standby(self, bp_id, name, lnum, condition=None, log=None):
+        self.add(bp_id, name, lnum, condition, log)
         self.set_standby(name, lnum)
+        self._persist(self._get_key(name, lnum))
+        return
+
+    def _persist(self, key):
+        """ ユーザーが変更した位置の状態を保存する."""
+        if self.journal is not None:
+            state = None
+            if key in self.bp_dict:
+                bp = self.bp_dict[key]
+                state = [bp.get('condition'), bp.get('log'),
+                        bp.get('enabled', True)]
+            self.journal.write(key, state)
+        return
+
+    def save(self, name, lnum):
+        """ debugger が位置を決めたブレイクポイント(関数のものなど)を保存する.
+
+        次からは、その位置のブレイクポイントとして復元される.
+        """
+        self._persist(self._get_key(name, lnum))
+        return
+
+    def open_journal(self, journal):
+        """ 保存されていたブレイクポイントの一覧を取得.
+
+        保存先は、取得したものを復元し終えてから set_journal で設定する
+        (復元のための変更を追記しないように).
+        """
+        ret = []
+        for key, condition, log, enabled in journal.load():
+            name, lnum = self._get_name_lnum_from_key(key)
+            ret.append({'name': name, 'lnum': lnum, 'condition': condition,
+                'log': log, 'enabled': enabled})
+        return ret
+
+    def set_journal(self, journal):
+        """ 以降の変更の保存先を設定する."""
+        self.journal = journal
         return
 
+    def relocate(self, name, lnum, actual_lnum):
+        """ debugger が位置を変更したときに、保存している位置も変更する."""
+        key = self._get_key(name, lnum)
+        if str(lnum) != str(actual_lnum) and self.journal is not None and \
+                key in self.journal.saved:
+            self.journal.write(key, None)
+            self._persist(self._get_key(name, actual_lnum))
+        return
+
+    def set_enabled(self, bp_id, enabled):
+        name, lnum = self.get_name_lnum(bp_id)
+        if name is not None:
+            key = self._get_key(name, lnum)
+            self.bp_dict[key]['enabled'] = enabled
+            self._persist(key)
+        return
+
+    def is_enabled(self, name, lnum):
+        bp = self.bp_dict.get(self._get_key(name, lnum), {})
+        return bp.get('enabled', True)
+
     def remove(self, bp_id):
         name, lnum = self.get_name_lnum(bp_id)
         if name is not None:
@@ -111,21 +607,68 @@ class BreakPoints():
 
     def remove(self, name, lnum):
         del self.bp_dict[self._get_key(name, lnum)]
+        self._persist(self._get_key(name, lnum))
 
     def remove_all(self):
         self.bp_dict = {}
         return
 
     def get_standby_bps(self, scripts):
-        """ standby 状態のブレイクポイントで、ロード済スクリプトが対象のもの """
+        """ standby 状態のブレイクポイントで、ロード済スクリプトが対象のもの
+
+        スクリプト名が末尾の一部のみのときは、ロード済スクリプトのいずれか
+        一つに決まったときに、そのスクリプト名へ変更する.
+        絶対パスのものは、そのスクリプトがロードされるまで standby のままにする.
+        """
         ret = []
-        for k, v in self.bp_dict.items():
+        for k, v in list(self.bp_dict.items()):
             if 'standby' in v:
                 name, lnum = self._get_name_lnum_from_key(k)
-                if scripts.exist(name):
-                    ret.append({'name': name, 'lnum':lnum, 'bp_id': v['bp_id']})
+                if not scripts.exist(name):
+                    resolved = scripts.resolve(name)[0]
+                    if resolved is None:
+                        continue
+                    self.rename(name, lnum, resolved)
+                    name = resolved
+                ret.append({'name': name, 'lnum':lnum, 'bp_id': v['bp_id'],
+                    'condition': v.get('condition'), 'log': v.get('log'),
+                    'enabled': v.get('enabled', True)})
         return ret
 
+    def map_standby(self, to_generated):
+        """ standby 状態のブレイクポイントの位置を to_generated で変換する.
+
+        元のソース(.ts など)へ設定していたものを、その source map を持つ
+        スクリプトがロードされたときに、生成されたスクリプトの位置へ移す.
+        """
+        for k, v in list(self.bp_dict.items()):
+            if 'standby' in v:
+                name, lnum = self._get_name_lnum_from_key(k)
+                new_name, new_lnum = to_generated(name, lnum)
+                if new_name != name or str(new_lnum) != str(lnum):
+                    self.rename(name, lnum, new_name, new_lnum)
+        return
+
+    def rename(self, name, lnum, new_name, new_lnum=None):
+        """ ブレイクポイントのスクリプト名(と行)を変更する."""
+        if new_lnum is None:
+            new_lnum = lnum
+        key = self._get_key(name, lnum)
+        new_key = self._get_key(new_name, new_lnum)
+        if key in self.bp_dict:
+            bp = self.bp_dict.pop(key)
+            # 変更先にすでにあるときは、そちらを残す.
+            self.bp_dict.setdefault(new_key, bp)
+            self._persist(key)
+            self._persist(new_key)
+        return
+
+    def has_logpoints(self):
+        for v in self.bp_dict.values():
+            if 'log' in v:
+                return True
+        return False
+
 
     def set_standby(self, name, lnum):
         key = self._get_key(name, lnum)
@@ -166,23 +709,401 @@ class BreakPoints():
             return None, None
     
 class Scripts():
-    """ ロード済スクリプトの一覧 """
+    """ ロード済スクリプトの一覧
+
+    'lib/foo.js' のような末尾の一部のみのスクリプト名からも引けるように、
+    パスの要素を末尾から順にたどる trie を、スクリプトの増減にあわせて
+    更新しておく. trie のノードは [子ノードの dict, 配下のスクリプトの数,
+    このノードで終わるスクリプト名のリスト].
+    """
     def __init__(self):
         self.scripts_dict = {}
+        self.trie = [{}, 0, []]
 
     def remove_all(self):
         self.scripts_dict = {}
+        self.trie = [{}, 0, []]
         return
 
     def set_scripts(self, scripts_resp_body):
-        self.remove_all()
+        """ スクリプトの一覧を更新し、新しくロードされたものの名前を返す."""
+        scripts = {}
         for i in scripts_resp_body:
             if 'name' in i:
-                self.scripts_dict[i['name']] ={'type': i['type']}
+                scripts[i['name']] ={'type': i['type'], 'id': i['id']}
+        # 変化したスクリプトのみ trie を更新する.
+        for name in self.scripts_dict.keys() - scripts.keys():
+            self._trie_remove(name)
+        added = list(scripts.keys() - self.scripts_dict.keys())
+        for name in added:
+            self._trie_add(name)
+        self.scripts_dict = scripts
+        return added
+
+    def _segments(self, name):
+        """ パスの要素を末尾から並べたリスト."""
+        return [s for s in reversed(name.replace('\\', '/').split('/'))
+                if s and s != '.']
+
+    def _trie_add(self, name):
+        node = self.trie
+        node[1] = node[1] + 1
+        for s in self._segments(name):
+            node = node[0].setdefault(s, [{}, 0, []])
+            node[1] = node[1] + 1
+        node[2].append(name)
+        return
+
+    def _trie_remove(self, name):
+        node = self.trie
+        node[1] = node[1] - 1
+        for s in self._segments(name):
+            child = node[0][s]
+            child[1] = child[1] - 1
+            if child[1] == 0:
+                # 配下にスクリプトがなくなったノードは削除する.
+                del node[0][s]
+                return
+            node = child
+        node[2].remove(name)
         return
 
+    def resolve(self, name, limit=SCRIPTS_AMBIGUOUS_MAX):
+        """ スクリプト名(末尾の一部でもよい)からロード済スクリプトを引く.
+
+        (スクリプト名, 候補のリスト)を返す. 一つに決まらないときの
+        スクリプト名は None で、候補は最大 limit 個.
+        絶対パスは末尾の一部として扱わず、同じスクリプトのみを引く.
+        """
+        if name in self.scripts_dict:
+            return name, [name]
+        if is_absolute(name):
+            # 別のディレクトリの同名のスクリプトにはしない
+            # (そのスクリプトがロードされるまで決めない).
+            return None, []
+        node = self.trie
+        for s in self._segments(name):
+            node = node[0].get(s)
+            if node is None:
+                return None, []
+        if node[1] == 0:
+            return None, []
+
+        candidates = []
+        stack = [node]
+        while stack and len(candidates) < limit:
+            n = stack.pop()
+            candidates.extend(n[2])
+            stack.extend(n[0].values())
+        candidates = sorted(candidates[:limit])
+        if node[1] == 1:
+            return candidates[0], candidates
+        return None, candidates
+
+    def ids(self):
+        return [v['id'] for v in self.scripts_dict.values()]
+
+    def names(self):
+        return list(self.scripts_dict.keys())
+
     def exist(self, name):
         if name in self.scripts_dict:
             return True
         else:
             return False
+
+    def name_of(self, script_id):
+        """ script id からスクリプト名を取得(なければ None)."""
+        for name, v in self.scripts_dict.items():
+            if v['id'] == script_id:
+                return name
+        return None
+
+class SourceCache():
+    """ ローカルにファイルがないスクリプト(node.js 内部のモジュールや eval
+    されたコードなど)のソースのキャッシュ.
+
+    ソースは Vim で表示できるように読み込み専用のファイルとして保存し、
+    script id からそのパスを引けるようにしておく.
+    """
+    def __init__(self):
+        self.tmpdir = None
+        self.path_dict = {}
+
+    def reset(self):
+        """ 接続しなおしたときなど、script id が変わるときに呼び出す."""
+        self.path_dict = {}
+        return
+
+    def get(self, script_id):
+        return self.path_dict.get(script_id)
+
+    def close(self):
+        """ 保存したソースをディレクトリごと削除する."""
+        def make_writable(func, path, exc_info):
+            # 読み込み専用のファイルも削除できるようにする(Windows など).
+            os.chmod(path, 0o644)
+            func(path)
+
+        if self.tmpdir is not None:
+            shutil.rmtree(self.tmpdir, onerror=make_writable)
+            self.tmpdir = None
+        self.path_dict = {}
+        return
+
+    def add(self, script_id, name, source):
+        """ ソースを保存し、そのパスを返す."""
+
+        if self.tmpdir is None:
+            self.tmpdir = tempfile.mkdtemp(prefix='nodedbg-')
+        if not name:
+            name = '[eval %d].js' % script_id
+        # 内容が同じなら接続しなおした後でも同じファイルを使う.
+        key = hashlib.sha1(source.encode('utf-8', 'surrogatepass')) \
+                .hexdigest()[:12]
+        path = os.path.join(self.tmpdir, key, os.path.basename(name))
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # ロケールによらず UTF-8 で保存する(JavaScript の文字列には
+            # 対になっていないサロゲートも含まれうるので、それは置き換える).
+            with open(path, 'w', encoding='utf-8', errors='replace') as f:
+                f.write(source)
+            os.chmod(path, 0o444)
+        self.path_dict[script_id] = path
+        return path
+
+# 関数定義とみなす行のパターン.
+# function foo(...) / foo = function / foo: function / Foo.prototype.foo = function
+SYMBOL_PATTERNS = [
+        re.compile(r'\bfunction\s+([\w$]+)\s*\('),
+        re.compile(r'([\w$]+(?:\.[\w$]+)*)\s*[:=]\s*function\b'),
+        ]
+
+def parse_symbols(source):
+    """ スクリプトのソースから関数名と行番号の一覧を取得."""
+
+    ret = []
+    lnum = 0
+    for line in source.split('\n'):
+        lnum = lnum + 1
+        for pattern in SYMBOL_PATTERNS:
+            for m in pattern.finditer(line):
+                ret.append([m.group(1), lnum])
+    return ret
+
+class SymbolIndex():
+    """ ロード済スクリプトの関数名のインデックス.
+
+    スクリプトのソースはレスポンスで受け取ったときに一度だけパースし、
+    結果はソースのハッシュをキーにしてディスクへキャッシュする.
+    """
+    def __init__(self, cache_dir=os.path.join(CACHE_DIR, 'symbols')):
+        self.cache_dir = cache_dir
+        self.requested = set()
+        self.symbols_dict = {}
+        self.func_dict = None
+
+    def reset(self):
+        """ 接続しなおしたときなど、script id が変わるときに呼び出す."""
+        self.requested = set()
+        return
+
+    def new_ids(self, ids):
+        """ まだソースを要求していない script id の一覧(要求済にする)."""
+        ret = [i for i in ids if i not in self.requested]
+        self.requested.update(ret)
+        return ret
+
+    def _load(self, key):
+        try:
+            with open(os.path.join(self.cache_dir, key + '.json')) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def _save(self, key, symbols):
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            path = os.path.join(self.cache_dir, key + '.json')
+            with open(path + '.tmp', 'w') as f:
+                json.dump(symbols, f)
+            os.replace(path + '.tmp', path)
+        except (IOError, OSError):
+            pass
+        return
+
+    def add_script(self, name, source):
+        """ スクリプトの関数名をインデックスへ追加."""
+
+        key = hashlib.sha1(source.encode()).hexdigest()
+        symbols = self._load(key)
+        if symbols is None:
+            symbols = parse_symbols(source)
+            self._save(key, symbols)
+
+        self.symbols_dict[name] = symbols
+        self.func_dict = None
+        return len(symbols)
+
+    def _get_func_dict(self):
+        if self.func_dict is None:
+            self.func_dict = {}
+            for name, symbols in self.symbols_dict.items():
+                for func, lnum in symbols:
+                    # Foo.prototype.bar は bar でも引けるようにする.
+                    for k in set([func, func.rsplit('.', 1)[-1]]):
+                        self.func_dict.setdefault(k, []).append((name, lnum))
+        return self.func_dict
+
+    def find(self, func):
+        """ 関数名から (スクリプト名, 行番号) の一覧を取得."""
+        return self._get_func_dict().get(func, [])
+
+    def match(self, regex, script=None):
+        """ 関数名が正規表現にマッチする (スクリプト名, 行番号) の一覧.
+
+        script が指定されたときは、そのスクリプト内の関数のみ.
+        """
+        ret = set()
+        for name, symbols in self.symbols_dict.items():
+            if script is not None and name != script:
+                continue
+            for func, lnum in symbols:
+                if regex.search(func):
+                    ret.add((name, lnum))
+        return sorted(ret)
+
+    def names(self):
+        return sorted(self._get_func_dict().keys())
+
+def frame_to_label(frame):
+    """ backtrace(inlineRefs) のフレームをプロファイル用のラベルへ変換."""
+
+    func = frame.get('func', {})
+    name = func.get('name') or func.get('inferredName') or '(anonymous)'
+    script = os.path.basename(frame.get('script', {}).get('name') or '')
+    return '%s (%s:%d)' % (name, script, frame.get('line', -1) + 1)
+
+class StackSampler():
+    """ suspend と backtrace によるサンプリングプロファイラの集計.
+
+    サンプルはルートから順に ';' で連結したスタックごとに数え、
+    flamegraph の folded 形式で出力できるようにしておく.
+    """
+    # 応答がないときに、サンプリングを諦めるまでの秒数.
+    BUSY_TIMEOUT = 1.0
+
+    def __init__(self, hz):
+        self.interval = 1.0 / hz
+        self.next_time = time.time()
+        self.busy = False
+        self.busy_since = 0
+        # サンプリングごとの番号と、応答を待っているサンプリングの番号.
+        self.token = 0
+        self.pending = None
+        self.stacks = {}
+        self.samples = 0
+        self.pause_total = 0.0
+
+    def due(self, now):
+        """ サンプリングする時刻になったか."""
+        if self.busy and now - self.busy_since > self.BUSY_TIMEOUT:
+            self.abort()
+        return not self.busy and now >= self.next_time
+
+    def timeout(self, now):
+        """ 次のサンプリングまでの秒数."""
+        return max(0.0, self.next_time - now)
+
+    def begin(self, now):
+        """ サンプリングを始め、その番号を返す."""
+        self.busy = True
+        self.busy_since = now
+        self.next_time = now + self.interval
+        self.token = self.token + 1
+        self.pending = self.token
+        return self.token
+
+    def abort(self):
+        """ 応答を待っているサンプリングを取り消す.
+
+        取り消したサンプリングの backtrace は add で無視される.
+        """
+        self.busy = False
+        self.pending = None
+        return
+
+    def add(self, frames, now, token):
+        """ backtrace のフレーム(先頭が最も内側)を 1 サンプルとして追加.
+
+        token のサンプリングが取り消されていたときは何もせずに False を返す.
+        """
+        if token != self.pending:
+            return False
+        labels = [frame_to_label(f) for f in reversed(frames)]
+        if len(labels) > 0:
+            key = ';'.join(labels)
+            self.stacks[key] = self.stacks.get(key, 0) + 1
+            self.samples = self.samples + 1
+        self.pause_total = self.pause_total + (now - self.busy_since)
+        self.busy = False
+        self.pending = None
+        return True
+
+    def write_folded(self, path):
+        with open(path, 'w') as f:
+            for key, count in sorted(self.stacks.items()):
+                f.write('%s %d\n' % (key, count))
+        return
+
+    def top(self, n):
+        """ (ラベル, self のサンプル数, total のサンプル数) の上位 n 件."""
+        self_count = {}
+        total_count = {}
+        for key, count in self.stacks.items():
+            labels = key.split(';')
+            self_count[labels[-1]] = self_count.get(labels[-1], 0) + count
+            for label in set(labels):
+                total_count[label] = total_count.get(label, 0) + count
+        ret = [(l, self_count.get(l, 0), total_count[l]) for l in total_count]
+        ret.sort(key=lambda x: (x[1], x[2]), reverse=True)
+        return ret[:n]
+
+class PyProfiler():
+    """ nodedbg 自身(Python 側)の処理のプロファイラ.
+
+    I/O スレッドの handle_resp と myjob を、呼び出しごとに cProfile で計測する.
+    スレッドをまたいで一つの Profile を使うので、計測中の呼び出しは
+    lock で一つずつにする.
+    """
+    def __init__(self):
+        import cProfile
+        self.lock = threading.Lock()
+        self.profile = cProfile.Profile()
+        self.calls = 0
+        self.started = time.time()
+
+    def runcall(self, fn, *args):
+        """ fn を計測しながら呼び出す."""
+        with self.lock:
+            self.profile.enable()
+            try:
+                return fn(*args)
+            finally:
+                self.profile.disable()
+                self.calls = self.calls + 1
+
+    def stop(self, path, n):
+        """ 計測結果を pstats 形式で path へ書き出し、
+        cumulative の上位 n 件を文字列で返す.
+        """
+        import io
+        import pstats
+        with self.lock:
+            if self.calls == 0:
+                return ''
+            out = io.StringIO()
+            stats = pstats.Stats(self.profile, stream=out)
+        stats.dump_stats(path)
+        stats.strip_dirs().sort_stats('cumulative').print_stats(n)
+        return out.getvalue().strip('\n') + '\n'
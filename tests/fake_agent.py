@@ -0,0 +1,205 @@
+# vi:set ts=8 sts=4 sw=4 et tw=80:
+#
+# @author hankei6km
+# @copyright (c) 2013 hankei6km
+# @license MIT License (http://opensource.org/licenses/mit-license.php)
+#
+# テスト用の v8 debugger protocol の agent(node --debug).
+# 受け取った request ごとにレスポンスを返す. レスポンスは任意の位置で
+# 分割して送信し、request の arguments の size を指定されたときは、
+# その長さ(文字数)の文字列をボディに含める.
+# break や exception のイベントも、レスポンスの後や、待たせておいた
+# レスポンスの間に挟んで送信できる.
+
+import json
+import queue
+import random
+import socket
+import threading
+
+CONNECT_MESSAGE = (b'Type: connect\r\n'
+        b'V8-Version: 3.14.5.9\r\n'
+        b'Protocol-Version: 1\r\n'
+        b'Embedding-Host: node v0.10.48\r\n'
+        b'Content-Length: 0\r\n\r\n')
+
+def message(body):
+    """ Content-Length のヘッダを付けたメッセージ."""
+    return b'Content-Length: %d\r\n\r\n' % len(body) + body
+
+class FakeAgent():
+    """ v8 debugger protocol の agent のふりをするサーバー.
+
+    レスポンスは 1 から chunk_max バイトのランダムな長さに分割して送信する.
+    bodies には command ごとにレスポンスのボディを返す callable を、
+    events には request ごとにレスポンスの後で送信するイベントの
+    (event, body) のリストを返す callable を指定する.
+    """
+    def __init__(self, chunk_max=65536, seed=None, bodies=None, events=None):
+        self.chunk_max = chunk_max
+        self.random = random.Random(seed)
+        self.bodies = bodies or {}
+        self.events = events
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(1)
+        self.port = self.server.getsockname()[1]
+
+        self.conn = None
+        self.outgoing = queue.Queue()
+        self.lock = threading.Lock()
+        self.seq = 0
+        # 受け取った request の seq と、request そのもの.
+        self.requests = []
+        self.received = []
+        # hold してから送信を待たせているもの.
+        self.held = None
+
+        self.threads = [threading.Thread(target=self.read, daemon=True),
+                threading.Thread(target=self.write, daemon=True)]
+        self.connected = threading.Event()
+        for t in self.threads:
+            t.start()
+        return
+
+    def read(self):
+        try:
+            self.conn, addr = self.server.accept()
+            self.conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.connected.set()
+            self.outgoing.put(CONNECT_MESSAGE)
+            data = b''
+            while True:
+                head, sep, rest = data.partition(b'\r\n\r\n')
+                if sep:
+                    length = int(head.split(b':', 1)[1])
+                    if len(rest) >= length:
+                        req = json.loads(rest[:length].decode())
+                        data = rest[length:]
+                        self.respond(req)
+                        continue
+                chunk = self.conn.recv(65536)
+                if not chunk:
+                    break
+                data = data + chunk
+        except OSError:
+            pass
+        self.connected.set()
+        self.outgoing.put(None)
+        return
+
+    def new_seq(self):
+        with self.lock:
+            self.seq = self.seq + 1
+            return self.seq
+
+    def put(self, msg):
+        """ msg を送信する(hold しているときは待たせておく)."""
+        data = message(json.dumps(msg, ensure_ascii=False).encode())
+        with self.lock:
+            if self.held is not None:
+                self.held.append(data)
+                return
+        self.outgoing.put(data)
+        return
+
+    def respond(self, req):
+        with self.lock:
+            self.requests.append(req['seq'])
+            self.received.append(req)
+        if req['command'] in self.bodies:
+            body = self.bodies[req['command']](req)
+        else:
+            body = {}
+        size = req.get('arguments', {}).get('size')
+        if size:
+            # UTF-8 で 2 バイトになる文字で、バイト数と文字数を違える.
+            body['text'] = 'é' * size
+        self.put({
+                'seq': self.new_seq(),
+                'type': 'response',
+                'request_seq': req['seq'],
+                'command': req['command'],
+                'success': True,
+                'running': True,
+                'body': body
+                })
+        if self.events is not None:
+            for event, body in self.events(req):
+                self.send_event(event, body)
+        return
+
+    def event_message(self, event, body):
+        return {'seq': self.new_seq(), 'type': 'event', 'event': event,
+                'body': body}
+
+    def send_event(self, event, body):
+        """ イベントを送信する."""
+        self.put(self.event_message(event, body))
+        return
+
+    def hold(self):
+        """ release するまで、レスポンスとイベントの送信を待たせる."""
+        with self.lock:
+            self.held = []
+        return
+
+    def release(self, events=(), every=1):
+        """ 待たせていたものを送信する.
+
+        events のイベントは、待たせていたものの every 個ごとに一つずつ
+        挟んで送信する(余ったものは最後に送信する).
+        """
+        events = list(events)
+        with self.lock:
+            held = self.held
+            self.held = None
+        for i, data in enumerate(held):
+            self.outgoing.put(data)
+            if (i + 1) % every == 0 and len(events):
+                self.outgoing.put(message(json.dumps(
+                    self.event_message(*events.pop(0))).encode()))
+        for event in events:
+            self.outgoing.put(message(json.dumps(
+                self.event_message(*event)).encode()))
+        return
+
+    def send_raw(self, data):
+        """ data をそのまま(分割して)送信する."""
+        self.outgoing.put(data)
+        return
+
+    def write(self):
+        """ 送信待ちのものをまとめ、ランダムな長さに分割して送信する."""
+        self.connected.wait()
+        closed = False
+        while not closed:
+            items = [self.outgoing.get()]
+            while not self.outgoing.empty():
+                items.append(self.outgoing.get())
+            if None in items:
+                closed = True
+                items = items[:items.index(None)]
+            data = memoryview(b''.join(items))
+            offset = 0
+            try:
+                while offset < len(data):
+                    n = self.random.randint(1, self.chunk_max)
+                    self.conn.sendall(data[offset:offset + n])
+                    offset = offset + n
+            except OSError:
+                break
+        return
+
+    def close(self):
+        self.server.close()
+        if self.conn is not None:
+            try:
+                self.conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        for t in self.threads:
+            t.join(5)
+        if self.conn is not None:
+            self.conn.close()
+        return
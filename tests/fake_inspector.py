@@ -0,0 +1,234 @@
+# vi:set ts=8 sts=4 sw=4 et tw=80:
+#
+# @author hankei6km
+# @copyright (c) 2013 hankei6km
+# @license MIT License (http://opensource.org/licenses/mit-license.php)
+#
+# テスト用の Node.js の inspector.
+# /json/list と WebSocket のハンドシェイクに応答し、受け取ったフレームを記録する.
+# レスポンスやイベントはテストから送信する(フレームの分割や、
+# 任意の位置での送信の分割もできる).
+
+import io
+import json
+import socket
+import base64
+import hashlib
+import threading
+
+WS_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+WS_PATH = '/0f2c1d3e-4b5a-6978-8a9b-acbdcedf0011'
+
+def read_exactly(f, n):
+    data = f.read(n)
+    if data is None or len(data) < n:
+        raise EOFError()
+    return data
+
+def read_frame(f):
+    """ f から WebSocket のフレームを読み込む.
+
+    (fin, opcode, masked, マスクを外したペイロード) を返す.
+    """
+    head = read_exactly(f, 2)
+    fin = (head[0] & 0x80) != 0
+    opcode = head[0] & 0x0f
+    masked = (head[1] & 0x80) != 0
+    length = head[1] & 0x7f
+    if length == 126:
+        length = int.from_bytes(read_exactly(f, 2), 'big')
+    elif length == 127:
+        length = int.from_bytes(read_exactly(f, 8), 'big')
+    key = read_exactly(f, 4) if masked else None
+    payload = read_exactly(f, length)
+    if masked:
+        payload = bytes(b ^ key[i % 4] for i, b in enumerate(payload))
+    return fin, opcode, masked, payload
+
+def parse_frame(data):
+    """ bytes のフレームを読み込む(read_frame を参照)."""
+    return read_frame(io.BytesIO(data))
+
+def server_frame(payload, opcode=0x1, fin=True):
+    """ サーバーから送信する(マスクしない) WebSocket のフレーム."""
+    head = bytes([(0x80 if fin else 0) | opcode])
+    length = len(payload)
+    if length < 126:
+        head = head + bytes([length])
+    elif length < 65536:
+        head = head + bytes([126]) + length.to_bytes(2, 'big')
+    else:
+        head = head + bytes([127]) + length.to_bytes(8, 'big')
+    return head + payload
+
+def split(data, count):
+    """ data を count 個に分割する(空のものは含めない)."""
+    size = max(1, -(-len(data) // count))
+    return [data[i:i + size] for i in range(0, len(data), size)] or [data]
+
+class FakeInspector():
+    """ inspector のふりをするサーバー.
+
+    results には method ごとのレスポンスの result を指定する(指定のない
+    method には空の result を返す). callable のときは params で呼び出す.
+    """
+    def __init__(self, results=None):
+        self.results = results or {}
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(2)
+        self.port = self.server.getsockname()[1]
+
+        self.cond = threading.Condition()
+        self.conn = None
+        self.sending = threading.Lock()
+        # WebSocket の upgrade の request の path とヘッダ.
+        self.path = None
+        self.headers = {}
+        # 受け取ったフレームの (fin, opcode, masked, payload) と、
+        # request(JSON) のリスト.
+        self.frames = []
+        self.requests = []
+        self.closed = False
+
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+        return
+
+    def serve(self):
+        try:
+            while True:
+                conn, addr = self.server.accept()
+                if self.handle_http(conn):
+                    break
+            self.handle_ws(conn)
+        except (OSError, EOFError):
+            pass
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        return
+
+    def handle_http(self, conn):
+        """ HTTP の request に応答する(WebSocket へ upgrade したら True)."""
+        data = b''
+        while b'\r\n\r\n' not in data:
+            chunk = conn.recv(4096)
+            if not chunk:
+                conn.close()
+                return False
+            data = data + chunk
+        lines = data.split(b'\r\n\r\n', 1)[0].decode('latin-1').split('\r\n')
+        path = lines[0].split(' ')[1]
+        headers = {}
+        for line in lines[1:]:
+            name, sep, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        if path == '/json/list':
+            body = json.dumps([{
+                'type': 'node',
+                'webSocketDebuggerUrl': 'ws://127.0.0.1:%d%s' % \
+                        (self.port, WS_PATH)
+                }]).encode()
+            conn.sendall(b'HTTP/1.0 200 OK\r\n'
+                    b'Content-Type: application/json\r\n'
+                    b'Content-Length: %d\r\n\r\n' % len(body) + body)
+            conn.close()
+            return False
+
+        accept = base64.b64encode(hashlib.sha1(
+            (headers.get('sec-websocket-key', '') + WS_GUID).encode()
+            ).digest())
+        with self.cond:
+            self.path = path
+            self.headers = headers
+            self.conn = conn
+        conn.sendall(b'HTTP/1.1 101 Switching Protocols\r\n'
+                b'Upgrade: websocket\r\n'
+                b'Connection: Upgrade\r\n'
+                b'Sec-WebSocket-Accept: ' + accept + b'\r\n\r\n')
+        return True
+
+    def handle_ws(self, conn):
+        f = conn.makefile('rb')
+        while True:
+            frame = read_frame(f)
+            fin, opcode, masked, payload = frame
+            with self.cond:
+                self.frames.append(frame)
+                self.cond.notify_all()
+            if opcode == 0x8:
+                break
+            if opcode != 0x1:
+                continue
+            msg = json.loads(payload.decode())
+            with self.cond:
+                self.requests.append(msg)
+                self.cond.notify_all()
+            result = self.results.get(msg['method'], {})
+            if callable(result):
+                result = result(msg.get('params', {}))
+            if result is not None:
+                self.send({'id': msg['id'], 'result': result})
+        conn.close()
+        return
+
+    def send(self, msg, fragments=1, chunk=None):
+        """ msg を送信する.
+
+        fragments 個のフレームに分けて送信し、chunk が指定されたときは
+        chunk バイトずつ送信する.
+        """
+        payload = json.dumps(msg).encode()
+        frames = []
+        parts = split(payload, fragments)
+        for i, part in enumerate(parts):
+            opcode = 0x1 if i == 0 else 0x0
+            frames.append(server_frame(part, opcode, i == len(parts) - 1))
+        self.send_raw(b''.join(frames), chunk)
+        return
+
+    def send_event(self, method, params=None, fragments=1, chunk=None):
+        self.send({'method': method, 'params': params or {}}, fragments,
+                chunk)
+        return
+
+    def send_raw(self, data, chunk=None):
+        with self.sending:
+            if chunk is None:
+                self.conn.sendall(data)
+            else:
+                for i in range(0, len(data), chunk):
+                    self.conn.sendall(data[i:i + chunk])
+        return
+
+    def wait(self, predicate, timeout=5):
+        """ predicate() が真になるまで待ち、その値を返す."""
+        with self.cond:
+            self.cond.wait_for(predicate, timeout)
+            return predicate()
+
+    def wait_request(self, method, timeout=5):
+        """ method の request を受け取るまで待つ(受け取れなければ None)."""
+        def find():
+            for msg in self.requests:
+                if msg['method'] == method:
+                    return msg
+            return None
+        return self.wait(find, timeout)
+
+    def methods(self):
+        with self.cond:
+            return [msg['method'] for msg in self.requests]
+
+    def close(self):
+        self.server.close()
+        if self.conn is not None:
+            try:
+                self.conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.conn.close()
+        self.thread.join(5)
+        return
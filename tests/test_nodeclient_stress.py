@@ -0,0 +1,287 @@
+# vi:set ts=8 sts=4 sw=4 et tw=80:
+#
+# @author hankei6km
+# @copyright (c) 2013 hankei6km
+# @license MIT License (http://opensource.org/licenses/mit-license.php)
+#
+# NodeClient を FakeAgent と接続しての負荷テスト.
+# レスポンスはランダムな位置で分割して届き、複数のスレッドから同時に
+# send_req する. すべての request にちょうど一度だけレスポンスが
+# 対応付けられることを確かめ、スループットと応答時間を表示する.
+# また、レスポンスの間に break や exception のイベントが続けて届いたときに
+# NodeTarget が bp_que へ渡す item を確かめる.
+
+import sys
+import time
+import threading
+import unittest
+import collections
+
+from clewn.nodeclient import NodeClient
+
+from fake_agent import FakeAgent, message
+
+try:
+    from clewn.nodedbg import NodeTarget
+except ImportError:
+    # pyclewn(misc, debugger)がないときは NodeTarget のテストは省く.
+    NodeTarget = None
+
+TIMEOUT = 30
+
+class NodeClientStressTestCase(unittest.TestCase):
+    """ FakeAgent と接続した NodeClient での負荷テスト."""
+
+    def start(self, chunk_max=65536):
+        self.agent = FakeAgent(chunk_max, seed=47)
+        self.cond = threading.Condition()
+        # 受け取ったレスポンスの (request_seq, tag, レスポンス).
+        self.responses = []
+        self.client = NodeClient(self.handle_resp)
+        self.client.connect_start('127.0.0.1', self.agent.port)
+        self.thread = threading.Thread(target=self.client.loop, daemon=True)
+        self.thread.start()
+        return
+
+    def tearDown(self):
+        self.client.close_when_done()
+        self.thread.join(TIMEOUT)
+        self.agent.close()
+        self.assertFalse(self.thread.is_alive())
+        return
+
+    def handle_resp(self, data):
+        tag = self.client.pop_tag(data)
+        with self.cond:
+            self.responses.append((data['request_seq'], tag, data))
+            self.cond.notify_all()
+        return
+
+    def send(self, count, threads=1, size=lambda i: 0):
+        """ threads 個のスレッドから count 個ずつ send_req し、
+        {seq: tag} を返す."""
+        sent = {}
+        lock = threading.Lock()
+
+        def sender(k):
+            for i in range(count):
+                tag = {'thread': k, 'index': i}
+                req = {'command': 'evaluate', 'arguments': {'size': size(i)}}
+                seq = self.client.send_req(req, tag)
+                with lock:
+                    sent[seq] = tag
+
+        senders = [threading.Thread(target=sender, args=(k,))
+                for k in range(threads)]
+        for t in senders:
+            t.start()
+        for t in senders:
+            t.join()
+        return sent
+
+    def wait_responses(self, count):
+        with self.cond:
+            self.cond.wait_for(lambda: len(self.responses) >= count, TIMEOUT)
+        self.finished = time.time()
+        # 余分なレスポンスが届いていないことも確かめる.
+        time.sleep(0.2)
+        with self.cond:
+            return list(self.responses)
+
+    def assertExactlyOnce(self, sent, responses):
+        counts = collections.Counter(seq for seq, tag, data in responses)
+        self.assertEqual(set(counts), set(sent))
+        self.assertEqual([seq for seq, n in counts.items() if n != 1], [])
+        for seq, tag, data in responses:
+            self.assertEqual(tag, sent[seq])
+        self.assertEqual(sorted(self.agent.requests), sorted(sent))
+        self.assertEqual(self.client.tags, {})
+        self.assertEqual(self.client.sent_at, {})
+
+    def report(self, name, count, elapsed):
+        p50, p99, worst = self.client.latency()
+        sys.stderr.write('\n%s: %d requests in %.2fs (%.0f req/s), '
+                'latency p50 %.2fms p99 %.2fms max %.2fms\n' % \
+                        (name, count, elapsed, count / elapsed,
+                            p50 * 1000, p99 * 1000, worst * 1000))
+        return
+
+    def test_split_at_random_offsets(self):
+        """Responses split into 1 to 7 byte pieces are all parsed."""
+        self.start(chunk_max=7)
+        started = time.time()
+        sent = self.send(500)
+        responses = self.wait_responses(len(sent))
+        self.report('split', len(sent), self.finished - started)
+        self.assertExactlyOnce(sent, responses)
+        self.assertEqual(self.client.discarded, 0)
+
+    def test_large_bodies(self):
+        """Multi-MB bodies arrive intact, between small ones."""
+        self.start()
+        size = lambda i: 3 * 1024 * 1024 if i % 5 == 0 else 0
+        started = time.time()
+        sent = self.send(20, size=size)
+        responses = self.wait_responses(len(sent))
+        self.report('large', len(sent), self.finished - started)
+        self.assertExactlyOnce(sent, responses)
+        for seq, tag, data in responses:
+            self.assertEqual(len(data['body'].get('text', '')),
+                    size(tag['index']))
+
+    def test_concurrent_send_req(self):
+        """Every request of several threads is answered exactly once."""
+        self.start()
+        size = lambda i: 2 * 1024 * 1024 if i % 250 == 0 else 0
+        started = time.time()
+        sent = self.send(500, threads=8, size=size)
+        responses = self.wait_responses(len(sent))
+        self.report('concurrent', len(sent), self.finished - started)
+        self.assertExactlyOnce(sent, responses)
+        self.assertEqual(self.client.discarded, 0)
+
+    def test_malformed_body(self):
+        """A body that is not JSON is discarded and parsing goes on."""
+        self.start(chunk_max=3)
+        sent = self.send(10)
+        self.wait_responses(len(sent))
+        self.agent.send_raw(message(b'{bad json') +
+                b'Content-Length: x\r\n\r\n')
+        sent.update(self.send(10))
+        responses = self.wait_responses(len(sent))
+        self.assertExactlyOnce(sent, responses)
+        self.assertEqual(self.client.discarded, 2)
+
+def break_body(line, **body):
+    body['script'] = {'name': '/app/a.js', 'id': 1}
+    body['sourceLine'] = line
+    return body
+
+@unittest.skipIf(NodeTarget is None, 'pyclewn is not installed')
+class NodeTargetStressTestCase(unittest.TestCase):
+    """ FakeAgent と接続した NodeTarget が bp_que へ渡す item のテスト."""
+
+    def setUp(self):
+        self.agent = FakeAgent(7, seed=47, bodies={
+            'frame': lambda req: {'scopes': [],
+                'script': {'name': '/app/a.js'}, 'line': 0},
+            'lookup': lambda req: dict((str(h), {'handle': h,
+                'properties': []}) for h in req['arguments']['handles'])
+            }, events=self.agent_events)
+        # ステップ実行で停止した回数と、ブレイクポイントで停止させる回目.
+        self.stops = 0
+        self.hit_at = None
+        self.items = []
+        self.target = NodeTarget(True, '127.0.0.1', self.agent.port)
+        self.target.start()
+        self.agent.send_event('break', break_body(0))
+        self.assertEqual(self.types(lambda t: 'break' in t), ['break'])
+        self.items = []
+        return
+
+    def tearDown(self):
+        self.target.close()
+        self.target.join(TIMEOUT)
+        self.agent.close()
+        self.assertFalse(self.target.is_alive())
+        return
+
+    def agent_events(self, req):
+        """ continue(ステップ実行)のレスポンスの後で停止させる."""
+        if req['command'] != 'continue' or 'arguments' not in req:
+            return []
+        self.stops = self.stops + 1
+        body = break_body(self.stops)
+        if self.stops == self.hit_at:
+            body['breakpoints'] = [1]
+        return [('break', body)]
+
+    def types(self, predicate):
+        """ predicate(item の type のリスト)が真になるまで bp_que から
+        取り出し(NodeDbg.update_job と同じく drain で)、type のリストを返す."""
+        end = time.time() + TIMEOUT
+        while time.time() < end and \
+                not predicate([i['type'] for i in self.items]):
+            self.items.extend(self.target.bp_que.drain())
+            time.sleep(0.01)
+        # 余分な item が渡されていないことも確かめる.
+        time.sleep(0.2)
+        self.items.extend(self.target.bp_que.drain())
+        return [i['type'] for i in self.items]
+
+    def continues(self):
+        with self.agent.lock:
+            return [(req['arguments']['stepaction'],
+                req['arguments']['stepcount'])
+                for req in self.agent.received
+                if req['command'] == 'continue' and 'arguments' in req]
+
+    def wait_continue(self):
+        end = time.time() + TIMEOUT
+        while time.time() < end and len(self.continues()) == 0:
+            time.sleep(0.01)
+        return
+
+    def test_break_burst(self):
+        """A burst of stops gives one break each and drops stale items."""
+        self.agent.hold()
+        for i in range(20):
+            self.target.frame()
+            self.target.lookup([i])
+        end = time.time() + TIMEOUT
+        while time.time() < end and len(self.agent.received) < 40:
+            time.sleep(0.01)
+        events = [('break', break_body(line)) for line in range(10, 15)]
+        events.append(('exception', break_body(15,
+            exception={'text': 'Error: x'})))
+        self.agent.release(events, every=7)
+        types = self.types(lambda t: t.count('break') == 6)
+        self.assertEqual(types, ['break'] * 6 + ['print'])
+        self.assertEqual([i['lnum'] for i in self.items[:6]],
+                list(range(11, 17)))
+        # 古い停止時のレスポンスの item はすべて破棄されている.
+        self.assertEqual(self.target.bp_que.dropped, 40)
+        self.assertEqual(self.target.pause_gen, 7)
+
+        self.items = []
+        self.target.frame()
+        self.target.lookup([3])
+        types = self.types(lambda t: 'properties' in t)
+        self.assertEqual(sorted(types), ['frame', 'properties'])
+        self.assertEqual([i['gen'] for i in self.items], [7, 7])
+
+    def test_pending_steps(self):
+        """Steps requested while running are sent at each stop."""
+        self.agent.hold()
+        self.target.step()
+        self.target.step(2)
+        self.target.stepin()
+        self.target.step()
+        self.wait_continue()
+        self.agent.release()
+        types = self.types(lambda t: 'break' in t)
+        self.assertEqual(types, ['break'])
+        self.assertEqual(self.items[0]['lnum'], 5)
+        self.assertEqual(self.continues(),
+                [('next', 1), ('next', 2), ('in', 1), ('next', 1)])
+        self.assertEqual(self.target.pending_steps, [])
+        self.assertFalse(self.target.running)
+
+    def test_pending_steps_breakpoint(self):
+        """A breakpoint hit cancels the pending steps."""
+        self.hit_at = 2
+        self.agent.hold()
+        self.target.step()
+        self.target.step(2)
+        self.target.stepin()
+        self.wait_continue()
+        self.agent.release()
+        types = self.types(lambda t: 'break' in t)
+        self.assertEqual(types, ['break'])
+        self.assertEqual(self.items[0]['lnum'], 3)
+        self.assertEqual(self.continues(), [('next', 1), ('next', 2)])
+        self.assertEqual(self.target.pending_steps, [])
+        self.assertFalse(self.target.running)
+
+if __name__ == '__main__':
+    unittest.main()
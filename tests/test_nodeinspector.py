@@ -0,0 +1,240 @@
+# vi:set ts=8 sts=4 sw=4 et tw=80:
+#
+# @author hankei6km
+# @copyright (c) 2013 hankei6km
+# @license MIT License (http://opensource.org/licenses/mit-license.php)
+#
+# InspectorClient を FakeInspector と接続してのテスト.
+
+import queue
+import threading
+import unittest
+
+from clewn.nodeinspector import InspectorClient, ws_frame
+
+from fake_inspector import FakeInspector, WS_PATH, parse_frame, server_frame
+
+TIMEOUT = 5
+
+SCRIPT = {'scriptId': '42', 'url': 'file:///tmp/t%20est.js'}
+
+def call_frame(line, func='add', script_id='42'):
+    return {
+            'callFrameId': 'frame:' + func,
+            'functionName': func,
+            'location': {'scriptId': script_id, 'lineNumber': line,
+                'columnNumber': 2},
+            'scopeChain': []
+            }
+
+class InspectorClientTestCase(unittest.TestCase):
+    """ FakeInspector と接続した InspectorClient でのテスト."""
+
+    def setUp(self):
+        self.inspector = FakeInspector({
+            'Debugger.setBreakpointByUrl': lambda params: {
+                'breakpointId': '1:%d:0:t' % params['lineNumber'],
+                'locations': [{'scriptId': '42',
+                    'lineNumber': params['lineNumber'], 'columnNumber': 0}]
+                }
+            })
+        self.messages = queue.Queue()
+        self.client = InspectorClient(self.messages.put)
+        self.client.connect_start('127.0.0.1', self.inspector.port)
+        self.thread = threading.Thread(target=self.client.loop,
+                args=(lambda: 0.05,), daemon=True)
+        self.thread.start()
+        self.assertIsNotNone(
+                self.inspector.wait_request('Runtime.runIfWaitingForDebugger'))
+        return
+
+    def tearDown(self):
+        self.client.close_when_done()
+        self.thread.join(TIMEOUT)
+        self.inspector.close()
+        self.assertFalse(self.thread.is_alive())
+        return
+
+    def next_message(self):
+        return self.messages.get(timeout=TIMEOUT)
+
+    def assertNoMessage(self):
+        self.assertRaises(queue.Empty, self.messages.get, timeout=0.2)
+
+    def pause(self, line, **params):
+        params.setdefault('reason', 'other')
+        params['callFrames'] = [call_frame(line), call_frame(9, 'main')]
+        self.inspector.send_event('Debugger.paused', params)
+        return
+
+    def test_handshake(self):
+        """The upgrade request uses the url from /json/list."""
+        self.assertEqual(self.inspector.path, WS_PATH)
+        headers = self.inspector.headers
+        self.assertEqual(headers['upgrade'].lower(), 'websocket')
+        self.assertEqual(headers['sec-websocket-version'], '13')
+        self.assertTrue(headers['sec-websocket-key'])
+        self.assertEqual(self.inspector.methods()[:3], ['Runtime.enable',
+            'Debugger.enable', 'Runtime.runIfWaitingForDebugger'])
+
+    def test_masked_frames(self):
+        """All frames sent by the client are masked."""
+        self.client.dbg_setbp('/tmp/a.js', 3)
+        data = self.next_message()
+        self.assertEqual(data['command'], 'setbreakpoint')
+        self.assertEqual(data['body']['actual_locations'], [{'line': 2}])
+        self.client.dbg_disconnect()
+        self.next_message()
+        frames = self.inspector.wait(
+                lambda: [f for f in self.inspector.frames if f[1] == 0x8])
+        self.assertTrue(frames)
+        for fin, opcode, masked, payload in self.inspector.frames:
+            self.assertTrue(fin)
+            self.assertTrue(masked)
+
+    def test_ws_frame_lengths(self):
+        """Payload lengths use the 7, 16 and 64 bit forms."""
+        for length in (0, 125, 126, 65535, 65536, 70000):
+            payload = bytes(i % 251 for i in range(length))
+            fin, opcode, masked, data = parse_frame(ws_frame(payload))
+            self.assertEqual((fin, opcode, masked), (True, 0x1, True))
+            self.assertEqual(data, payload)
+
+    def test_ping(self):
+        """A ping is answered with a masked pong of the same payload."""
+        self.inspector.send_raw(server_frame(b'hello', 0x9))
+        frames = self.inspector.wait(
+                lambda: [f for f in self.inspector.frames if f[1] == 0xa])
+        self.assertEqual(frames, [(True, 0xa, True, b'hello')])
+
+    def test_fragmented_frames(self):
+        """Fragmented messages are joined, whatever the chunk size."""
+        long_script = {'scriptId': '43',
+                'url': 'file:///tmp/' + 'x' * 70000 + '.js'}
+        self.inspector.send_event('Debugger.scriptParsed', SCRIPT,
+                fragments=3, chunk=1)
+        self.inspector.send_event('Debugger.scriptParsed', long_script,
+                fragments=4, chunk=997)
+        self.inspector.send_event('Debugger.paused', {'reason': 'other',
+            'callFrames': [call_frame(0, 'f', '43'), call_frame(3)]},
+            fragments=2)
+        data = self.next_message()
+        self.assertEqual(data['event'], 'break')
+        self.assertEqual(data['body']['script']['name'],
+                '/tmp/' + 'x' * 70000 + '.js')
+
+        self.client.dbg_backtrace()
+        frames = self.next_message()['body']['frames']
+        self.assertEqual([f['script']['name'] for f in frames],
+                ['/tmp/' + 'x' * 70000 + '.js', '/tmp/t est.js'])
+
+    def test_paused(self):
+        """A backtrace requested while running is answered once paused."""
+        self.inspector.send_event('Debugger.scriptParsed', SCRIPT)
+        self.client.dbg_backtrace(tag={'type': 'backtrace'})
+        self.assertNoMessage()
+
+        self.pause(4, hitBreakpoints=['1:4:0:t'])
+        data = self.next_message()
+        self.assertEqual(data['event'], 'break')
+        self.assertEqual(data['body']['script'], {'id': 42,
+            'name': '/tmp/t est.js'})
+        self.assertEqual(data['body']['sourceLine'], 4)
+        self.assertEqual(data['body']['breakpoints'], ['1:4:0:t'])
+        self.assertNotIn('suspend', data['body'])
+
+        data = self.next_message()
+        self.assertEqual(data['command'], 'backtrace')
+        self.assertEqual(self.client.pop_tag(data), {'type': 'backtrace'})
+        self.assertEqual([f['func']['name'] for f in data['body']['frames']],
+                ['add', 'main'])
+
+    def test_resumed(self):
+        """A suspend sent while resuming waits for Debugger.resumed."""
+        self.pause(4)
+        self.assertEqual(self.next_message()['event'], 'break')
+
+        self.client.dbg_continue()
+        self.client.dbg_suspend()
+        self.assertEqual(self.next_message()['command'], 'continue')
+        self.assertIsNone(self.inspector.wait_request('Debugger.pause', 0.2))
+        self.assertIsNone(self.client.call_frames)
+
+        self.inspector.send_event('Debugger.resumed')
+        self.assertIsNotNone(self.inspector.wait_request('Debugger.pause'))
+        self.assertEqual(self.next_message()['command'], 'suspend')
+
+        self.pause(5)
+        data = self.next_message()
+        self.assertEqual(data['event'], 'break')
+        self.assertEqual(data['body']['sourceLine'], 5)
+        self.assertTrue(data['body']['suspend'])
+
+    def test_steps(self):
+        """Counted steps stop early on a breakpoint."""
+        self.pause(4)
+        self.assertEqual(self.next_message()['event'], 'break')
+        self.client.dbg_continue('next', 3)
+        self.assertEqual(self.next_message()['command'], 'continue')
+        self.inspector.send_event('Debugger.resumed')
+        self.pause(5)
+        self.assertTrue(self.inspector.wait(
+            lambda: self.inspector.methods().count('Debugger.stepOver') == 2))
+        self.assertNoMessage()
+
+        self.inspector.send_event('Debugger.resumed')
+        self.pause(7, hitBreakpoints=['1:7:0:t'])
+        data = self.next_message()
+        self.assertEqual(data['event'], 'break')
+        self.assertEqual(data['body']['sourceLine'], 7)
+        self.assertEqual(data['body']['breakpoints'], ['1:7:0:t'])
+        self.assertEqual(self.inspector.methods().count('Debugger.stepOver'),
+                2)
+
+    def test_preview(self):
+        """The children of a fully previewed object come with the scope."""
+        self.inspector.results['Runtime.getProperties'] = {'result': [
+            {'name': 'flat', 'value': {'type': 'object',
+                'className': 'Object', 'objectId': 'o:1', 'preview': {
+                    'type': 'object', 'overflow': False, 'properties': [
+                        {'name': 'n', 'type': 'number', 'value': '5'},
+                        {'name': 's', 'type': 'string', 'value': 'x'},
+                        {'name': 'z', 'type': 'object', 'subtype': 'null',
+                            'value': 'null'},
+                        {'name': 'o', 'type': 'object', 'value': 'Object'}
+                        ]}}},
+            {'name': 'big', 'value': {'type': 'object',
+                'className': 'Object', 'objectId': 'o:2', 'preview': {
+                    'type': 'object', 'overflow': True, 'properties': []}}}
+            ]}
+        self.inspector.send_event('Debugger.paused', {'reason': 'other',
+            'callFrames': [dict(call_frame(4), scopeChain=[{'type': 'local',
+                'object': {'type': 'object', 'objectId': 'scope:0'}}])]})
+        self.assertEqual(self.next_message()['event'], 'break')
+
+        self.client.dbg_scope(0, 0)
+        properties = self.next_message()['body']['object']['properties']
+        flat, big = [p['value'] for p in properties]
+        self.assertEqual(flat['preview'], [
+            {'name': 'n', 'value': {'type': 'number', 'value': 5}},
+            {'name': 's', 'value': {'type': 'string', 'value': 'x'}},
+            {'name': 'z', 'value': {'type': 'null', 'value': None}},
+            {'name': 'o', 'value': {'type': 'object', 'value': 'Object'}}])
+        self.assertIn('ref', flat)
+        self.assertNotIn('preview', big)
+
+    def test_exception(self):
+        """A pause on an exception is reported as an exception event."""
+        self.pause(4, reason='exception', data={'description': 'Error: x'})
+        data = self.next_message()
+        self.assertEqual(data['event'], 'exception')
+        self.assertEqual(data['body']['exception'], {'text': 'Error: x'})
+
+    def test_close_frame(self):
+        """The loop ends when the inspector closes the connection."""
+        self.inspector.send_raw(server_frame(b'', 0x8))
+        self.thread.join(TIMEOUT)
+        self.assertFalse(self.thread.is_alive())
+
+if __name__ == '__main__':
+    unittest.main()
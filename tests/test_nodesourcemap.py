@@ -0,0 +1,64 @@
+# vi:set ts=8 sts=4 sw=4 et tw=80:
+#
+# @author hankei6km
+# @copyright (c) 2013 hankei6km
+# @license MIT License (http://opensource.org/licenses/mit-license.php)
+#
+# nodesourcemap のテスト.
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+from clewn.nodesourcemap import SourceMaps
+
+GEN_JS = '''"use strict";
+function f(x) {
+    const y = x * 2;
+    return y + 1;
+}
+//# sourceMappingURL=gen.js.map
+'''
+
+class SourceMapsTestCase(unittest.TestCase):
+    """ 生成されたスクリプトと元のソースとの位置の変換のテスト."""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.js = os.path.join(self.dir, 'gen.js')
+        self.ts = os.path.join(self.dir, 'src', 'gen.ts')
+        with open(self.js, 'w') as f:
+            f.write(GEN_JS)
+        self.maps = SourceMaps()
+        return
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        return
+
+    def write_map(self, mappings):
+        with open(self.js + '.map', 'w') as f:
+            json.dump({'version': 3, 'sources': ['src/gen.ts'],
+                'mappings': mappings}, f)
+        return
+
+    def test_convert(self):
+        """Positions are converted both ways."""
+        self.write_map(';AAAA;AACE;AACA;AACF')
+        self.assertTrue(self.maps.add_scripts([self.js]))
+        self.assertEqual(self.maps.to_original(self.js, 4), (self.ts, 3))
+        self.assertEqual(self.maps.to_generated(self.ts, 3), (self.js, 4))
+        self.assertEqual(self.maps.to_generated(self.ts, 9), (self.ts, 9))
+
+    def test_malformed_mappings(self):
+        """A map whose mappings cannot be decoded is dropped."""
+        self.write_map(';AAAA;AA!E;AACA')
+        self.assertTrue(self.maps.add_scripts([self.js]))
+        self.assertEqual(self.maps.to_original(self.js, 2), (self.js, 2))
+        self.assertEqual(self.maps.to_generated(self.ts, 1), (self.ts, 1))
+        self.assertIsNone(self.maps.get(self.js))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+# vi:set ts=8 sts=4 sw=4 et tw=80:
+#
+# @author hankei6km
+# @copyright (c) 2013 hankei6km
+# @license MIT License (http://opensource.org/licenses/mit-license.php)
+#
+# nodeutils のテスト.
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+from clewn.nodeutils import (Scripts, BreakPoints, BreakPointJournal,
+        is_absolute, serialized_to_print)
+
+def scripts_body(*names):
+    return [{'name': name, 'type': 2, 'id': i}
+            for i, name in enumerate(names)]
+
+class ScriptsTestCase(unittest.TestCase):
+    """ Scripts.resolve のテスト."""
+
+    def setUp(self):
+        self.scripts = Scripts()
+        self.scripts.set_scripts(scripts_body('/srv/app/lib/foo.js',
+            '/srv/app/lib/bar.js', '/srv/app/test/bar.js'))
+        return
+
+    def test_is_absolute(self):
+        """Absolute paths include Windows drive letters."""
+        self.assertTrue(is_absolute('/app/lib/foo.js'))
+        self.assertTrue(is_absolute('C:\\app\\foo.js'))
+        self.assertTrue(is_absolute('c:/app/foo.js'))
+        self.assertFalse(is_absolute('lib/foo.js'))
+        self.assertFalse(is_absolute('foo.js'))
+
+    def test_resolve_suffix(self):
+        """A relative name resolves by the last components of the path."""
+        self.assertEqual(self.scripts.resolve('foo.js'),
+                ('/srv/app/lib/foo.js', ['/srv/app/lib/foo.js']))
+        self.assertEqual(self.scripts.resolve('lib/bar.js')[0],
+                '/srv/app/lib/bar.js')
+        self.assertEqual(self.scripts.resolve('bar.js'),
+                (None, ['/srv/app/lib/bar.js', '/srv/app/test/bar.js']))
+        self.assertEqual(self.scripts.resolve('baz.js'), (None, []))
+
+    def test_resolve_absolute(self):
+        """An absolute name resolves only to the same script."""
+        self.assertEqual(self.scripts.resolve('/srv/app/lib/foo.js')[0],
+                '/srv/app/lib/foo.js')
+        self.assertEqual(self.scripts.resolve('/app/lib/foo.js'), (None, []))
+        self.assertEqual(self.scripts.resolve('C:\\app\\lib\\foo.js'),
+                (None, []))
+
+class BreakPointsTestCase(unittest.TestCase):
+    """ BreakPoints.get_standby_bps と保存のテスト."""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.journal = BreakPointJournal(os.path.join(self.dir, 'bp.jsonl'))
+        self.bps = BreakPoints()
+        self.bps.open_journal(self.journal)
+        self.bps.set_journal(self.journal)
+        self.scripts = Scripts()
+        return
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        return
+
+    def saved(self):
+        return [rec[0] for rec in
+                BreakPointJournal(self.journal.path).load()]
+
+    def test_absolute_standby(self):
+        """A breakpoint on an absolute path waits for that very script."""
+        self.bps.add_standby(1, '/app/lib/foo.js', 5)
+        self.scripts.set_scripts(scripts_body('/srv/app/lib/foo.js'))
+        self.assertEqual(self.bps.get_standby_bps(self.scripts), [])
+        self.assertEqual(self.saved(), ['5:/app/lib/foo.js'])
+
+        self.scripts.set_scripts(scripts_body('/srv/app/lib/foo.js',
+            '/app/lib/foo.js'))
+        bplist = self.bps.get_standby_bps(self.scripts)
+        self.assertEqual([(bp['name'], bp['lnum']) for bp in bplist],
+                [('/app/lib/foo.js', '5')])
+        self.assertEqual(self.saved(), ['5:/app/lib/foo.js'])
+
+    def test_relative_standby(self):
+        """A breakpoint on a path suffix is renamed once it is resolved."""
+        self.bps.add_standby(1, 'lib/foo.js', 5)
+        self.scripts.set_scripts(scripts_body('/srv/app/lib/foo.js'))
+        bplist = self.bps.get_standby_bps(self.scripts)
+        self.assertEqual([(bp['name'], bp['lnum']) for bp in bplist],
+                [('/srv/app/lib/foo.js', '5')])
+        self.assertEqual(self.saved(), ['5:/srv/app/lib/foo.js'])
+
+    def test_map_standby(self):
+        """A breakpoint in an original source moves to the generated one."""
+        self.bps.add_standby(1, '/app/src/foo.ts', 3)
+        self.bps.add_standby(2, '/app/lib/bar.js', 7)
+        self.bps.map_standby(lambda name, lnum: ('/app/lib/foo.js', 4)
+                if name == '/app/src/foo.ts' else (name, lnum))
+        self.scripts.set_scripts(scripts_body('/app/lib/foo.js'))
+        bplist = self.bps.get_standby_bps(self.scripts)
+        self.assertEqual([(bp['name'], bp['lnum'], bp['bp_id'])
+            for bp in bplist], [('/app/lib/foo.js', '4', 1)])
+        self.assertEqual(sorted(self.saved()),
+                ['4:/app/lib/foo.js', '7:/app/lib/bar.js'])
+
+class SerializedTestCase(unittest.TestCase):
+    """ serialized_to_print のテスト."""
+
+    def test_print(self):
+        """The serialized value is printed with its structure."""
+        value = json.dumps({'c': 'Object', 'a': False, 'more': 0,
+            'p': [['x', {'v': '1'}]]})
+        self.assertEqual(serialized_to_print({'body': {'type': 'string',
+            'value': value, 'handle': 3}}), '{\n x: 1\n}')
+
+    def test_truncated(self):
+        """A truncated value is reported in one line."""
+        data = {'body': {'type': 'string', 'value': '{"c": "Obj',
+            'handle': 3, 'length': 250000}}
+        self.assertEqual(serialized_to_print(data),
+                'Serialization truncated (10 of 250000 characters), '
+                'try a smaller depth.')
+
+    def test_not_serialized(self):
+        """A value that is not JSON is reported in one line."""
+        data = {'body': {'type': 'undefined', 'text': 'undefined'}}
+        self.assertEqual(serialized_to_print(data),
+                'Cannot decode the serialized value.')
+
+if __name__ == '__main__':
+    unittest.main()